@@ -3,32 +3,211 @@ import os
 import shutil 
 import argparse
 import subprocess
+import threading
+import multiprocessing
+import hashlib
+import json
+import time
+import traceback
+import re
+import random
+import socket
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from rollingstats import RollingStats
+from resultstore import ResultStore, new_run_id
+from regression import compare_run, write_report
+from procstats import start_accounting, wait_with_usage, usageMetrics, process_group_args, kill_tree
+from steadystate import warmup_length
+from cpusets import split_cores, pin_command
+from logparser import LogParser, numberPattern
+from memsampler import MemorySampler, sample_at, sampleFields, sampling_available
+from launcher import monotonic, resolve_argv, split_command, command_line
+from benchview import Measurement
+from telemetry import Telemetry
+from checkpoint import Checkpoint, RetryBudget, fingerprint
+from sharding import Coordinator, Agent, ShardError, parse_address, normalize_machines
+
+# Commands run by a setup stage are logged to that stage's log file. The path
+# is per thread since stages run concurrently.
+stageLog = threading.local()
+
+# Drive the workspace is mapped to, set from config['Drive']
+mappedDrive = 'X:'
 
 def error(message, exitCode = 1):
     print(message)
-    run_command('subst X: /D')
+    # Stages and iteration workers report failures by exiting their thread;
+    # only the main thread owns the drive mapping.
+    if threading.current_thread().name == 'MainThread':
+        run_command('subst {} /D'.format(mappedDrive))
     sys.exit(exitCode)
 
-def run_command(cmd, outputFilePath = None, append = True):
-    expandedCmd = os.path.expandvars(cmd)
-    print('running command \'{}\' in directory \'{}\''.format(expandedCmd, os.getcwd()))
+class IterationFailed(Exception):
+    # A benchmark launch that failed in a way a retry may get past: it timed
+    # out, exited with an error or did not report every metric
+    pass
+
+# Size of the reads that drain a child's output, and of the log file buffer
+readSize = 64 * 1024
+logBufferSize = 1024 * 1024
+
+class ConsoleWriter:
+    # Copies child output to the console from its own thread through a
+    # bounded queue, so a slow console never stops us draining a child's pipe
+    # and never slows down the process being timed. When the queue is full
+    # the output is dropped from the console only; the log file gets all of
+    # it. One writer is shared by every command so their output stays whole.
+    def __init__(self, maxChunks = 256):
+        self.queue = queue.Queue(maxChunks)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.dropped = 0
+
+    def write(self, data):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target = self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            try:
+                self.queue.put_nowait(data)
+            except queue.Full:
+                self.dropped += len(data)
+
+    def run(self):
+        # The output is bytes, which go to the binary buffer under Python 3's
+        # text console. Whatever was printed before goes out first.
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+        while True:
+            data = self.queue.get()
+            with self.lock:
+                dropped = self.dropped
+                self.dropped = 0
+            sys.stdout.flush()
+            if dropped != 0:
+                out.write('\n[{} bytes of output not shown, see the log file]\n'.format(dropped).encode('ascii'))
+            out.write(data)
+            out.flush()
+            self.queue.task_done()
+
+    def flush(self):
+        # Waits until everything queued so far is on the console
+        self.queue.join()
+
+console = ConsoleWriter()
+
+class Watchdog:
+    # Kills proc and everything it started if it is still running after
+    # timeout seconds. Does nothing without a timeout.
+    def __init__(self, proc, job, timeout):
+        self.fired = False
+        self.timer = None
+        if timeout:
+            self.timer = threading.Timer(timeout, self.kill, (proc, job))
+            self.timer.daemon = True
+            self.timer.start()
+
+    def kill(self, proc, job):
+        if proc.returncode is not None:
+            return
+        self.fired = True
+        kill_tree(proc, job)
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer.join()
+
+def drain_output(pipe, outputFile, lineHandler, launchTimes = None):
+    # Reads the child's output in large chunks as soon as it is written and
+    # passes it on to the log file, the console and lineHandler, which still
+    # gets one line at a time, decoded.
+    fd = pipe.fileno()
+    partial = b''
+    while True:
+        data = os.read(fd, readSize)
+        if not data:
+            break
+        if launchTimes is not None and 'firstOutput' not in launchTimes:
+            launchTimes['firstOutput'] = monotonic()
+        outputFile.write(data)
+        console.write(data)
+        if lineHandler is not None:
+            lines = (partial + data).split(b'\n')
+            partial = lines.pop()
+            for line in lines:
+                lineHandler((line + b'\n').decode('utf-8', 'replace'))
+    if partial and lineHandler is not None:
+        lineHandler(partial.decode('utf-8', 'replace'))
+    pipe.close()
+
+def run_command(cmd, outputFilePath = None, append = True, lineHandler = None, cwd = None, env = None, usageHandler = None, startHandler = None, checkReturnCode = True, timeout = None, launchTimes = None, raiseOnFailure = False):
+    # With a timeout (seconds) the command and every process it starts are
+    # killed once it has run that long, and the command fails. Failures
+    # raise IterationFailed with raiseOnFailure instead of ending the run.
+    # cmd is either a command line for the shell or an argv list, which is
+    # executed directly with no shell and no variable expansion. With a
+    # launchTimes dict the monotonic times the process was spawned, first
+    # wrote output and exited are recorded in it.
+    if isinstance(cmd, list):
+        expandedCmd = cmd
+        shell = False
+        print('running command \'{}\' in directory \'{}\''.format(command_line(cmd), cwd or os.getcwd()))
+    else:
+        expandedCmd = os.path.expandvars(cmd)
+        shell = True
+        print('running command \'{}\' in directory \'{}\''.format(expandedCmd, cwd or os.getcwd()))
+    if launchTimes is None:
+        launchTimes = {}
+    if outputFilePath is None:
+        outputFilePath = getattr(stageLog, 'path', None)
+    # The process tree can only be killed as a whole if it has its own group
+    popenArgs = process_group_args() if timeout else {}
     if outputFilePath is None:
-        returnCode = os.system(expandedCmd)
+        launchTimes['spawn'] = monotonic()
+        outProc = subprocess.Popen(expandedCmd, shell = shell, cwd = cwd, env = env, **popenArgs)
+        launchTimes['spawned'] = monotonic()
+        job = start_accounting(outProc)
+        watchdog = Watchdog(outProc, job, timeout)
+        returnCode, usage = wait_with_usage(outProc, job)
+        launchTimes['exit'] = monotonic()
     else:
         # Write to file and Console
         if append:
-            outputFile = open(outputFilePath, 'a')
+            outputFile = open(outputFilePath, 'ab', logBufferSize)
         else:
-            outputFile = open(outputFilePath, 'w')
-        outProc = subprocess.Popen(expandedCmd, shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
-        for line in outProc.stdout:
-            sys.stdout.write(line)
-            outputFile.write(line)
-        outProc.wait()
-        returnCode = outProc.returncode
-    
-    if returnCode != 0:
-        error('Command failed with non-zero return code {}'.format(returnCode))
+            outputFile = open(outputFilePath, 'wb', logBufferSize)
+        launchTimes['spawn'] = monotonic()
+        outProc = subprocess.Popen(expandedCmd, shell = shell, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, cwd = cwd, env = env, **popenArgs)
+        launchTimes['spawned'] = monotonic()
+        job = start_accounting(outProc)
+        watchdog = Watchdog(outProc, job, timeout)
+        if startHandler is not None:
+            startHandler(outProc)
+        drain_output(outProc.stdout, outputFile, lineHandler, launchTimes)
+        returnCode, usage = wait_with_usage(outProc, job)
+        launchTimes['exit'] = monotonic()
+        outputFile.close()
+        console.flush()
+        if usageHandler is not None:
+            usageHandler(usage)
+    watchdog.cancel()
+
+    failure = None
+    if watchdog.fired:
+        failure = 'Command timed out after {}s'.format(timeout)
+    elif returnCode != 0 and checkReturnCode:
+        failure = 'Command failed with non-zero return code {}'.format(returnCode)
+    if failure is not None:
+        if raiseOnFailure:
+            raise IterationFailed(failure)
+        error(failure)
     
     return returnCode
 
@@ -41,64 +220,430 @@ def create_csv_file(data, name, benchmarkTitle):
     for item in data:
         f.write('{},{}'.format(benchmarkTitle, item))
         f.write('\n')
+    f.close()
 
-def parse_num_from_string (str):
-    # Numbers in the output have a trailing 'ms' we need to strip.
-    # There are also a lot of non-number outputs.
-    for s in str.split():
-        if s[0].isdigit():
-            numString = s[:-2]
-            if not numString.isdigit():
-                error('expected number, found non-numeric string')
+# Maps the line prefixes MusicStore prints to the metric they report, in the
+# order they appear within a single iteration.
+metricPrefixes = [
+    ('Server started in', 'startup'),
+    ('Request took', 'request'),
+    ('Steadystate min response time', 'minSteadyState'),
+    ('Steadystate max response time', 'maxSteadyState'),
+    ('Steadystate average response time', 'avgSteadyState')
+]
 
-            return numString
-    
-    return -1
+# Recognizes every line of MusicStore output we care about in one match.
+# Times are read in ms whatever unit MusicStore prints them in.
+musicStoreParser = LogParser(
+    [(metric, re.escape(prefix) + r'\D*' + numberPattern, 'ms') for prefix, metric in metricPrefixes] +
+    [('loadedFromBin', re.escape('ASP.NET loaded from bin. This is a bug if you wanted crossgen'), None)])
 
-def parse_output (inFileName, iters, suffix):
-    startups = []
-    requests = []
-    minSteadyState = []
-    maxSteadyState = []
-    avgSteadyState = []
-
-    for line in open(inFileName, 'r'):
-        if line.startswith('Server started in'):
-            startupTime = parse_num_from_string(line)
-            startups.append(startupTime)
-        elif line.startswith('Request took'):
-            requestTime = parse_num_from_string(line)
-            requests.append(requestTime)
-        elif line.startswith('Steadystate min response time'):
-            minTime = parse_num_from_string(line)
-            minSteadyState.append(minTime)
-        elif line.startswith('Steadystate max response time'):
-            maxTime = parse_num_from_string(line)
-            maxSteadyState.append(maxTime)
-        elif line.startswith('Steadystate average response time'):
-            avgTime = parse_num_from_string(line)
-            avgSteadyState.append(avgTime)
-        elif line.startswith('ASP.NET loaded from bin. This is a bug if you wanted crossgen'):
+# Metrics checked for a warm-up phase. Startup and the first request are the
+# ones that pay for a cold disk cache and JIT/crossgen state.
+warmupMetrics = ['startup', 'request']
+
+# Per iteration memory metrics derived from the sampled timeline
+memoryMetrics = ['startupRSSKB', 'startupPrivateKB', 'steadyStateRSSKB', 'steadyStatePrivateKB', 'peakThreads', 'peakHandles']
+
+# Per iteration times the harness measured itself, in ms from just before the
+# process was spawned: until Popen returned, until the first byte of output,
+# until the 'Server started in' line arrived and until the process exited.
+# untimedMs is the part of serverStartedMs that MusicStore's own startup time
+# does not cover, which is process creation, the host and the runtime
+# starting up before MusicStore's clock does.
+launchMetrics = ['spawnMs', 'firstOutputMs', 'serverStartedMs', 'exitMs', 'untimedMs']
+
+class IterationParser:
+    # Consumes MusicStore output one line at a time as it is tee'd by
+    # run_command and builds one record per iteration, so a bad iteration is
+    # reported as soon as its process exits rather than after the whole run.
+    # With a sampleInterval (seconds) it also samples the memory of each
+    # iteration's process tree. Iterations of a parser with a label are
+    # reported to the live telemetry under that configuration label.
+    def __init__(self, sampleInterval = None, label = None):
+        self.records = []
+        self.current = {}
+        self.sampleInterval = sampleInterval
+        self.sampler = None
+        self.label = label
+        self.checkpoint = None
+
+    def start_process(self, proc):
+        if self.sampleInterval:
+            self.sampler = MemorySampler(proc.pid, self.sampleInterval)
+            self.sampler.start()
+
+    def feed(self, line):
+        result = musicStoreParser.parse_line(line)
+        if result is None:
+            return
+
+        metric, value = result
+        if metric == 'loadedFromBin':
             error(line)
-    
-    if len(startups) == 0:
+        if metric in self.current:
+            error('iteration {} reported {} twice'.format(len(self.records) + 1, metric))
+        self.current[metric] = value
+        self.current.setdefault('markers', {})[metric] = time.time()
+        self.current.setdefault('monotonicMarkers', {})[metric] = monotonic()
+
+    def discard_iteration(self):
+        # Drops what a failed launch reported
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
+        self.current = {}
+
+    def record_usage(self, usage):
+        self.current['usage'] = usage
+        if self.sampler is not None:
+            self.current['memory'] = self.sampler.stop()
+            self.sampler = None
+
+    def end_iteration(self, launchTimes = None):
+        for prefix, metric in metricPrefixes:
+            if metric not in self.current:
+                raise IterationFailed('iteration {} is missing {}'.format(len(self.records) + 1, metric))
+
+        if 'memory' in self.current:
+            self.current['memoryMetrics'] = get_memory_metrics(self.current['memory'], self.current['markers'])
+        if launchTimes is not None:
+            self.current['launchMetrics'] = get_launch_metrics(launchTimes, self.current['monotonicMarkers']['startup'], self.current['startup'])
+        self.current.pop('monotonicMarkers', None)
+
+        self.current['timestamp'] = time.time()
+        self.records.append(self.current)
+        if self.checkpoint is not None:
+            self.checkpoint.append(self.current)
+        if self.label is not None:
+            report_iteration(self.label, self.current, launchTimes)
+        self.current = {}
+
+def get_memory_metrics(samples, markers):
+    # Memory right after 'Server started in' and at the end of the steady
+    # state requests, plus the peak thread and handle counts
+    metrics = dict((name, None) for name in memoryMetrics)
+    if not samples:
+        return metrics
+
+    rss = sampleFields.index('rssKB') + 1
+    private = sampleFields.index('privateKB') + 1
+    startup = sample_at(samples, markers['startup'], after = True)
+    steadyState = sample_at(samples, markers['avgSteadyState'], after = False)
+    metrics['startupRSSKB'] = startup[rss]
+    metrics['startupPrivateKB'] = startup[private]
+    metrics['steadyStateRSSKB'] = steadyState[rss]
+    metrics['steadyStatePrivateKB'] = steadyState[private]
+    metrics['peakThreads'] = max(s[sampleFields.index('threads') + 1] for s in samples)
+    metrics['peakHandles'] = max(s[sampleFields.index('handles') + 1] for s in samples)
+    return metrics
+
+# Live metrics of the run, None unless --telemetry-port or --telemetry-file
+# asked for them, and the startup times of each configuration so far.
+# Parallel workers report their iterations from their own threads, so the
+# startup times are only touched under telemetryStatsLock.
+telemetry = None
+telemetryStats = {}
+telemetryStatsLock = threading.Lock()
+
+def start_telemetry(config):
+    global telemetry
+    if config['TelemetryPort'] is None and config['TelemetryFile'] is None:
+        return
+    telemetry = Telemetry()
+    telemetry.describe('jitbench_iterations', 'counter', 'MusicStore iterations completed.')
+    telemetry.describe('jitbench_startup_last_ms', 'gauge', 'Startup time of the latest iteration in ms.')
+    telemetry.describe('jitbench_startup_median_ms', 'gauge', 'Median startup time so far in ms.')
+    telemetry.describe('jitbench_startup_p95_ms', 'gauge', '95th percentile startup time so far in ms.')
+    telemetry.describe('jitbench_startup_stddev_percent', 'gauge', 'Standard deviation of the startup times so far in percent of their median.')
+    telemetry.describe('jitbench_ci_width_percent', 'gauge', 'Widest confidence interval of the adaptive mode in percent of the mean.')
+    telemetry.describe('jitbench_ci_width_target_percent', 'gauge', 'Confidence interval width the adaptive mode stops at.')
+    telemetry.describe('jitbench_iteration_duration_seconds', 'histogram', 'Wall time of each iteration from spawn to exit.')
+    if config['TelemetryPort'] is not None:
+        port = telemetry.start_http(config['TelemetryPort'])
+        print('serving live metrics on http://127.0.0.1:{}/metrics'.format(port))
+    if config['TelemetryFile'] is not None:
+        telemetry.start_textfile(config['TelemetryFile'], config['TelemetryInterval'])
+
+def stop_telemetry():
+    if telemetry is not None:
+        telemetry.stop()
+
+def telemetry_labels(label):
+    return {'config': label or 'default'}
+
+def report_iteration(label, record, launchTimes):
+    if telemetry is None:
+        return
+    labels = telemetry_labels(label)
+    with telemetryStatsLock:
+        stats = telemetryStats.setdefault(label, RollingStats())
+        stats.push(record['startup'])
+        median, p95, stdDevPercent = stats.median(), stats.percentile(95), stats.percent_of_median()
+    telemetry.inc('jitbench_iterations', labels)
+    telemetry.set('jitbench_startup_last_ms', labels, record['startup'])
+    telemetry.set('jitbench_startup_median_ms', labels, median)
+    telemetry.set('jitbench_startup_p95_ms', labels, p95)
+    telemetry.set('jitbench_startup_stddev_percent', labels, stdDevPercent)
+    if launchTimes is not None and 'exit' in launchTimes:
+        telemetry.observe('jitbench_iteration_duration_seconds', labels, launchTimes['exit'] - launchTimes['spawn'])
+
+def get_launch_metrics(launchTimes, serverStarted, startup):
+    spawn = launchTimes['spawn']
+    metrics = {
+        'spawnMs': (launchTimes['spawned'] - spawn) * 1000.0,
+        'firstOutputMs': (launchTimes['firstOutput'] - spawn) * 1000.0 if 'firstOutput' in launchTimes else None,
+        'serverStartedMs': (serverStarted - spawn) * 1000.0,
+        'exitMs': (launchTimes['exit'] - spawn) * 1000.0
+    }
+    metrics['untimedMs'] = metrics['serverStartedMs'] - startup
+    return metrics
+
+def parse_output (inFileName, iters, suffix):
+    # Re-parses a saved output file. Iterations are delimited by the
+    # 'Server started in' line since the file has no process boundaries.
+    parser = IterationParser()
+    inFile = open(inFileName, 'r')
+    try:
+        for line in inFile:
+            if line.startswith('Server started in') and parser.current:
+                parser.end_iteration()
+            parser.feed(line)
+        if parser.current:
+            parser.end_iteration()
+    except IterationFailed as e:
+        error(str(e))
+    finally:
+        inFile.close()
+
+    write_results(parser.records, iters, suffix)
+
+# The BenchView test each metric is published as, before the cell's suffix
+benchviewTitles = [
+    ('startup', 'JitBenchStartupTime'),
+    ('request', 'JitBenchRequestTime'),
+    ('minSteadyState', 'JitBenchRequestMinimumSteadyStateTime'),
+    ('maxSteadyState', 'JitBenchRequestMaximumSteadyStateTime'),
+    ('avgSteadyState', 'JitBenchRequestAverageSteadyStateTime')
+]
+
+def write_results (records, iters, suffix, measurement = None):
+    # With a measurement the timings are also added to it the way
+    # 'measurement.py csv -m Duration -u ms --better desc' adds the text files.
+    # The iteration --drop-first-value used to leave out is already gone:
+    # discard_warmup drops it, or the warm-up iterations it detected.
+    if len(records) == 0:
         error('No data detected, startups count = 0')
-    if len(startups) != iters:
-        error('startups count = {}, expected {}'.format(len(startups), iters))
-    if len(requests) != len(startups):
-        error('requests count = {}, expected {}'.format(len(requests), len(startups)))
-    if len(minSteadyState) != len(startups):
-        error('minSteadyState count = {}, expected {}'.format(len(minSteadyState), len(startups)))
-    if len(maxSteadyState) != len(startups):
-        error('maxSteadyState count = {}, expected {}'.format(len(maxSteadyState), len(startups)))
-    if len(avgSteadyState) != len(startups):
-        error('avgSteadyState count = {}, expected {}'.format(len(avgSteadyState), len(startups))) 
-
-    create_csv_file(startups, 'startup' + suffix + '.txt', 'JitBenchStartupTime' + suffix)
-    create_csv_file(requests, 'request' + suffix + '.txt', 'JitBenchRequestTime' + suffix)
-    create_csv_file(minSteadyState, 'minSteadyState' + suffix + '.txt', 'JitBenchRequestMinimumSteadyStateTime' + suffix)
-    create_csv_file(maxSteadyState, 'maxSteadyState' + suffix + '.txt', 'JitBenchRequestMaximumSteadyStateTime' + suffix)
-    create_csv_file(avgSteadyState, 'avgSteadyState' + suffix + '.txt', 'JitBenchRequestAverageSteadyStateTime' + suffix)
+    if len(records) != iters:
+        error('startups count = {}, expected {}'.format(len(records), iters))
+
+    for metric, title in benchviewTitles:
+        values = [r[metric] for r in records]
+        create_csv_file(values, metric + suffix + '.txt', title + suffix)
+        if measurement is not None:
+            measurement.add([title + suffix], 'Duration', 'ms', 'desc', values)
+
+    if 'machine' in records[0]:
+        create_shard_file(records, 'shards' + suffix + '.csv')
+    elif 'worker' in records[0]:
+        create_iteration_file(records, 'iterations' + suffix + '.csv')
+    if 'usage' in records[0]:
+        create_usage_file(records, 'resources' + suffix + '.csv')
+    if 'memory' in records[0]:
+        create_memory_file(records, 'memory' + suffix + '.csv')
+    if 'launchMetrics' in records[0]:
+        create_launch_file(records, 'launch' + suffix + '.csv')
+    if any('trace' in r for r in records):
+        create_profile_file(records, 'profile' + suffix + '.csv')
+
+def create_memory_file(records, name):
+    # One row per memory sample, plus one row per output marker so the
+    # timeline can be lined up with 'Server started in' and the requests.
+    # Offsets are in ms from the iteration's first sample.
+    if os.path.isfile(name):
+        os.remove(name)
+
+    f = open(name, 'w')
+    f.write('iteration,offsetMs,event,' + ','.join(sampleFields) + '\n')
+    for index, r in enumerate(records):
+        iteration = r.get('iteration', index)
+        if not r['memory']:
+            continue
+        start = r['memory'][0][0]
+        rows = [(s[0], 'sample', s[1:]) for s in r['memory']]
+        rows += [(t, metric, [None] * len(sampleFields)) for metric, t in r['markers'].items()]
+        for t, event, values in sorted(rows, key = lambda row: row[0]):
+            f.write('{},{},{},{}\n'.format(iteration, int((t - start) * 1000), event, ','.join('' if v is None else str(v) for v in values)))
+    f.close()
+
+def create_launch_file(records, name):
+    # The harness side times of every iteration next to the startup time
+    # MusicStore reported, so the two can be checked against each other
+    if os.path.isfile(name):
+        os.remove(name)
+
+    f = open(name, 'w')
+    f.write('iteration,startup,' + ','.join(launchMetrics) + '\n')
+    for index, r in enumerate(records):
+        values = ['' if r['launchMetrics'][m] is None else '{:.3f}'.format(r['launchMetrics'][m]) for m in launchMetrics]
+        f.write('{},{},{}\n'.format(r.get('iteration', index), r['startup'], ','.join(values)))
+    f.close()
+
+def create_usage_file(records, name):
+    # CPU time, peak memory, page faults and context switches of every
+    # iteration, in the same order as the timing files
+    if os.path.isfile(name):
+        os.remove(name)
+
+    f = open(name, 'w')
+    f.write('iteration,' + ','.join(usageMetrics) + '\n')
+    for index, r in enumerate(records):
+        values = ['' if r['usage'][m] is None else str(r['usage'][m]) for m in usageMetrics]
+        f.write('{},{}\n'.format(r.get('iteration', index), ','.join(values)))
+    f.close()
+
+def store_results(config, records, configName):
+    # Appends every metric of every iteration to the local result store,
+    # under the machine that measured it. Iterations run by sharding agents
+    # carry their agent's host, everything else was measured here. Timings
+    # normalized across machines are stored as that machine measured them,
+    # so each machine's history only holds its own numbers.
+    if not config['ResultStore']:
+        return
+
+    rows = []
+    for index, record in enumerate(records):
+        first = len(rows)
+        measured = record.get('raw', {})
+        for prefix, metric in metricPrefixes:
+            rows.append({
+                'run': config['RunId'],
+                'benchmark': 'JitBench',
+                'metric': metric,
+                'config': configName,
+                'commit_id': config['CoreCLRCommit'],
+                'timestamp': record['timestamp'],
+                'iteration': record.get('iteration', index),
+                'value': measured.get(metric, record[metric])
+            })
+        for key, metrics in [('memoryMetrics', memoryMetrics), ('launchMetrics', launchMetrics)]:
+            for metric in metrics:
+                if key in record and record[key][metric] is not None:
+                    rows.append({
+                        'run': config['RunId'],
+                        'benchmark': 'JitBench',
+                        'metric': metric,
+                        'config': configName,
+                        'commit_id': config['CoreCLRCommit'],
+                        'timestamp': record['timestamp'],
+                        'iteration': record.get('iteration', index),
+                        'value': record[key][metric]
+                    })
+        for metric in usageMetrics:
+            if 'usage' in record and record['usage'][metric] is not None:
+                rows.append({
+                    'run': config['RunId'],
+                    'benchmark': 'JitBench',
+                    'metric': metric,
+                    'config': configName,
+                    'commit_id': config['CoreCLRCommit'],
+                    'timestamp': record['timestamp'],
+                    'iteration': record.get('iteration', index),
+                    'value': record['usage'][metric]
+                })
+        if 'host' in record:
+            for row in rows[first:]:
+                row['machine'] = record['host']
+
+    store = ResultStore(config['ResultStorePath'])
+    store.append(rows)
+    store.close()
+    print('stored {} results for run {} in {}'.format(len(rows), config['RunId'], config['ResultStorePath']))
+
+def report_regressions(config):
+    # Compares this run with the previous runs on this machine in the result
+    # store and writes a ranked report to regressions.txt
+    if not config['ResultStore'] or not config['RegressionReport']:
+        return
+
+    store = ResultStore(config['ResultStorePath'])
+    findings = compare_run(store, config['RunId'], config['BaselineRuns'])
+    store.close()
+    regressions = write_report(findings, 'regressions.txt')
+    if regressions != 0 and config['FailOnRegression']:
+        error('{} regressions detected against the previous {} runs'.format(regressions, config['BaselineRuns']))
+
+# The machine noise check is a short stabilization run of the portable native
+# stability runner, the same blackscholes check the nightly stability job does
+stabilityScript = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stability', 'stability', 'native-stability-test.py')
+
+# Number of successive blackscholes iterations whose spread is checked
+preflightWindow = 5
+
+def run_preflight(config, phase):
+    # Runs the stability runner in stabilization mode for at most
+    # PreflightIterations iterations and returns the noise it measured.
+    # The runner's download cache keeps blackscholes in the workspace, so
+    # it is only downloaded and unpacked the first time.
+    preflightDir = os.path.abspath('preflight')
+    if not os.path.isdir(preflightDir):
+        os.makedirs(preflightDir)
+
+    command = '"{}" "{}" --stabilization --stabilization-iterations {} --iterations {} --std-dev {} --target-dir "{}" --no-result-store'.format(
+        sys.executable, stabilityScript, preflightWindow, config['PreflightIterations'], config['PreflightStdDev'], preflightDir)
+
+    # blackscholes is unpacked into the preflight directory and run from it
+    env = dict(os.environ)
+    env['PATH'] = preflightDir + os.pathsep + env.get('PATH', '')
+
+    noise = {}
+    def parse_line(line):
+        m = re.search(r'Standard deviation was (\d+\.\d+)% of median (\d+\.\d+)', line)
+        if m:
+            noise['percentOfMedian'] = float(m.group(1))
+            noise['median'] = float(m.group(2))
+
+    outputFilePath = os.path.join(preflightDir, 'preflight_{}.txt'.format(phase))
+    returnCode = run_command(command, outputFilePath, append = False, lineHandler = parse_line, cwd = preflightDir, env = env, checkReturnCode = False)
+    if 'percentOfMedian' not in noise:
+        error('machine noise check {} the measurements did not report a standard deviation, see {}'.format(phase, outputFilePath))
+
+    noise['stable'] = returnCode == 0
+    noise['target'] = config['PreflightStdDev']
+    return noise
+
+def check_machine_noise(config, phase):
+    # Records how noisy the machine was before or after the measurements in
+    # preflight.json and the result store. A noisy machine is either flagged
+    # or, with --preflight refuse, fails the run.
+    if config['Preflight'] == 'off':
+        return
+
+    noise = run_preflight(config, phase)
+    config['PreflightResults'][phase] = noise
+    write_json_file('preflight.json', config['PreflightResults'])
+
+    if config['ResultStore']:
+        store = ResultStore(config['ResultStorePath'])
+        store.append([{
+            'run': config['RunId'],
+            'benchmark': 'Preflight',
+            'metric': 'noisePercent',
+            'config': phase,
+            'commit_id': config['CoreCLRCommit'],
+            'iteration': 0,
+            'value': noise['percentOfMedian']
+        }])
+        store.close()
+
+    if noise['stable']:
+        print('machine noise {} the measurements was {:.2f}%'.format(phase, noise['percentOfMedian']))
+        return
+
+    message = 'machine is too noisy {} the measurements: {:.2f}% of median, target {:.2f}%'.format(phase, noise['percentOfMedian'], noise['target'])
+    if config['Preflight'] == 'refuse':
+        error(message)
+    print('WARNING: ' + message)
 
 def copy_file(curName, newName):
     print('copying {} to {}'.format(curName, newName))
@@ -107,96 +652,466 @@ def copy_file(curName, newName):
     
     shutil.copyfile(curName, newName)
 
+# Written into each patched shared runtime directory. Records, for every file
+# we placed there, the hash of its content and the size/mtime of both the
+# CoreCLR source file and the patched copy, so the next run only touches files
+# that actually changed.
+patchManifestName = '.coreclr_patch_manifest.json'
+
+# FICLONE ioctl from linux/fs.h
+FICLONE = 0x40049409
+
+def hash_file(path):
+    sha = hashlib.sha256()
+    f = open(path, 'rb')
+    try:
+        chunk = f.read(1024 * 1024)
+        while chunk:
+            sha.update(chunk)
+            chunk = f.read(1024 * 1024)
+    finally:
+        f.close()
+    return sha.hexdigest()
+
+def file_stat(path):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+def load_json_file(path):
+    if not os.path.isfile(path):
+        return {}
+    try:
+        f = open(path, 'r')
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except ValueError:
+        print('ignoring unreadable file {}'.format(path))
+        return {}
+
+def write_json_file(path, data):
+    # Write to a temp file first so an interrupted run never leaves a
+    # truncated file behind.
+    tempPath = path + '.tmp'
+    f = open(tempPath, 'w')
+    json.dump(data, f, indent = 2, sort_keys = True)
+    f.close()
+    if os.path.isfile(path):
+        os.remove(path)
+    os.rename(tempPath, path)
+
+def reflink_file(curName, newName):
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+    src = open(curName, 'rb')
+    dst = open(newName, 'wb')
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except (IOError, OSError):
+        return False
+    finally:
+        src.close()
+        dst.close()
+
+def link_or_copy_file(curName, newName, hardlink = True):
+    # Prefer a copy-on-write clone, then a hardlink, and only fall back to a
+    # byte copy when the filesystem supports neither.
+    if os.path.isfile(newName):
+        os.remove(newName)
+
+    if reflink_file(curName, newName):
+        return 'reflinked'
+    if os.path.isfile(newName):
+        os.remove(newName)
+
+    if hardlink and hasattr(os, 'link'):
+        try:
+            os.link(curName, newName)
+            return 'linked'
+        except OSError:
+            pass
+
+    shutil.copyfile(curName, newName)
+    return 'copied'
+
 def patch_coreclr_files(coreClrBinPath, sharedRuntime):
-    for item in os.listdir(coreClrBinPath):
+    manifestPath = os.path.join(sharedRuntime, patchManifestName)
+    manifest = load_json_file(manifestPath)
+    newManifest = {}
+    unchanged = 0
+
+    for item in sorted(os.listdir(coreClrBinPath)):
         fullPath = os.path.join(coreClrBinPath, item)
-        if os.path.isfile(fullPath):
-            copy_file(fullPath, os.path.join(sharedRuntime, item))
+        if not os.path.isfile(fullPath):
+            continue
 
-def prepare_coreclr(config):
-    startDir = os.getcwd()
+        targetPath = os.path.join(sharedRuntime, item)
+        sourceStat = file_stat(fullPath)
+        entry = manifest.get(item)
+
+        # Only hash the source when its size or mtime moved since last time
+        if entry is not None and entry['source'] == sourceStat:
+            sourceHash = entry['hash']
+        else:
+            sourceHash = hash_file(fullPath)
+
+        if entry is not None and entry['hash'] == sourceHash and os.path.isfile(targetPath) and file_stat(targetPath) == entry['target']:
+            entry['source'] = sourceStat
+            newManifest[item] = entry
+            unchanged += 1
+            continue
+
+        action = link_or_copy_file(fullPath, targetPath)
+        print('{} {} to {}'.format(action, fullPath, targetPath))
+        newManifest[item] = {'hash': sourceHash, 'source': sourceStat, 'target': file_stat(targetPath)}
+
+    write_json_file(manifestPath, newManifest)
+    print('{} of {} files in {} were already up to date'.format(unchanged, len(newManifest), sharedRuntime))
+
+# Environment variables exported by the crossgen store scripts
+crossgenEnvironment = ['JITBENCH_ASPNET_VERSION', 'JITBENCH_FRAMEWORK_VERSION', 'JITBENCH_ASPNET_MANIFEST', 'DOTNET_SHARED_STORE']
+
+def get_git_commit(repoDir):
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = repoDir).decode('ascii').strip()
+
+def try_get_git_commit(repoDir):
+    # For directories that may not be in a git repo, e.g. a user supplied
+    # coreclr bin path
+    try:
+        return get_git_commit(repoDir)
+    except (subprocess.CalledProcessError, OSError):
+        return ''
+
+def hash_tree(path):
+    # Hash of the relative path and content of every file under path
+    sha = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            fullPath = os.path.join(root, name)
+            relPath = os.path.relpath(fullPath, path).replace(os.sep, '/')
+            if relPath == patchManifestName:
+                continue
+            sha.update(relPath.encode('utf-8'))
+            sha.update(hash_file(fullPath).encode('ascii'))
+    return sha.hexdigest()
 
-    coreClrDir = 'coreclr'
+def tree_signature(path):
+    # Cheap fingerprint of a directory used to tell whether it was modified
+    # since we last restored or cached it.
+    count = 0
+    size = 0
+    mtime = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            st = os.stat(os.path.join(root, name))
+            count += 1
+            size += st.st_size
+            mtime = max(mtime, st.st_mtime)
+    return {'files': count, 'size': size, 'mtime': mtime}
+
+def clone_tree(sourceDir, targetDir):
+    # Cache entries must not share inodes with the live outputs, otherwise a
+    # build that rewrites a file in place would silently change the entry, so
+    # this never hardlinks.
+    if os.path.isdir(targetDir):
+        shutil.rmtree(targetDir)
+    for root, dirs, files in os.walk(sourceDir):
+        relDir = os.path.relpath(root, sourceDir)
+        newDir = os.path.normpath(os.path.join(targetDir, relDir))
+        if not os.path.isdir(newDir):
+            os.makedirs(newDir)
+        for name in files:
+            link_or_copy_file(os.path.join(root, name), os.path.join(newDir, name), hardlink = False)
+
+def run_cached_stage(config, stageName, inputs, outputDirs, environmentNames, action):
+    # Runs action unless a previous run already produced outputDirs from the
+    # same inputs. Cache entries live under StageCacheDir/<stage>/<key>, where
+    # key is the hash of inputs, and hold a copy of every output directory plus
+    # the environment variables the stage exported. stage.json is written last
+    # and marks the entry as complete. StageCacheDir/<stage>/current.json
+    # remembers which key the live output directories hold, so a hit on
+    # untouched outputs does not copy anything.
+    if not config['StageCache']:
+        action()
+        return
+
+    inputsText = json.dumps(inputs, sort_keys = True)
+    key = hashlib.sha256(inputsText.encode('utf-8')).hexdigest()
+    stageDir = os.path.join(config['StageCacheDir'], stageName)
+    entryDir = os.path.join(stageDir, key)
+    entryFile = os.path.join(entryDir, 'stage.json')
+    currentFile = os.path.join(stageDir, 'current.json')
+
+    entry = load_json_file(entryFile)
+    if entry:
+        current = load_json_file(currentFile)
+        for i, outputDir in enumerate(outputDirs):
+            live = current.get(outputDir)
+            if live is not None and live['key'] == key and os.path.isdir(outputDir) and tree_signature(outputDir) == live['signature']:
+                print('stage {} is cached as {}, {} is up to date'.format(stageName, key, outputDir))
+                continue
+            print('stage {} is cached as {}, restoring {}'.format(stageName, key, outputDir))
+            clone_tree(os.path.join(entryDir, 'output{}'.format(i)), outputDir)
+            current[outputDir] = {'key': key, 'signature': tree_signature(outputDir)}
+        write_json_file(currentFile, current)
+        for name, value in entry['environment'].items():
+            os.environ[name] = value
+        return
+
+    print('stage {} is not cached for inputs {}'.format(stageName, inputsText))
+    action()
+
+    if os.path.isdir(entryDir):
+        shutil.rmtree(entryDir)
+    current = load_json_file(currentFile)
+    for i, outputDir in enumerate(outputDirs):
+        clone_tree(outputDir, os.path.join(entryDir, 'output{}'.format(i)))
+        current[outputDir] = {'key': key, 'signature': tree_signature(outputDir)}
+    environment = {}
+    for name in environmentNames:
+        if name in os.environ:
+            environment[name] = os.environ[name]
+    write_json_file(entryFile, {'inputs': inputs, 'environment': environment})
+    write_json_file(currentFile, current)
+
+class StageGraph:
+    # Setup stages declared with the stages they depend on. run() starts every
+    # stage whose dependencies have finished, so independent stages overlap,
+    # and logs each stage's commands to <logDir>/<stage>.log.
+    def __init__(self, logDir):
+        self.logDir = logDir
+        self.stages = {}
+        self.order = []
+        self.timings = {}
+
+    def add(self, name, dependencies, action):
+        for dependency in dependencies:
+            if dependency not in self.stages:
+                error('stage {} depends on unknown stage {}'.format(name, dependency))
+        self.stages[name] = (dependencies, action)
+        self.order.append(name)
+
+    def run(self):
+        if not os.path.isdir(self.logDir):
+            os.makedirs(self.logDir)
+
+        condition = threading.Condition()
+        done = set()
+        running = {}
+        failed = []
+        startTime = time.time()
+
+        def run_stage(name):
+            logPath = os.path.join(self.logDir, name + '.log')
+            if os.path.isfile(logPath):
+                os.remove(logPath)
+            stageLog.path = logPath
+            stageStart = time.time()
+            succeeded = False
+            try:
+                self.stages[name][1]()
+                succeeded = True
+            except SystemExit:
+                pass
+            except Exception:
+                traceback.print_exc()
+            stageLog.path = None
+
+            condition.acquire()
+            self.timings[name] = (stageStart - startTime, time.time() - startTime)
+            del running[name]
+            if succeeded:
+                done.add(name)
+            else:
+                failed.append(name)
+            condition.notify_all()
+            condition.release()
+
+        condition.acquire()
+        try:
+            while True:
+                # Once something failed, let running stages finish but start nothing new
+                if len(failed) == 0:
+                    for name in self.order:
+                        if name in done or name in running:
+                            continue
+                        if all(d in done for d in self.stages[name][0]):
+                            print('starting stage {}'.format(name))
+                            thread = threading.Thread(target = run_stage, args = (name,), name = name)
+                            running[name] = thread
+                            thread.start()
+                if len(running) == 0:
+                    break
+                condition.wait()
+        finally:
+            condition.release()
+
+        if len(failed) != 0:
+            error('stages {} failed, see logs in {}'.format(', '.join(failed), self.logDir))
+
+        self.report()
+
+    def critical_path(self):
+        # Walk back from the stage that finished last, each time following the
+        # dependency that finished last.
+        path = []
+        name = max(self.timings, key = lambda n: self.timings[n][1])
+        while name is not None:
+            path.append(name)
+            dependencies = self.stages[name][0]
+            name = max(dependencies, key = lambda n: self.timings[n][1]) if dependencies else None
+        path.reverse()
+        return path
+
+    def report(self):
+        # A critical stage's share is the time from the previous critical
+        # stage's end to its own end, which includes any scheduling delay.
+        criticalPath = self.critical_path()
+        criticalTime = {}
+        previousEnd = 0
+        for name in criticalPath:
+            criticalTime[name] = self.timings[name][1] - previousEnd
+            previousEnd = self.timings[name][1]
+
+        reportFile = open(os.path.join(self.logDir, 'stages.csv'), 'w')
+        reportFile.write('stage,start,duration,critical\n')
+        print('{:<20} {:>10} {:>10} {:>10}'.format('stage', 'start', 'duration', 'critical'))
+        for name in sorted(self.timings, key = lambda n: self.timings[n][0]):
+            start, end = self.timings[name]
+            critical = criticalTime.get(name, 0)
+            print('{:<20} {:>9.1f}s {:>9.1f}s {:>9.1f}s'.format(name, start, end - start, critical))
+            reportFile.write('{},{:.3f},{:.3f},{:.3f}\n'.format(name, start, end - start, critical))
+        reportFile.close()
+        print('critical path: {} ({:.1f}s)'.format(' -> '.join(criticalPath), previousEnd))
+
+def prepare_coreclr(config):
+    workspace = os.getcwd()
+    coreClrDir = os.path.join(workspace, 'coreclr')
     
     if os.path.isdir(coreClrDir):
-        os.chdir(coreClrDir)
-        run_command('git pull')
-        os.chdir(startDir)
+        run_command('git pull', cwd = coreClrDir)
     else:
-        run_command('git clone https://github.com/dotnet/coreclr')
-
-    os.chdir(coreClrDir)
+        run_command('git clone https://github.com/dotnet/coreclr', cwd = workspace)
 
     # TODO: ability to change architecture
     archStr = config['Arch']
     osStr = config['OS']
-    if osStr == 'Windows_NT':
-        run_command('cmd.exe /c build.cmd release {} skiptests'.format(archStr))
-    else:
-        run_command('./build.sh release {} skiptests'.format(archStr))
-
     productIdentifier = '{}.{}.Release'.format(osStr, archStr)
-    coreClrOutPath = os.path.join('bin', 'Product', productIdentifier)
+    coreClrOutPath = os.path.join(coreClrDir, 'bin', 'Product', productIdentifier)
+
+    def build():
+        if osStr == 'Windows_NT':
+            run_command('cmd.exe /c build.cmd release {} skiptests'.format(archStr), cwd = coreClrDir)
+        else:
+            run_command('./build.sh release {} skiptests'.format(archStr), cwd = coreClrDir)
+
+    inputs = {'commit': get_git_commit(coreClrDir), 'os': osStr, 'arch': archStr}
+    run_cached_stage(config, 'coreclr', inputs, [coreClrOutPath], [], build)
+    config['CoreCLRCommit'] = inputs['commit']
+
     if not os.path.isdir(coreClrOutPath):
         error('coreclr build output path {} does not exist'.format(coreClrOutPath))
 
-    os.chdir(startDir)
-
+    config['CoreCLRBinPath'] = coreClrOutPath
 
-def prepare_jitbench(config):
-    startDir = os.getcwd()
-    jitBenchDir = os.path.join(startDir, 'JitBench')
+def prepare_jitbench(graph, config, coreClrStages):
+    # Adds the stages that set up JitBench to graph. Patching the runtime has
+    # to wait for coreClrStages; cloning JitBench and installing dotnet do not.
+    workspace = os.getcwd()
+    jitBenchDir = os.path.join(workspace, 'JitBench')
+    musicStoreDir = os.path.join(jitBenchDir, 'src', 'MusicStore')
+    osStr = config['OS']
+    archStr = config['Arch']
+    stageInputs = {}
 
-    if os.path.isdir(jitBenchDir):
-        os.chdir(jitBenchDir)
-        run_command('git pull')
-        os.chdir(startDir)
-    else:
+    def source():
         branch = config['Branch']
-        run_command('git clone -b {} https://github.com/aspnet/JitBench'.format(branch))
+        if os.path.isdir(jitBenchDir):
+            # The matrix may run several branches in the same clone
+            run_command('git fetch origin', cwd = jitBenchDir)
+            run_command('git checkout {}'.format(branch), cwd = jitBenchDir)
+            run_command('git pull', cwd = jitBenchDir)
+        else:
+            run_command('git clone -b {} https://github.com/aspnet/JitBench'.format(branch), cwd = workspace)
 
-    if not os.path.isdir(jitBenchDir):
-        error('JitBench folder does not exist')
+        if not os.path.isdir(jitBenchDir):
+            error('JitBench folder does not exist')
 
-    os.chdir(jitBenchDir)
+    def install():
+        # Get the latest shared runtime and SDK
+        initialize_jitbench_folder(config, jitBenchDir)
 
-    # Get the latest shared runtime and SDK
-    # TODO: ability to change architecture
-    osStr, archStr = initialize_jitbench_folder(config)
-      
-    # Add new dotnet to path
-    os.environ['PATH'] = os.path.join(os.getcwd(), '.dotnet') + os.pathsep + os.environ['PATH']
-    
-    run_command('dotnet --info')
+        # Add new dotnet to path
+        use_dotnet(os.path.join(jitBenchDir, dotnet_dir_name(config)))
 
-    # Modify shared runtime with local built copy
-    if config['CLRSetup']:
-        patch_runtime(jitBenchDir, config)
+        run_command('dotnet --info', cwd = jitBenchDir)
 
-    install_crossgened_assemblies(osStr, archStr)
+    def crossgen():
+        # Everything from here on depends on the JitBench sources, the
+        # (patched) runtime and the SDK that was installed, so those make up
+        # the cache key.
+        dotnetDir = os.path.join(jitBenchDir, dotnet_dir_name(config))
+        stageInputs.update({
+            'commit': get_git_commit(jitBenchDir),
+            'runtime': hash_tree(os.path.join(dotnetDir, 'shared', 'Microsoft.NETCore.App')),
+            'sdk': sorted(os.listdir(os.path.join(dotnetDir, 'sdk'))),
+            'os': osStr,
+            'arch': archStr,
+            'branch': config['Branch']
+        })
 
-    os.chdir(os.path.join('src', 'MusicStore'))
+        if config['RunCrossgen']:
+            run_cached_stage(config, 'crossgen', stageInputs, [os.path.join(jitBenchDir, '.store')], crossgenEnvironment,
+                lambda: install_crossgened_assemblies(config, jitBenchDir))
+        else:
+            install_crossgened_assemblies(config, jitBenchDir)
 
-    # Restore the MusicStore project
-    run_command('dotnet restore')
+    def publish():
+        def restore_and_publish():
+            # Restore the MusicStore project
+            run_command('dotnet restore', cwd = musicStoreDir)
 
-    # publish the App
-    if osStr == 'Windows_NT':
-        run_command('dotnet publish -c Release -f netcoreapp2.1 --manifest %JITBENCH_ASPNET_MANIFEST%')
-    else:
-        run_command('dotnet publish -c Release -f netcoreapp2.1 --manifest $JITBENCH_ASPNET_MANIFEST')
+            # publish the App
+            if osStr == 'Windows_NT':
+                run_command('dotnet publish -c Release -f netcoreapp2.1 --manifest %JITBENCH_ASPNET_MANIFEST%', cwd = musicStoreDir)
+            else:
+                run_command('dotnet publish -c Release -f netcoreapp2.1 --manifest $JITBENCH_ASPNET_MANIFEST', cwd = musicStoreDir)
 
-    publishPath = os.path.join('bin', 'Release', 'netcoreapp2.1', 'publish')
-    
-    os.chdir(startDir)
+        publishPath = os.path.join(musicStoreDir, 'bin', 'Release', 'netcoreapp2.1', 'publish')
+
+        publishInputs = dict(stageInputs)
+        manifest = os.environ.get('JITBENCH_ASPNET_MANIFEST', '')
+        publishInputs['manifest'] = manifest
+        if os.path.isfile(manifest):
+            publishInputs['manifestHash'] = hash_file(manifest)
+        run_cached_stage(config, 'publish', publishInputs, [publishPath], [], restore_and_publish)
+
+    graph.add('jitbench_source', [], source)
+    graph.add('dotnet_install', ['jitbench_source'], install)
+
+    crossgenDependencies = ['dotnet_install']
+    # Modify shared runtime with local built copy
+    if config['CLRSetup']:
+        graph.add('patch_runtime', ['dotnet_install'] + coreClrStages, lambda: patch_runtime(jitBenchDir, config))
+        crossgenDependencies = ['patch_runtime']
+
+    graph.add('crossgen', crossgenDependencies, crossgen)
+    graph.add('publish', ['crossgen'], publish)
+
+def install_crossgened_assemblies(config, jitBenchDir):
+    osStr = config['OS']
+    archStr = config['Arch']
 
-def install_crossgened_assemblies(osStr, archStr):
     # Install crossgened assemblies
     # TODO: right now the runtime param is built in. Need to fix that.
     if osStr == 'Windows_NT':
-        outFileName = 'aspnetinstall.txt'        
+        outFileName = os.path.join(jitBenchDir, 'aspnetinstall.txt')
         if config['RunCrossgen']:
-            run_command('powershell .\AspNet-GenerateStore.ps1 -InstallDir .store -Architecture {} -Runtime win7-x64'.format(archStr), outFileName)
+            run_command('powershell .\\AspNet-GenerateStore.ps1 -InstallDir .store -Architecture {} -Runtime win7-x64'.format(archStr), outFileName, cwd = jitBenchDir)
 
         aspnetVersion = ''
         frameworkVersion = ''
@@ -205,7 +1120,8 @@ def install_crossgened_assemblies(osStr, archStr):
         # In the usual case these would be set by the script, but we need to 
         # set them manually since sub scripts don't impact our environment like
         # it would in powershell
-        for line in open(outFileName, 'r'):
+        outFile = open(outFileName, 'r')
+        for line in outFile:
             if line.startswith('Setting JITBENCH_ASPNET_VERSION to '):
                 aspnetVersion = line[35:].rstrip()
                 os.environ['JITBENCH_ASPNET_VERSION'] = aspnetVersion
@@ -218,6 +1134,7 @@ def install_crossgened_assemblies(osStr, archStr):
             elif line.startswith('Setting DOTNET_SHARED_STORE to '):
                 sharedStore = line[31:].rstrip()
                 os.environ['DOTNET_SHARED_STORE'] = sharedStore
+        outFile.close()
 
         if aspnetVersion is None or aspnetVersion.isspace():
             error('Missing asp.net version from script output')
@@ -235,25 +1152,44 @@ def install_crossgened_assemblies(osStr, archStr):
 
     else:
         if config['RunCrossgen']:
-            run_command('source ./aspnet-generatestore.sh -i .store --arch {} -r {}'.format(archStr, 'ubuntu.14.04-x64'))
+            run_command('source ./aspnet-generatestore.sh -i .store --arch {} -r {}'.format(archStr, 'ubuntu.14.04-x64'), cwd = jitBenchDir)
 
-def initialize_jitbench_folder(config):
-    # Get the latest shared runtime and SDK
-    # TODO: ability to change architecture
+def dotnet_dir_name(config):
+    # Each architecture gets its own dotnet install in the JitBench tree.
+    # dotnet-install skips versions that are already in its install dir, so
+    # a shared one would give an x86 build the x64 runtime.
+    return '.dotnet-{}'.format(config['Arch'])
+
+# The dotnet install the last build put on PATH
+dotnetOnPath = None
+
+def use_dotnet(dotnetDir):
+    # Puts dotnetDir first on PATH, in place of the install an earlier build
+    # of the matrix put there
+    global dotnetOnPath
+    entries = os.environ['PATH'].split(os.pathsep)
+    if dotnetOnPath in entries:
+        entries.remove(dotnetOnPath)
+    os.environ['PATH'] = os.pathsep.join([dotnetDir] + entries)
+    dotnetOnPath = dotnetDir
+
+def initialize_jitbench_folder(config, jitBenchDir):
+    # Get the latest shared runtime and SDK for config's Arch
     archStr = config['Arch']
     osStr = config['OS']
+    dotnetDirName = dotnet_dir_name(config)
 
     if osStr == 'Windows_NT':
-        run_command('powershell .\\Dotnet-Install.ps1 -SharedRuntime -InstallDir .dotnet -Channel master -Architecture {}'.format(archStr))
-        run_command('powershell .\\Dotnet-Install.ps1 -InstallDir .dotnet -Channel master -Architecture {}'.format(archStr))
+        run_command('powershell .\\Dotnet-Install.ps1 -SharedRuntime -InstallDir {} -Channel master -Architecture {}'.format(dotnetDirName, archStr), cwd = jitBenchDir)
+        run_command('powershell .\\Dotnet-Install.ps1 -InstallDir {} -Channel master -Architecture {}'.format(dotnetDirName, archStr), cwd = jitBenchDir)
     else:
-        run_command('./dotnet-install.sh -sharedruntime -installdir .dotnet -channel master -architecture {}'.format(archStr))
-        run_command('source ./dotnet-install.sh -installdir .dotnet -channel master -architecture {}'.format(archStr))
+        run_command('./dotnet-install.sh -sharedruntime -installdir {} -channel master -architecture {}'.format(dotnetDirName, archStr), cwd = jitBenchDir)
+        run_command('source ./dotnet-install.sh -installdir {} -channel master -architecture {}'.format(dotnetDirName, archStr), cwd = jitBenchDir)
     
     return osStr, archStr
 
 def patch_runtime(jitBenchDir, config):
-    sharedRuntimeDir = os.path.join(jitBenchDir, '.dotnet', 'shared', 'Microsoft.NETCore.App')
+    sharedRuntimeDir = os.path.join(jitBenchDir, dotnet_dir_name(config), 'shared', 'Microsoft.NETCore.App')
     patched = False
     for item in os.listdir(sharedRuntimeDir):
         targetRuntimeDir = os.path.join(sharedRuntimeDir, item)
@@ -267,42 +1203,876 @@ def patch_runtime(jitBenchDir, config):
         error('did not find a dotnet version to patch')
 
 
-def run_jitbench(config, tiered):
+def prepare_build(config, remappedDir, several):
+    # Sets up CoreCLR and JitBench for config's Arch and Branch. With several
+    # builds in the matrix each one logs to its own directory.
+    logDir = os.path.join(remappedDir, 'logs')
+    if several:
+        logDir = os.path.join(logDir, label_part('{}_{}'.format(config['Arch'], config['Branch'])))
+
+    graph = StageGraph(logDir)
+    coreClrStages = []
+    if config['CLRSetup']:
+        coreClrBinPath = config['CoreCLRBinPath'];
+        if not config['LocalRun']:
+            graph.add('coreclr', [], lambda: prepare_coreclr(config))
+            coreClrStages = ['coreclr']
+        elif not os.path.isdir(coreClrBinPath):
+            error('CoreCLR bin path {} does not exist'.format(coreClrBinPath))
+        else:
+            config['CoreCLRCommit'] = try_get_git_commit(coreClrBinPath)
+
+    prepare_jitbench(graph, config, coreClrStages)
+    graph.run()
+
+def run_jitbench(config, cell):
+    # Runs the measurements of one cell of the configuration matrix with the
+    # cell's knobs set in the environment. Output files get the cell's suffix.
+    # Returns None for a cell a resumed run had already finished, see
+    # finished_results.
     startDir = os.getcwd()
+    suffix = cell['suffix']
+    # Parallel workers interleave their iterations, so only the sequential
+    # and adaptive loops can pick up where an interrupted run left off
+    checkpoint = open_checkpoint(config, cell) if config['Parallel'] == 1 else None
+    if checkpoint is not None and checkpoint.finished is not None:
+        return None
+    resumed = checkpoint is not None and len(checkpoint.records) != 0
+    profiler = make_profiler(config, suffix)
 
     targetDir = os.path.join('JitBench', 'src', 'MusicStore', 'bin', 'Release', 'netcoreapp2.1', 'publish')
     os.chdir(targetDir)
 
-    targetCommand = 'dotnet MusicStore.dll' 
+    targetCommand = musicstore_command()
 
-    if tiered:
-        os.environ['COMPLUS_EXPERIMENTAL_TieredCompilation']='1'
-    else:
-        os.environ['COMPLUS_EXPERIMENTAL_TieredCompilation']='0'
+    # Knobs of one cell must not leak into the next
+    savedEnvironment = set_environment(cell['env'])
 
-    # Warmup the scenario
-    run_iteration(targetCommand, None)
+    # Warmup the scenario. With warm-up detection the measured iterations
+    # are checked for a warm-up phase instead of paying for an extra launch.
+    if not config['WarmupDetection']:
+        run_iteration(targetCommand, None, timeout = config['IterationTimeout'])
 
-    # Delete existing results if there are any
-    outputFilePath = 'output_tiered.txt' if tiered else 'output.txt'
-    if os.path.isfile(outputFilePath):
+    # Delete existing results if there are any, unless they are being added to
+    outputFilePath = 'output{}.txt'.format(suffix)
+    if os.path.isfile(outputFilePath) and not resumed:
         os.remove(outputFilePath)
 
     iterations = 100
-    for i in range(0, iterations):
-        run_iteration(targetCommand, outputFilePath)
+    if config['Adaptive']:
+        records, warmup = run_adaptive_iterations(config, targetCommand, outputFilePath, profiler, cell['label'], checkpoint)
+    elif config['Parallel'] > 1:
+        records, warmup = discard_warmup(config, run_parallel_iterations(config, targetCommand, outputFilePath, iterations, cell['label']))
+    else:
+        parser = IterationParser(config['MemorySampleInterval'], cell['label'])
+        parser.records = list(checkpoint.records)
+        parser.checkpoint = checkpoint
+        for i in range(len(parser.records), iterations):
+            run_iteration(targetCommand, outputFilePath, parser, timeout = config['IterationTimeout'], profiler = profiler)
+        checkpoint.finish()
+        records, warmup = discard_warmup(config, parser.records)
+    iterations = len(records)
+    if profiler is not None:
+        profiler.rerun_slowest(records, targetCommand)
 
     curName = os.path.join(os.getcwd(), outputFilePath)
     newName = os.path.join(startDir, outputFilePath)
     copy_file(curName, newName)
 
+    restore_environment(savedEnvironment)
+
+    os.chdir(startDir)
+    write_json_file('warmup{}.json'.format(suffix), warmup)
+    return records, iterations
+
+def set_environment(env):
+    # Sets env in os.environ and returns what to restore it to
+    savedEnvironment = dict((name, os.environ.get(name)) for name in env)
+    os.environ.update(env)
+    return savedEnvironment
+
+def restore_environment(savedEnvironment):
+    for name, value in savedEnvironment.items():
+        if value is None:
+            del os.environ[name]
+        else:
+            os.environ[name] = value
+
+def run_interleaved(config, cells, suffix):
+    # Measures all the cells of one build in a single session. Each block
+    # runs every cell once, in a fresh random order, so drift in the machine
+    # over the session affects every cell alike instead of whichever one ran
+    # last. Returns (records, iterations) per cell, in the order of cells.
+    # suffix names the session's files when the matrix has several builds.
+    startDir = os.getcwd()
+    profilers = [make_profiler(config, cell['suffix']) for cell in cells]
+    targetDir = os.path.join('JitBench', 'src', 'MusicStore', 'bin', 'Release', 'netcoreapp2.1', 'publish')
+    os.chdir(targetDir)
+
+    targetCommand = musicstore_command()
+
+    # One warm-up for the whole session rather than one per cell
+    if not config['WarmupDetection']:
+        savedEnvironment = set_environment(cells[0]['env'])
+        run_iteration(targetCommand, None, timeout = config['IterationTimeout'])
+        restore_environment(savedEnvironment)
+
+    outputFilePaths = []
+    parsers = []
+    for cell in cells:
+        outputFilePath = 'output{}.txt'.format(cell['suffix'])
+        if os.path.isfile(outputFilePath):
+            os.remove(outputFilePath)
+        outputFilePaths.append(outputFilePath)
+        parsers.append(IterationParser(config['MemorySampleInterval'], cell['label']))
+
+    # The seed is recorded so a schedule can be replayed
+    seed = config['InterleaveSeed']
+    if seed is None:
+        seed = random.randint(0, 2 ** 31 - 1)
+    rng = random.Random(seed)
+
+    blocks = 100
+    schedule = []
+    for block in range(0, blocks):
+        order = list(range(0, len(cells)))
+        rng.shuffle(order)
+        schedule.append([cells[index]['label'] for index in order])
+        print('Running block {} of {}'.format(block + 1, blocks))
+        for position, index in enumerate(order):
+            savedEnvironment = set_environment(cells[index]['env'])
+            run_iteration(targetCommand, outputFilePaths[index], parsers[index], timeout = config['IterationTimeout'], profiler = profilers[index])
+            restore_environment(savedEnvironment)
+            parsers[index].records[-1]['block'] = block
+            parsers[index].records[-1]['position'] = position
+
+    for outputFilePath in outputFilePaths:
+        copy_file(os.path.join(os.getcwd(), outputFilePath), os.path.join(startDir, outputFilePath))
+
+    # The same leading blocks are dropped from every cell so the remaining
+    # iterations still pair up block by block
+    warmup = 0
+    perCell = []
+    for cell, parser in zip(cells, parsers):
+        count, perMetric = find_warmup(config, parser.records)
+        warmup = max(warmup, count)
+        perCell.append({'label': cell['label'], 'warmupIterations': count, 'metrics': perMetric})
+    print('discarding the first {} blocks as warm-up'.format(warmup))
+
+    results = []
+    for cell, parser, profiler in zip(cells, parsers, profilers):
+        records = parser.records[warmup:]
+        if profiler is not None:
+            savedEnvironment = set_environment(cell['env'])
+            profiler.rerun_slowest(records, targetCommand)
+            restore_environment(savedEnvironment)
+        results.append((records, len(records)))
+    os.chdir(startDir)
+
+    write_json_file('interleave{}.json'.format(suffix), {
+        'seed': seed,
+        'schedule': schedule,
+        'warmup': {
+            'method': 'detect' if config['WarmupDetection'] else 'fixed',
+            'maxWarmup': config['MaxWarmup'],
+            'minShiftPercent': config['MinWarmupShift'],
+            'warmupBlocks': warmup,
+            'cells': perCell
+        }
+    })
+
+    write_paired_differences(cells, [records for records, iterations in results], 'paired{}.csv'.format(suffix))
+    return results
+
+def write_paired_differences(cells, cellRecords, name):
+    # Compares every cell with the first one using the differences between
+    # the iterations of the same block, which cancels out whatever the
+    # machine was doing during that block. Reports the mean difference with
+    # its 95% confidence interval and a bootstrap interval of the median
+    # difference, both in ms.
+    if os.path.isfile(name):
+        os.remove(name)
+
+    baseCell = cells[0]
+    baseRecords = cellRecords[0]
+    f = open(name, 'w')
+    f.write('config,baseline,metric,pairs,meanDiff,meanLow,meanHigh,medianDiff,medianLow,medianHigh,percentOfBaseline\n')
+    for cell, records in zip(cells[1:], cellRecords[1:]):
+        print('Paired differences of {} against {}:'.format(cell['label'] or '(default)', baseCell['label'] or '(default)'))
+        for prefix, metric in metricPrefixes:
+            differences = RollingStats()
+            baseline = RollingStats()
+            for base, record in zip(baseRecords, records):
+                differences.push(record[metric] - base[metric])
+                baseline.push(base[metric])
+            mean = differences.mean()
+            halfWidth = differences.mean_confidence_interval()
+            medianLow, medianHigh = differences.bootstrap_ci()
+            baseMean = baseline.mean()
+            percent = (mean / baseMean) * 100.0 if baseMean != 0 else 0.0
+            f.write('{},{},{},{},{},{},{},{},{},{},{}\n'.format(cell['label'], baseCell['label'], metric, len(differences),
+                mean, mean - halfWidth, mean + halfWidth, differences.median(), medianLow, medianHigh, percent))
+            print('  {}: {:+.2f}ms [{:+.2f}, {:+.2f}] ({:+.2f}%), median {:+.2f}ms [{:+.2f}, {:+.2f}]'.format(metric,
+                mean, mean - halfWidth, mean + halfWidth, percent, differences.median(), medianLow, medianHigh))
+    f.close()
+
+# The matrix JitBench runs when none is given: with and without tiered
+# compilation, labeled the way the BenchView upload expects.
+defaultMatrix = {
+    'axes': [
+        {
+            'name': 'tiering',
+            'values': [
+                {'label': 'TieredCompilation', 'env': {'COMPLUS_EXPERIMENTAL_TieredCompilation': '1'}},
+                {'label': '', 'env': {'COMPLUS_EXPERIMENTAL_TieredCompilation': '0'}}
+            ]
+        }
+    ]
+}
+
+def load_matrix(path):
+    # A matrix file is JSON like defaultMatrix. 'axes' is a list of knob
+    # axes, each a list of values with a label and the environment variables
+    # that value sets. It may also list 'Arch' and 'Branch' values to build
+    # and run. Every combination of one value per axis is a cell.
+    matrix = load_json_file(path)
+    if matrix is None:
+        error('could not read configuration matrix {}'.format(path))
+    for axis in matrix.get('axes', []):
+        if 'name' not in axis or not axis.get('values'):
+            error('every axis of {} needs a name and at least one value'.format(path))
+        for value in axis['values']:
+            if 'label' not in value or not isinstance(value.get('env'), dict):
+                error('every value of axis {} in {} needs a label and an env object'.format(axis['name'], path))
+    return matrix
+
+def parse_knob(text):
+    # --knob NAME=v1,v2,... as a matrix axis labeled NAMEv1, NAMEv2, ...
+    name, sep, values = text.partition('=')
+    if not sep or not name or not values:
+        error('--knob expects NAME=value1,value2,... not {}'.format(text))
+    return {'name': name, 'values': [{'label': name + value, 'env': {name: value}} for value in values.split(',')]}
+
+def label_part(text):
+    return re.sub(r'[^A-Za-z0-9.]+', '-', text).strip('-')
+
+def build_cells(config):
+    # (Arch, Branch) combinations to build, in order
+    matrix = config['Matrix']
+    arches = matrix.get('Arch', [config['Arch']])
+    branches = matrix.get('Branch', [config['Branch']])
+    return [(arch, branch) for arch in arches for branch in branches]
+
+def knob_cells(config, arch, branch):
+    # The cells to measure for one build. A cell's label joins the labels of
+    # its values, plus the arch and branch when the matrix varies them, and
+    # names its results in the result store; its suffix names its files.
+    matrix = config['Matrix']
+    prefix = []
+    if len(matrix.get('Arch', [])) > 1:
+        prefix.append(arch)
+    if len(matrix.get('Branch', [])) > 1:
+        prefix.append(label_part(branch))
+
+    cells = [{'labels': prefix, 'env': {}}]
+    for axis in matrix.get('axes', []):
+        expanded = []
+        for cell in cells:
+            for value in axis['values']:
+                env = dict(cell['env'])
+                env.update(value['env'])
+                labels = cell['labels'] + ([value['label']] if value['label'] else [])
+                expanded.append({'labels': labels, 'env': env})
+        cells = expanded
+
+    for cell in cells:
+        cell['label'] = '_'.join(cell.pop('labels'))
+        cell['suffix'] = '_' + cell['label'] if cell['label'] else ''
+        cell['arch'] = arch
+        cell['branch'] = branch
+    return cells
+
+def find_warmup(config, records):
+    # Number of leading records to discard and the count each metric asked
+    # for. Without detection the first record is always discarded, which is
+    # what the BenchView upload used to do with --drop-first-value. Every
+    # metric gets an equal share of the 5% false positive rate.
+    if not config['WarmupDetection']:
+        return 1, {}
+
+    perMetric = {}
+    for metric in warmupMetrics:
+        perMetric[metric] = warmup_length([float(r[metric]) for r in records], config['MaxWarmup'],
+                                          0.05 / len(warmupMetrics), config['MinWarmupShift'] / 100.0)
+    return max(perMetric.values()), perMetric
+
+def discard_warmup(config, records):
+    # Drops the warm-up iterations and returns the rest together with a
+    # description of what was dropped and why. Parallel workers each start
+    # from their own copy of the publish directory, so each worker's
+    # iterations are checked separately.
+    workers = {}
+    for record in records:
+        workers.setdefault(record.get('worker', 0), []).append(record)
+
+    kept = []
+    decision = {
+        'method': 'detect' if config['WarmupDetection'] else 'fixed',
+        'maxWarmup': config['MaxWarmup'],
+        'minShiftPercent': config['MinWarmupShift'],
+        'workers': []
+    }
+    for worker in sorted(workers.keys()):
+        workerRecords = workers[worker]
+        count, perMetric = find_warmup(config, workerRecords)
+        kept += workerRecords[count:]
+        decision['workers'].append({
+            'worker': worker,
+            'warmupIterations': count,
+            'metrics': perMetric,
+            'discarded': [dict((metric, r[metric]) for prefix, metric in metricPrefixes) for r in workerRecords[:count]]
+        })
+        print('discarding {} warm-up iterations of worker {}'.format(count, worker))
+
+    if 'iteration' in records[0]:
+        kept.sort(key = lambda r: r['iteration'])
+    return kept, decision
+
+def musicstore_command():
+    # MusicStore's argv, with dotnet resolved against the current PATH once
+    # rather than by a shell on every launch
+    return resolve_argv(['dotnet', 'MusicStore.dll'])
+
+# Failed launches the whole run may retry before it fails, set from
+# config['IterationRetries']
+retryBudget = RetryBudget(0)
+
+def run_iteration(targetCommand, outputFile, parser = None, cwd = None, env = None, timeout = None, profiler = None):
+    # With a profiler the iterations it selects are first run under its
+    # collector, with their output next to the trace, and then again on
+    # their own, so the collector's overhead never reaches the records.
+    traceDir = None
+    if profiler is not None:
+        command, traceDir = profiler.wrap(targetCommand, len(parser.records))
+    if traceDir is not None:
+        profiled = IterationParser()
+        launch_iteration(command, os.path.join(traceDir, 'output.txt'), profiled, cwd, env, timeout, traceDir)
+    launch_iteration(targetCommand, outputFile, parser, cwd, env, timeout)
+    if profiler is not None:
+        profiler.finish(parser.records[-1], traceDir, profiled.records[-1] if traceDir is not None else None)
+
+def launch_iteration(command, outputFile, parser, cwd, env, timeout, traceDir = None):
+    # Runs one launch, again while the retry budget lasts if it fails. A
+    # failed launch's partial trace is thrown away.
+    while True:
+        lineHandler = parser.feed if parser is not None else None
+        usageHandler = parser.record_usage if parser is not None else None
+        startHandler = parser.start_process if parser is not None else None
+        launchTimes = {}
+        try:
+            run_command(command, outputFile, lineHandler = lineHandler, cwd = cwd, env = env, usageHandler = usageHandler, startHandler = startHandler, timeout = timeout, launchTimes = launchTimes, raiseOnFailure = True)
+            if parser is not None:
+                parser.end_iteration(launchTimes)
+            break
+        except IterationFailed as e:
+            if parser is not None:
+                parser.discard_iteration()
+            if traceDir is not None:
+                shutil.rmtree(traceDir, True)
+                os.makedirs(traceDir)
+            if not retryBudget.take():
+                error('Running MusicStore failed: {}'.format(e))
+            print('Running MusicStore failed: {}. Retrying, {} retries left'.format(e, retryBudget.remaining))
+
+# Settings that change what an iteration measures. A checkpoint is only
+# resumed if these, the cell and the JitBench commit are all the same.
+checkpointKeys = ['OS', 'Arch', 'Branch', 'CoreCLRCommit', 'CoreCLRBinPath', 'RunCrossgen', 'WarmupDetection', 'MaxWarmup', 'MinWarmupShift',
+                  'Adaptive', 'MinIterations', 'MaxIterations', 'TargetCIWidth', 'MemorySampleInterval', 'IterationTimeout',
+                  'ProfileCommand', 'ProfileTrigger']
+
+def cell_checkpoint(config, cell):
+    # The checkpoint of one cell's iterations in the workspace, not yet read
+    values = dict((key, config[key]) for key in checkpointKeys)
+    values['JitBenchCommit'] = try_get_git_commit('JitBench')
+    values['label'] = cell['label']
+    values['env'] = cell['env']
+    return Checkpoint(os.path.abspath('checkpoint{}.jsonl'.format(cell['suffix'])), fingerprint(values))
+
+def open_checkpoint(config, cell):
+    # The checkpoint of one cell's iterations, holding the iterations of an
+    # interrupted run with the same fingerprint if --resume asked for them.
+    # The checkpoint of a finished run is returned as it was loaded, without
+    # being written to again.
+    checkpoint = cell_checkpoint(config, cell)
+    if config['Resume'] and checkpoint.load():
+        if checkpoint.finished is not None:
+            print('{} already finished in {}, skipping it'.format(cell['label'] or '(default)', checkpoint.path))
+            return checkpoint
+        print('resuming {} after {} completed iterations'.format(cell['label'] or '(default)', len(checkpoint.records)))
+    else:
+        checkpoint = Checkpoint(checkpoint.path, checkpoint.fingerprint)
+    checkpoint.start()
+    return checkpoint
+
+def finished_results(config, cell):
+    # The records and iteration count of a cell that a resumed run had
+    # already finished, rebuilt from its checkpoint the way the measurement
+    # loops left them, or None if the cell still has to be measured
+    if not config['Resume'] or config['Parallel'] != 1:
+        return None
+    checkpoint = cell_checkpoint(config, cell)
+    if not checkpoint.load() or checkpoint.finished is None:
+        return None
+    print('{} already finished in {}, writing its results again'.format(cell['label'] or '(default)', checkpoint.path))
+    records, warmup = discard_warmup(config, list(checkpoint.records))
+    return records, len(records)
+
+# Iterations the percentile trigger has to see before it can call one slow
+profileMinHistory = 10
+
+class IterationProfiler:
+    # Runs selected iterations of one cell under config['ProfileCommand'],
+    # a template in which {command} is the MusicStore command line and
+    # {trace} a directory for the collector to write its trace to. Traces
+    # are kept under traceRoot and linked from the iteration's record.
+    #
+    # Triggers are:
+    #   every:N       profile every Nth iteration
+    #   percentile:P  profile every iteration, but only keep the trace of
+    #                 iterations whose profiled startup is past the Pth
+    #                 percentile of the profiled iterations before them
+    #   slowest:K     after the measurements, re-run the configuration under
+    #                 the collector once for each of the K slowest iterations
+    # Launches under the collector carry its overhead, so with every:N and
+    # percentile:P the selected iterations are measured by a second launch
+    # without it. Their profiled startup is kept as traceStartup.
+    def __init__(self, config, traceRoot):
+        self.template = config['ProfileCommand']
+        self.trigger, self.value = config['ProfileTrigger']
+        self.timeout = config['IterationTimeout']
+        self.traceRoot = traceRoot
+        self.startups = RollingStats()
+        if os.path.isdir(traceRoot):
+            shutil.rmtree(traceRoot)
+
+    def command(self, targetCommand, traceDir):
+        # The collector's argv. A {command} argument of its own is replaced by
+        # MusicStore's argv; inside a larger argument it is its command line.
+        os.makedirs(traceDir)
+        argv = []
+        for arg in split_command(self.template):
+            if arg == '{command}':
+                argv += targetCommand
+            else:
+                argv.append(arg.format(command = command_line(targetCommand), trace = traceDir))
+        return resolve_argv(argv)
+
+    def wrap(self, targetCommand, index):
+        # The command to run as the index'th iteration and the directory its
+        # trace goes to, None if it is not profiled
+        if self.trigger == 'every' and (index + 1) % self.value == 0:
+            pass
+        elif self.trigger == 'percentile':
+            pass
+        else:
+            return targetCommand, None
+        traceDir = os.path.join(self.traceRoot, 'launch{}'.format(index))
+        return self.command(targetCommand, traceDir), traceDir
+
+    def finish(self, record, traceDir, profiledRecord):
+        # record is the iteration as measured, profiledRecord its launch
+        # under the collector, None if it was not profiled
+        if traceDir is None:
+            return
+        startup = profiledRecord['startup']
+        if self.trigger == 'percentile':
+            if len(self.startups) < profileMinHistory or startup <= self.startups.percentile(self.value):
+                shutil.rmtree(traceDir)
+                traceDir = None
+            else:
+                print('profiled startup of {}ms is past the {}th percentile, keeping trace {}'.format(startup, self.value, traceDir))
+            self.startups.push(startup)
+        if traceDir is not None:
+            record['trace'] = traceDir
+            record['traceTrigger'] = self.trigger
+            record['traceStartup'] = startup
+
+    def rerun_slowest(self, records, targetCommand):
+        # For the slowest trigger, runs one profiled iteration per slow
+        # record. Its output goes next to its trace and its startup is kept
+        # in the record to show whether the slowness reproduced.
+        if self.trigger != 'slowest':
+            return
+        slowest = sorted(range(0, len(records)), key = lambda i: records[i]['startup'], reverse = True)[:self.value]
+        for index in slowest:
+            traceDir = os.path.join(self.traceRoot, 'rerun{}'.format(index))
+            print('re-running iteration {} ({}ms) under the profiler'.format(index, records[index]['startup']))
+            parser = IterationParser()
+            command = self.command(targetCommand, traceDir)
+            run_iteration(command, os.path.join(traceDir, 'output.txt'), parser, timeout = self.timeout)
+            records[index]['trace'] = traceDir
+            records[index]['traceTrigger'] = self.trigger
+            records[index]['traceStartup'] = parser.records[-1]['startup']
+
+def create_profile_file(records, name):
+    # Links every profiled iteration to its trace
+    if os.path.isfile(name):
+        os.remove(name)
+
+    f = open(name, 'w')
+    f.write('iteration,trigger,startup,traceStartup,trace\n')
+    for index, r in enumerate(records):
+        if 'trace' in r:
+            f.write('{},{},{},{},{}\n'.format(r.get('iteration', index), r['traceTrigger'], r['startup'], r.get('traceStartup', ''), r['trace']))
+    f.close()
+
+def make_profiler(config, suffix):
+    if config['ProfileCommand'] is None:
+        return None
+    return IterationProfiler(config, os.path.abspath('traces{}'.format(suffix)))
+
+def run_adaptive_iterations(config, targetCommand, outputFilePath, profiler = None, label = '', checkpoint = None):
+    # Same idea as the stability runner's stabilization mode: after
+    # MinIterations, stop as soon as every metric's confidence interval is
+    # narrower than TargetCIWidth percent of its mean. Noisy configurations
+    # keep going up to MaxIterations and are reported, not failed.
+    # Iterations found to be warm-up are left out of the confidence
+    # intervals, and MinIterations counts only the iterations after them.
+    # Iterations of an interrupted run come from the checkpoint
+    parser = IterationParser(config['MemorySampleInterval'], label)
+    stats = dict((metric, RollingStats()) for prefix, metric in metricPrefixes)
+    if checkpoint is not None:
+        parser.records = list(checkpoint.records)
+        parser.checkpoint = checkpoint
+        for record in parser.records:
+            for prefix, metric in metricPrefixes:
+                stats[metric].push(record[metric])
+    statsWarmup = 0
+    minIter = config['MinIterations']
+    maxIter = config['MaxIterations']
+    target = config['TargetCIWidth']
+    for i in range(len(parser.records) + 1, maxIter + 1):
+        print('Running iteration {} of at most {}'.format(i, maxIter))
+        run_iteration(targetCommand, outputFilePath, parser, timeout = config['IterationTimeout'], profiler = profiler)
+        for prefix, metric in metricPrefixes:
+            stats[metric].push(parser.records[-1][metric])
+        if i < minIter:
+            continue
+
+        warmup, perMetric = find_warmup(config, parser.records)
+        if warmup != statsWarmup:
+            stats = dict((metric, RollingStats()) for prefix, metric in metricPrefixes)
+            for record in parser.records[warmup:]:
+                for prefix, metric in metricPrefixes:
+                    stats[metric].push(record[metric])
+            statsWarmup = warmup
+        if i - warmup < minIter:
+            continue
+
+        widestMetric = None
+        widest = 0.0
+        for prefix, metric in metricPrefixes:
+            mean = stats[metric].mean()
+            width = (2 * stats[metric].mean_confidence_interval() / mean) * 100.0 if mean != 0 else 0.0
+            if widestMetric is None or width > widest:
+                widestMetric = metric
+                widest = width
+        print('Widest confidence interval was {:.2f}% of the mean ({}) over {} iterations'.format(widest, widestMetric, i - warmup))
+        if telemetry is not None:
+            telemetry.set('jitbench_ci_width_percent', telemetry_labels(label), widest)
+            telemetry.set('jitbench_ci_width_target_percent', telemetry_labels(label), target)
+        if widest <= target:
+            print('Hit target of < {:.2f}%, stopping'.format(target))
+            if checkpoint is not None:
+                checkpoint.finish()
+            return discard_warmup(config, parser.records)
+
+    print('Failed to hit confidence interval target of {:.2f}% after {} iterations'.format(target, maxIter))
+    if checkpoint is not None:
+        checkpoint.finish()
+    return discard_warmup(config, parser.records)
+
+def get_worker_core_sets(workers):
+    # One disjoint set of processors per worker
+    try:
+        return split_cores(workers)
+    except ValueError:
+        error('cannot run {} workers on a machine with {} processors'.format(workers, multiprocessing.cpu_count()))
+
+def run_worker(worker, cores, workerDir, env, targetCommand, iterationIndices, osStr, sampleInterval, timeout, label, results, failures, stopEvent):
+    parser = IterationParser(sampleInterval, label)
+    outputFilePath = os.path.join(workerDir, 'output.txt')
+    command = pin_command(targetCommand, cores, osStr == 'Windows_NT')
+    try:
+        for index in iterationIndices:
+            if stopEvent.is_set():
+                return
+            run_iteration(command, outputFilePath, parser, cwd = workerDir, env = env, timeout = timeout)
+            record = parser.records[-1]
+            record['iteration'] = index
+            record['worker'] = worker
+            record['cores'] = cores
+            results.append(record)
+    except SystemExit:
+        failures.append(worker)
+        stopEvent.set()
+
+def run_parallel_iterations(config, targetCommand, outputFilePath, iterations, label = ''):
+    # Runs the measured iterations on config['Parallel'] workers at once. Each
+    # worker is pinned to its own cores, listens on its own port and runs out
+    # of its own copy of the publish directory so the MusicStore instances do
+    # not share state. Iterations are dealt out round robin.
+    workers = config['Parallel']
+    coreSets = get_worker_core_sets(workers)
+    publishDir = os.getcwd()
+
+    threads = []
+    results = []
+    failures = []
+    stopEvent = threading.Event()
+    workerDirs = []
+    for worker in range(0, workers):
+        workerDir = publishDir + '_worker{}'.format(worker)
+        if os.path.isdir(workerDir):
+            shutil.rmtree(workerDir)
+        shutil.copytree(publishDir, workerDir)
+        workerDirs.append(workerDir)
+
+        env = dict(os.environ)
+        env['ASPNETCORE_URLS'] = 'http://localhost:{}'.format(config['BasePort'] + worker)
+
+        print('worker {} uses cores {} and {}'.format(worker, coreSets[worker], env['ASPNETCORE_URLS']))
+        indices = list(range(worker, iterations, workers))
+        thread = threading.Thread(target = run_worker, args = (worker, coreSets[worker], workerDir, env, targetCommand, indices, config['OS'], config['MemorySampleInterval'], config['IterationTimeout'], label, results, failures, stopEvent))
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    if len(failures) != 0:
+        error('workers {} failed'.format(', '.join(str(w) for w in sorted(failures))))
+
+    # Keep output.txt as a single log of the whole run
+    outputFile = open(outputFilePath, 'wb')
+    for workerDir in workerDirs:
+        workerOutput = open(os.path.join(workerDir, 'output.txt'), 'rb')
+        outputFile.write(workerOutput.read())
+        workerOutput.close()
+    outputFile.close()
+
+    return sorted(results, key = lambda r: r['iteration'])
+
+# Settings that change what an agent's iterations measure. An agent is only
+# accepted if its settings are the same as the coordinator's.
+shardKeys = ['OS', 'RunCrossgen', 'WarmupDetection', 'MaxWarmup', 'MinWarmupShift', 'MemorySampleInterval', 'IterationTimeout']
+
+def start_coordinator(config):
+    host, port = config['Coordinator']
+    try:
+        coordinator = Coordinator(host, port)
+    except socket.error as e:
+        error('cannot listen for agents on {}:{}: {}'.format(host, port, e))
+    print('waiting for {} agents on {}:{}'.format(config['Agents'], host, coordinator.port))
+
+    settings = dict((key, config[key]) for key in shardKeys)
+    def check(hello):
+        different = [key for key in shardKeys if hello['settings'].get(key) != settings[key]]
+        if len(different) != 0:
+            return 'settings differ from the coordinator: {}'.format(', '.join(different))
+        # Agents that share a machine must not share a workspace or drive
+        for agent in coordinator.agents:
+            if agent.hostName != hello.get('host'):
+                continue
+            for key in ['Workspace', 'Drive']:
+                if agent.settings.get(key) == hello['settings'].get(key):
+                    return 'agent {} on the same machine already uses {} {}'.format(agent.name, key.lower(), agent.settings.get(key))
+        return None
+
+    try:
+        coordinator.accept(config['Agents'], config['AgentTimeout'], check)
+    except ShardError as e:
+        error(str(e))
+    return coordinator
+
+def run_sharded(config, coordinator, builds, cells):
+    # Splits the iterations of every cell round robin across the agents, the
+    # way --parallel splits them across workers, so every agent measures part
+    # of every cell and a slow machine cannot end up with one cell to itself.
+    # Warm-up is found per agent, then the timings are normalized per
+    # machine. Returns the records and iteration count of each cell.
+    iterations = 100
+    agents = coordinator.alive_agents()
+
+    # Agents on the same machine split it the way --parallel workers do. Each
+    # agent is told its slot and how many agents share its machine, by name,
+    # since a task may be handed on to another agent.
+    hosts = {}
+    for agent in agents:
+        hosts.setdefault(agent.hostName, []).append(agent.name)
+    slots = {}
+    for names in hosts.values():
+        for slot, name in enumerate(names):
+            slots[name] = [slot, len(names)]
+
+    tasks = []
+    for cell in cells:
+        for index, agent in enumerate(agents):
+            tasks.append((agent, {
+                'arch': config['Arch'],
+                'branch': config['Branch'],
+                'builds': builds,
+                'cell': cell,
+                'iterations': list(range(index, iterations, len(agents))),
+                'slots': slots
+            }))
+    try:
+        results = coordinator.run(tasks)
+    except ShardError as e:
+        error(str(e))
+
+    # Every agent has to have measured the same CoreCLR and JitBench
+    buildAgents = {}
+    for agent, result in results:
+        buildAgents.setdefault(fingerprint(result['build']), set()).add(agent.name)
+    if len(buildAgents) > 1:
+        error('the agents measured different builds: {}'.format('; '.join(', '.join(sorted(names)) for names in buildAgents.values())))
+    build = results[0][1]['build']
+    config['CoreCLRCommit'] = build['CoreCLRCommit']
+
+    cellResults = []
+    for cellIndex, cell in enumerate(cells):
+        records = []
+        agentIterations = {}
+        for agent, result in results[cellIndex * len(agents):(cellIndex + 1) * len(agents)]:
+            for record in result['records']:
+                record['worker'] = agent.name
+                record['machine'] = agent.fingerprint
+                records.append(record)
+            agentIterations[agent.name] = agentIterations.get(agent.name, 0) + len(result['records'])
+        records.sort(key = lambda r: r['iteration'])
+        records, warmup = discard_warmup(config, records)
+        factors = normalize_machines(records, [metric for prefix, metric in metricPrefixes])
+        write_json_file('warmup{}.json'.format(cell['suffix']), warmup)
+        write_json_file('shards{}.json'.format(cell['suffix']), {
+            'build': build,
+            'agents': [{'name': agent.name, 'host': agent.hostName, 'fingerprint': agent.fingerprint, 'machine': agent.machine, 'iterations': agentIterations.get(agent.name, 0)} for agent in coordinator.agents],
+            'factors': factors
+        })
+        cellResults.append((records, len(records)))
+    return cellResults
+
+def run_shard(config, cell, indices, name, fresh, slot = 0, slots = 1):
+    # Runs the iterations of one cell an agent was handed, after a warm-up
+    # launch unless warm-up detection is on. Records keep their iteration
+    # number in the whole cell so the coordinator can merge them. When slots
+    # agents share the machine, this one is pinned to the slot-th set of
+    # cores and listens on base-port + slot.
+    startDir = os.getcwd()
+    targetDir = os.path.join('JitBench', 'src', 'MusicStore', 'bin', 'Release', 'netcoreapp2.1', 'publish')
+    os.chdir(targetDir)
+
+    targetCommand = musicstore_command()
+    savedEnvironment = set_environment(cell['env'])
+    env = None
+    if slots > 1:
+        cores = get_worker_core_sets(slots)[slot]
+        targetCommand = pin_command(targetCommand, cores, config['OS'] == 'Windows_NT')
+        env = dict(os.environ)
+        env['ASPNETCORE_URLS'] = 'http://localhost:{}'.format(config['BasePort'] + slot)
+        print('agent {} uses cores {} and {}'.format(name, cores, env['ASPNETCORE_URLS']))
+    if not config['WarmupDetection']:
+        run_iteration(targetCommand, None, env = env, timeout = config['IterationTimeout'])
+
+    # A cell handed on from a failed agent adds to the output of the cell
+    outputFilePath = 'output{}.txt'.format(cell['suffix'])
+    if os.path.isfile(outputFilePath) and fresh:
+        os.remove(outputFilePath)
+
+    parser = IterationParser(config['MemorySampleInterval'], cell['label'])
+    for index in indices:
+        run_iteration(targetCommand, outputFilePath, parser, env = env, timeout = config['IterationTimeout'])
+        parser.records[-1]['iteration'] = index
+        parser.records[-1]['worker'] = name
+
+    copy_file(os.path.join(os.getcwd(), outputFilePath), os.path.join(startDir, outputFilePath))
+    restore_environment(savedEnvironment)
     os.chdir(startDir)
-    return newName, iterations
+    return parser.records
+
+def run_agent(config, remappedDir):
+    # Serves the coordinator until it is done. Each build is set up the
+    # first time a task asks for it, and the machine noise is checked around
+    # the whole session as it would be around a run of its own.
+    host, port = config['Agent']
+    settings = dict((key, config[key]) for key in shardKeys)
+    # Only checked against the other agents on this machine
+    settings['Workspace'] = os.path.abspath(config['Workspace'])
+    settings['Drive'] = config['Drive']
+    agent = Agent(host, port, config['AgentName'], settings)
+    try:
+        agent.connect(config['AgentTimeout'])
+    except ShardError as e:
+        error(str(e))
+    print('agent {} of the coordinator at {}:{}'.format(agent.name, host, port))
+
+    builds = {}
+    cellsRun = set()
+    def run_task(task):
+        build = (task['arch'], task['branch'])
+        config['Arch'], config['Branch'] = build
+        if build not in builds:
+            print('setting up {} {}'.format(task['arch'], task['branch']))
+            prepare_build(config, remappedDir, task['builds'] > 1)
+            if len(builds) == 0:
+                check_machine_noise(config, 'before')
+            builds[build] = {
+                'arch': task['arch'],
+                'branch': task['branch'],
+                'CoreCLRCommit': config['CoreCLRCommit'],
+                'JitBenchCommit': try_get_git_commit('JitBench')
+            }
+        cell = task['cell']
+        print('Running {} iterations of configuration {}'.format(len(task['iterations']), cell['label'] or '(default)'))
+        slot, slots = task['slots'].get(agent.name, [0, 1])
+        records = run_shard(config, cell, task['iterations'], agent.name, cell['suffix'] not in cellsRun, slot, slots)
+        cellsRun.add(cell['suffix'])
+        # The coordinator stores them under this machine
+        for record in records:
+            record['host'] = agent.hostName
+        return {'build': builds[build], 'records': records}
 
-def run_iteration(targetCommand, outputFile):
-    errorCode = run_command(targetCommand, outputFile)
-    if errorCode != 0:
-        error('Running MusicStore failed with error {}'.format(errorCode))
+    agent.serve(run_task)
+    if len(builds) != 0:
+        check_machine_noise(config, 'after')
+
+def create_shard_file(records, name):
+    # Records which agent and machine produced each iteration, with the
+    # timings both normalized and as measured, so runs can be checked for
+    # skew between machines
+    if os.path.isfile(name):
+        os.remove(name)
+
+    metrics = [metric for prefix, metric in metricPrefixes]
+    f = open(name, 'w')
+    f.write('iteration,agent,host,machine,{},{}\n'.format(','.join(metrics), ','.join(metric + 'Raw' for metric in metrics)))
+    for r in records:
+        f.write('{},{},{},{},{},{}\n'.format(r['iteration'], r['worker'], r['host'], r['machine'],
+            ','.join('{:.3f}'.format(r[metric]) for metric in metrics), ','.join(str(r['raw'][metric]) for metric in metrics)))
+    f.close()
+
+def create_iteration_file(records, name):
+    # Records which worker and which cores produced each iteration so runs
+    # can be checked for skew between workers.
+    if os.path.isfile(name):
+        os.remove(name)
+
+    f = open(name, 'w')
+    f.write('iteration,worker,cores,startup,request,minSteadyState,maxSteadyState,avgSteadyState\n')
+    for r in records:
+        f.write('{},{},{},{},{},{},{},{}\n'.format(r['iteration'], r['worker'], ' '.join(str(c) for c in r['cores']),
+            r['startup'], r['request'], r['minSteadyState'], r['maxSteadyState'], r['avgSteadyState']))
+    f.close()
 
 def parse_config():
     workingDir = os.environ['WORKSPACE']
@@ -315,7 +2085,48 @@ def parse_config():
         'RunCrossgen': True, 
         'CLRSetup': True, 
         'Branch': 'rel/2.0.0',
-        'TieredJitting': False
+        'TieredJitting': False,
+        'Parallel': 1,
+        'BasePort': 5000,
+        'StageCache': True,
+        'StageCacheDir': None,
+        'Adaptive': False,
+        'MinIterations': 10,
+        'MaxIterations': 100,
+        'TargetCIWidth': 2.0,
+        'ResultStore': True,
+        'ResultStorePath': None,
+        'RunId': new_run_id(),
+        'CoreCLRCommit': '',
+        'RegressionReport': True,
+        'BaselineRuns': 10,
+        'FailOnRegression': False,
+        'MemorySampleInterval': None,
+        'WarmupDetection': True,
+        'MaxWarmup': 10,
+        'MinWarmupShift': 5.0,
+        'Preflight': 'off',
+        'PreflightIterations': 10,
+        'PreflightStdDev': 2.0,
+        'PreflightResults': {},
+        'IterationTimeout': 600,
+        'Matrix': defaultMatrix,
+        'Interleave': False,
+        'InterleaveSeed': None,
+        'ProfileCommand': None,
+        'ProfileTrigger': None,
+        'BenchViewMeasurement': None,
+        'TelemetryPort': None,
+        'TelemetryFile': None,
+        'TelemetryInterval': 10,
+        'Resume': False,
+        'IterationRetries': 2,
+        'Coordinator': None,
+        'Agents': 1,
+        'Agent': None,
+        'AgentName': socket.gethostname(),
+        'AgentTimeout': 600,
+        'Drive': 'X:'
     }
     
     parser = argparse.ArgumentParser(description='Patches JitBench with a local CLR and runs basic timings')
@@ -326,6 +2137,45 @@ def parse_config():
     parser.add_argument('--workspace', help='Local directory to clone JitBench in to')
     parser.add_argument('--runcrossgen', type=bool_parser, help='Set to false if you want to skip crossgening JitBench. MusicStore depends on crossgen, so it needs to be run at least once to initialize the store.')
     parser.add_argument('--branch', help='the branch of JitBench to run.')
+    parser.add_argument('--parallel', type=int, help='Number of MusicStore iterations to run at once. Each worker is pinned to its own cores and listens on its own port.')
+    parser.add_argument('--base-port', type=int, help='Port the first parallel worker listens on. Worker N uses base-port + N.')
+    parser.add_argument('--stagecache', type=bool_parser, help='Set to false to always rebuild coreclr, the crossgen store and MusicStore instead of reusing outputs from a previous run with the same inputs')
+    parser.add_argument('--stagecache-dir', help='Directory to keep cached stage outputs in. Defaults to .stagecache in the workspace.')
+    parser.add_argument('--resultstore', type=bool_parser, help='Set to false to skip appending per-iteration results to the local result store')
+    parser.add_argument('--resultstore-path', help='SQLite result store to append to. Defaults to results.db in the workspace.')
+    parser.add_argument('--regression-report', type=bool_parser, help='Set to false to skip comparing this run against previous runs in the result store')
+    parser.add_argument('--baseline-runs', type=int, help='Number of previous runs to compare against when looking for regressions')
+    parser.add_argument('--fail-on-regression', type=bool_parser, help='Set to true to fail the run when a significant regression is found')
+    parser.add_argument('--memory-sample-interval', type=int, help='Sample the memory, thread and handle counts of every iteration every this many ms')
+    parser.add_argument('--warmup-detection', type=bool_parser, help='Set to false to go back to a single warm-up launch and discarding the first measured iteration instead of detecting the warm-up phase')
+    parser.add_argument('--max-warmup', type=int, help='Maximum number of measured iterations warm-up detection may discard')
+    parser.add_argument('--min-warmup-shift', type=float, help='How much slower, in %% of the median of the rest, iterations must be to count as warm-up')
+    parser.add_argument('--preflight', choices=['off', 'flag', 'refuse'], help='Check how noisy the machine is with the native stability runner before and after the measurements, and flag the run or refuse it if it is too noisy')
+    parser.add_argument('--preflight-iterations', type=int, help='Maximum number of blackscholes iterations each machine noise check runs')
+    parser.add_argument('--preflight-std-dev', type=float, help='Standard deviation, in %% of the median, above which the machine counts as too noisy')
+    parser.add_argument('--iteration-timeout', type=int, help='Seconds a MusicStore iteration may run before it and everything it started are killed and the run fails. 0 for no limit.')
+    parser.add_argument('--matrix', help='JSON file declaring the configuration matrix to run: axes of environment variable knobs and optionally Arch and Branch values. Defaults to with and without tiered compilation.')
+    parser.add_argument('--knob', action='append', help='Adds an axis to the configuration matrix that sets an environment variable to each of the given values, as NAME=value1,value2. May be repeated.')
+    parser.add_argument('--interleave', type=bool_parser, help='Set to true to measure the configurations of each build in one session of randomized blocks that run every configuration once, and report their paired differences against the first configuration')
+    parser.add_argument('--interleave-seed', type=int, help='Seed of the random block order in interleaved mode. Defaults to a new seed every run, recorded in interleave.json.')
+    parser.add_argument('--profile-command', help='Collector to run selected iterations under, with {command} where the MusicStore command goes and {trace} where the directory for its trace goes, e.g. "perf record -g -o {trace}/perf.data {command}"')
+    parser.add_argument('--profile-trigger', help='Which iterations to profile: every:N for every Nth, percentile:P to keep the traces of iterations slower than the Pth percentile of the ones before them, or slowest:K to re-run the configuration under the collector for the K slowest iterations')
+    parser.add_argument('--benchview-measurement', help='Write the timings of every configuration to this BenchView measurement.json, relative to the workspace, ready for submission.py')
+    parser.add_argument('--telemetry-port', type=int, help='Serve live progress metrics in the OpenMetrics format on http://127.0.0.1:PORT/metrics while the run goes on')
+    parser.add_argument('--telemetry-file', help='Rewrite live progress metrics in the OpenMetrics format to this file every --telemetry-interval seconds, e.g. for a node exporter textfile collector')
+    parser.add_argument('--telemetry-interval', type=int, help='Seconds between rewrites of --telemetry-file')
+    parser.add_argument('--resume', type=bool_parser, help='Set to true to continue each configuration from the iterations an interrupted run saved in its checkpoint, if the configuration and commits are the same')
+    parser.add_argument('--retries', type=int, help='Number of failed MusicStore launches the whole run may retry before it fails')
+    parser.add_argument('--coordinator', help='Set up nothing and run no iterations here, but wait on HOST:PORT for --agents agents and split the iterations of every configuration across them. Defaults to 127.0.0.1 when only a port is given, use 0.0.0.0:PORT for agents on other machines.')
+    parser.add_argument('--agents', type=int, help='Number of agents the coordinator waits for before it starts')
+    parser.add_argument('--agent', help='Run as an agent of the coordinator at HOST:PORT: set up each build it asks for and run the iterations it hands out. Results are stored by the coordinator.')
+    parser.add_argument('--agent-name', help='Name the agent reports its iterations under. Defaults to the host name.')
+    parser.add_argument('--agent-timeout', type=int, help='Seconds the coordinator waits for its agents to connect, and an agent keeps trying to reach its coordinator')
+    parser.add_argument('--adaptive', type=bool_parser, help='Set to true to run until the 95%% confidence interval of every metric is narrower than --ci-width instead of a fixed 100 iterations')
+    parser.add_argument('--min-iterations', type=int, help='Minimum number of iterations to run in adaptive mode')
+    parser.add_argument('--max-iterations', type=int, help='Maximum number of iterations to run in adaptive mode')
+    parser.add_argument('--ci-width', type=float, help='Target width of the confidence interval in adaptive mode, in %% of the mean')
+    parser.add_argument('--drive', help='Drive letter the workspace is mapped to. Defaults to X:. Agents that share a machine each need their own workspace and drive.')
 
     args = parser.parse_args()
 
@@ -352,6 +2202,126 @@ def parse_config():
         config['CLRSetup'] = args.clrsetup
     if args.branch != None:
         config['Branch'] = args.branch
+    if args.parallel != None:
+        if args.parallel < 1:
+            error('--parallel must be at least 1')
+        config['Parallel'] = args.parallel
+    if args.base_port != None:
+        config['BasePort'] = args.base_port
+    if args.stagecache == False:
+        config['StageCache'] = False
+    if args.stagecache_dir != None:
+        config['StageCacheDir'] = os.path.abspath(args.stagecache_dir)
+    if args.resultstore == False:
+        config['ResultStore'] = False
+    if args.resultstore_path != None:
+        config['ResultStorePath'] = os.path.abspath(args.resultstore_path)
+    if args.regression_report == False:
+        config['RegressionReport'] = False
+    if args.baseline_runs != None:
+        config['BaselineRuns'] = args.baseline_runs
+    if args.fail_on_regression == True:
+        config['FailOnRegression'] = True
+    if args.memory_sample_interval != None and args.memory_sample_interval > 0:
+        if not sampling_available():
+            error('memory sampling needs psutil on this platform')
+        config['MemorySampleInterval'] = args.memory_sample_interval / 1000.0
+    if args.warmup_detection == False:
+        config['WarmupDetection'] = False
+    if args.max_warmup != None:
+        config['MaxWarmup'] = args.max_warmup
+    if args.min_warmup_shift != None:
+        if args.min_warmup_shift < 0:
+            error('--min-warmup-shift must not be negative')
+        config['MinWarmupShift'] = args.min_warmup_shift
+    if args.preflight != None:
+        config['Preflight'] = args.preflight
+    if args.preflight_iterations != None:
+        config['PreflightIterations'] = args.preflight_iterations
+    if args.preflight_std_dev != None:
+        config['PreflightStdDev'] = args.preflight_std_dev
+    if args.iteration_timeout != None:
+        config['IterationTimeout'] = args.iteration_timeout if args.iteration_timeout > 0 else None
+    if args.matrix != None:
+        config['Matrix'] = load_matrix(args.matrix)
+    if args.knob != None:
+        config['Matrix'] = dict(config['Matrix'])
+        config['Matrix']['axes'] = config['Matrix'].get('axes', []) + [parse_knob(knob) for knob in args.knob]
+    if args.interleave == True:
+        config['Interleave'] = True
+    if args.interleave_seed != None:
+        config['InterleaveSeed'] = args.interleave_seed
+    if args.profile_command != None:
+        config['ProfileCommand'] = args.profile_command
+    if args.profile_trigger != None:
+        config['ProfileTrigger'] = parse_profile_trigger(args.profile_trigger)
+    if args.benchview_measurement != None:
+        config['BenchViewMeasurement'] = args.benchview_measurement
+    if args.telemetry_port != None:
+        config['TelemetryPort'] = args.telemetry_port
+    if args.telemetry_file != None:
+        config['TelemetryFile'] = os.path.abspath(args.telemetry_file)
+    if args.telemetry_interval != None:
+        if args.telemetry_interval < 1:
+            error('--telemetry-interval must be at least 1')
+        config['TelemetryInterval'] = args.telemetry_interval
+    if args.resume == True:
+        config['Resume'] = True
+    if args.retries != None:
+        if args.retries < 0:
+            error('--retries must not be negative')
+        config['IterationRetries'] = args.retries
+    try:
+        if args.coordinator != None:
+            config['Coordinator'] = parse_address(args.coordinator)
+        if args.agent != None:
+            config['Agent'] = parse_address(args.agent)
+    except ShardError as e:
+        error(str(e))
+    if args.agents != None:
+        if args.agents < 1:
+            error('--agents must be at least 1')
+        config['Agents'] = args.agents
+    if args.agent_name != None:
+        config['AgentName'] = args.agent_name
+    if args.agent_timeout != None:
+        config['AgentTimeout'] = args.agent_timeout
+    if args.adaptive == True:
+        config['Adaptive'] = True
+    if args.min_iterations != None:
+        config['MinIterations'] = args.min_iterations
+    if args.max_iterations != None:
+        config['MaxIterations'] = args.max_iterations
+    if args.ci_width != None:
+        config['TargetCIWidth'] = args.ci_width
+    if args.drive != None:
+        if not re.match(r'^[A-Za-z]:?$', args.drive):
+            error('--drive must be a drive letter, e.g. Y:')
+        config['Drive'] = args.drive[0].upper() + ':'
+
+    if config['LocalRun'] and len(config['Matrix'].get('Arch', [])) > 1:
+        error('a matrix with several Arch values cannot run against a single --coreclrbinpath')
+    if config['Adaptive'] and config['Parallel'] > 1:
+        error('--adaptive and --parallel cannot be combined')
+    if config['Interleave'] and (config['Adaptive'] or config['Parallel'] > 1):
+        error('--interleave cannot be combined with --adaptive or --parallel')
+    if config['Resume'] and (config['Interleave'] or config['Parallel'] > 1):
+        error('--resume cannot be combined with --interleave or --parallel')
+    if config['Coordinator'] is not None and config['Agent'] is not None:
+        error('--coordinator and --agent cannot be combined')
+    if (config['Coordinator'] is not None or config['Agent'] is not None) and (config['Adaptive'] or config['Interleave'] or config['Parallel'] > 1 or config['Resume'] or config['ProfileCommand'] is not None):
+        error('--coordinator and --agent cannot be combined with --adaptive, --interleave, --parallel, --resume or --profile-command')
+    if (config['ProfileCommand'] is None) != (config['ProfileTrigger'] is None):
+        error('--profile-command and --profile-trigger must be given together')
+    if config['ProfileCommand'] is not None:
+        if '{command}' not in config['ProfileCommand'] or '{trace}' not in config['ProfileCommand']:
+            error('--profile-command must contain {command} and {trace}')
+        if config['Parallel'] > 1:
+            error('--profile-command cannot be combined with --parallel')
+    if config['Preflight'] != 'off' and config['PreflightIterations'] < preflightWindow:
+        error('--preflight-iterations must be at least {}'.format(preflightWindow))
+    if config['MinIterations'] < 2 or config['MinIterations'] > config['MaxIterations']:
+        error('--min-iterations must be at least 2 and no more than --max-iterations')
 
     workingDir = config['Workspace']
     if workingDir is None or workingDir.isspace():
@@ -359,6 +2329,15 @@ def parse_config():
 
     return config
 
+def parse_profile_trigger(text):
+    kind, sep, value = text.partition(':')
+    if kind not in ['every', 'percentile', 'slowest'] or not value.isdigit():
+        error('--profile-trigger expects every:N, percentile:P or slowest:K, not {}'.format(text))
+    value = int(value)
+    if value < 1 or (kind == 'percentile' and value >= 100):
+        error('--profile-trigger {} is out of range'.format(text))
+    return kind, value
+
 def bool_parser(str):
     val = str.lower()
     if val == 'true' or val == 't':
@@ -377,27 +2356,83 @@ if __name__ == '__main__':
         os.makedirs(workingDir)
 
     absolutePath = os.path.abspath(workingDir)
-    run_command('subst X: {}'.format(absolutePath))
-    remappedDir = 'X:\\'
+    mappedDrive = config['Drive']
+    run_command('subst {} {}'.format(mappedDrive, absolutePath))
+    remappedDir = mappedDrive + '\\'
     os.chdir(remappedDir)
 
-    if config['CLRSetup']:
-        coreClrBinPath = config['CoreCLRBinPath'];
-        if not coreClrBinPath or coreClrBinPath.isspace():
-            prepare_coreclr(config)
-            productIdentifier = '{}.{}.Release'.format(config['OS'], config['Arch'])
-            coreClrBinPath = os.path.join(remappedDir, 'coreclr', 'bin', 'Product', productIdentifier)
-            config['CoreCLRBinPath'] = coreClrBinPath
-        
-        if not os.path.isdir(coreClrBinPath):
-            error('CoreCLR bin path {} does not exist'.format(coreClrBinPath))
+    if config['StageCacheDir'] is None:
+        config['StageCacheDir'] = os.path.join(remappedDir, '.stagecache')
+    if config['ResultStorePath'] is None:
+        config['ResultStorePath'] = os.path.join(remappedDir, 'results.db')
 
-    prepare_jitbench(config)
-    tieredFileName, iters = run_jitbench(config, True)
-    parse_output(tieredFileName, iters, '_TieredCompilation')
-    
-    fileName, iters = run_jitbench(config, False)
-    parse_output(fileName, iters, '')
+    # Every (Arch, Branch) in the matrix is set up in turn and all the knob
+    # cells are measured on it
+    builds = build_cells(config)
+    measuredCells = []
+    measurement = Measurement() if config['BenchViewMeasurement'] is not None else None
+    start_telemetry(config)
+    retryBudget = RetryBudget(config['IterationRetries'])
+
+    # An agent measures whatever its coordinator hands out and leaves the
+    # results to it
+    if config['Agent'] is not None:
+        run_agent(config, remappedDir)
+        stop_telemetry()
+        run_command('subst {} /D'.format(mappedDrive))
+        sys.exit(0)
+
+    # A coordinator sets up nothing itself and measures on its agents
+    coordinator = start_coordinator(config) if config['Coordinator'] is not None else None
+    for arch, branch in builds:
+        config['Arch'] = arch
+        config['Branch'] = branch
+        if coordinator is None:
+            prepare_build(config, remappedDir, len(builds) > 1)
+            if len(measuredCells) == 0:
+                check_machine_noise(config, 'before')
+
+        cells = knob_cells(config, arch, branch)
+        if coordinator is not None:
+            print('Running configurations {} on {} agents'.format(', '.join(cell['label'] or '(default)' for cell in cells), len(coordinator.alive_agents())))
+            results = run_sharded(config, coordinator, len(builds), cells)
+        elif config['Interleave'] and len(cells) > 1:
+            print('Running configurations {} interleaved'.format(', '.join(cell['label'] or '(default)' for cell in cells)))
+            buildSuffix = '_' + label_part('{}_{}'.format(arch, branch)) if len(builds) > 1 else ''
+            results = run_interleaved(config, cells, buildSuffix)
+        else:
+            results = None
+        for index, cell in enumerate(cells):
+            finished = None
+            if results is None:
+                finished = finished_results(config, cell)
+            if finished is not None:
+                # Its iterations are in the result store already, but the
+                # measurement document is written anew and needs them
+                records, iters = finished
+                write_results(records, iters, cell['suffix'], measurement)
+            else:
+                if results is None:
+                    print('Running configuration {}'.format(cell['label'] or '(default)'))
+                    records, iters = run_jitbench(config, cell)
+                else:
+                    records, iters = results[index]
+                write_results(records, iters, cell['suffix'], measurement)
+                store_results(config, records, cell['label'])
+            measuredCells.append(cell)
+            write_json_file('matrix.json', measuredCells)
+
+    if coordinator is not None:
+        coordinator.close()
+
+    if measurement is not None:
+        measurement.write(config['BenchViewMeasurement'])
+
+    if coordinator is None:
+        check_machine_noise(config, 'after')
+
+    report_regressions(config)
 
-    run_command("subst X: /D")
+    stop_telemetry()
+    run_command('subst {} /D'.format(mappedDrive))
     sys.exit(0)
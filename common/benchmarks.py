@@ -0,0 +1,38 @@
+# Loads the declarative benchmark registry used by the native stability
+# runners. Each entry describes where a benchmark comes from, how to run it
+# and how to read its result, so adding a workload needs no code.
+
+import json
+
+from logparser import LogParser
+
+# Keys every benchmark in the registry must define
+requiredKeys = ['sources', 'command', 'resultRegex', 'metric', 'units', 'stdDev']
+
+# Optional keys:
+#   sha256       expected hash of the source archive, checked by the download cache
+#   description  what the benchmark stresses
+
+def load_registry(path):
+    # Returns the registry as a dict of benchmark name to spec. Each spec
+    # gets its result regex compiled into a LogParser, 'parser'.
+    registryFile = open(path, 'r')
+    try:
+        registry = json.load(registryFile)
+    finally:
+        registryFile.close()
+
+    for name, spec in registry.items():
+        for key in requiredKeys:
+            if key not in spec:
+                raise ValueError('benchmark {} in {} does not define {}'.format(name, path, key))
+        spec['parser'] = LogParser([(spec['metric'], spec['resultRegex'], None)], anchored = False)
+    return registry
+
+def parse_result(spec, output):
+    # The number read from the first line of output matching the
+    # benchmark's result regex, or None if no line matches
+    result = spec['parser'].first(output)
+    if result is None:
+        return None
+    return float(result[1])
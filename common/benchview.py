@@ -0,0 +1,57 @@
+# Writes the BenchView measurement.json document directly from in-memory
+# results, shared by the JitBench timing harness and the Windows stability
+# runner.
+#
+# This is the document BenchView's measurement.py builds from CSV files of
+# "test,...,subtest,value" rows: every test is a node in a tree named by the
+# leading columns, and its leaves carry the metric definition and one
+# iteration per value. Building it in one pass saves an interpreter launch
+# and a rewrite of measurement.json per CSV file.
+
+import json
+import os
+
+class Measurement:
+    def __init__(self):
+        self.tests = []
+
+    def find_test(self, path):
+        # The test at path, created along with its parents if needed
+        tests = self.tests
+        test = None
+        for name in path:
+            test = None
+            for candidate in tests:
+                if candidate['name'] == name:
+                    test = candidate
+                    break
+            if test is None:
+                test = {'name': name, 'categories': [], 'tests': []}
+                tests.append(test)
+            tests = test['tests']
+        return test
+
+    def add(self, path, metric, unit, better, values, dropFirst = False):
+        # Appends values of metric to the test at path, a list of names from
+        # the outermost test in. better is 'asc' or 'desc'. dropFirst leaves
+        # out the first value, as measurement.py --drop-first-value does.
+        if better not in ['asc', 'desc']:
+            raise ValueError('better must be asc or desc, not {}'.format(better))
+        test = self.find_test(path)
+        performance = test.setdefault('performance', {'metrics': [], 'iterations': []})
+        if not any(m['name'] == metric for m in performance['metrics']):
+            performance['metrics'].append({'name': metric, 'displayName': metric, 'unit': unit, 'better': better})
+        if dropFirst:
+            values = values[1:]
+        for value in values:
+            performance['iterations'].append({metric: float(value)})
+
+    def write(self, path):
+        # Written to a temporary file and renamed so a reader never sees half of it
+        tempPath = path + '.tmp'
+        f = open(tempPath, 'w')
+        json.dump({'tests': self.tests}, f, indent = 2, sort_keys = True)
+        f.close()
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tempPath, path)
@@ -0,0 +1,116 @@
+# Durable per-iteration checkpoints of measurement loops and a shared budget
+# of retries for failed launches, used by the JitBench timing harness and the
+# native stability runners.
+#
+# A checkpoint is a JSON lines file. The first line holds the fingerprint of
+# what is being measured (configuration, commit, command line) and any state
+# the loop needs to carry over, each following line one completed iteration,
+# and a last 'finished' line the outcome once the loop is done. Every line is
+# flushed and fsynced as it is written, so a crash loses at most the
+# iteration that was running. A loop can only resume from a checkpoint whose
+# fingerprint matches its own.
+
+import hashlib
+import json
+import os
+import threading
+
+def fingerprint(values):
+    # A short stable hash of a JSON serializable description
+    return hashlib.sha256(json.dumps(values, sort_keys = True).encode('utf-8')).hexdigest()[:16]
+
+class Checkpoint:
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.state = {}
+        self.records = []
+        self.finished = None
+        self.file = None
+
+    def load(self):
+        # Reads the iterations of a previous run with the same fingerprint.
+        # Returns True if there was one. A line cut short by a crash ends the
+        # checkpoint there.
+        if not os.path.isfile(self.path):
+            return False
+        f = open(self.path, 'r')
+        try:
+            lines = f.read().split('\n')
+        finally:
+            f.close()
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            return False
+        if header.get('fingerprint') != self.fingerprint:
+            return False
+
+        self.state = header.get('state', {})
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break
+            if 'finished' in entry:
+                self.finished = entry['finished']
+                break
+            self.records.append(entry['record'])
+        return True
+
+    def start(self, state = None):
+        # Starts writing the checkpoint: a new one with state, or continuing
+        # the iterations load() found, which are written back first so a
+        # partial last line is dropped
+        if state is not None:
+            self.state = state
+        tempPath = self.path + '.tmp'
+        self.file = open(tempPath, 'w')
+        self.write_line({'fingerprint': self.fingerprint, 'state': self.state})
+        for record in self.records:
+            self.write_line({'record': record})
+        if self.finished is not None:
+            self.write_line({'finished': self.finished})
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tempPath, self.path)
+        self.file = open(self.path, 'a')
+
+    def write_line(self, entry):
+        self.file.write(json.dumps(entry, sort_keys = True) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def append(self, record):
+        self.records.append(record)
+        self.write_line({'record': record})
+
+    def finish(self, outcome = True):
+        # Records the outcome of the loop and returns it
+        self.finished = outcome
+        self.write_line({'finished': outcome})
+        self.close()
+        return outcome
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class RetryBudget:
+    # The number of failed launches a whole run may retry, shared by every
+    # loop and thread of the run
+    def __init__(self, retries):
+        self.remaining = retries
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        # Whether a failed launch may be retried, using up one retry if so
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            self.used += 1
+            return True
@@ -0,0 +1,33 @@
+# Splitting a machine into disjoint CPU sets and pinning commands to them,
+# shared by the JitBench timing harness and the native stability runners.
+
+import multiprocessing
+import subprocess
+
+def split_cores(count, cpuCount = None):
+    # Splits the machine's logical processors into count disjoint, equally
+    # sized sets. Left over processors are not used by any set.
+    if cpuCount is None:
+        cpuCount = multiprocessing.cpu_count()
+    coresPerSet = cpuCount // count
+    if coresPerSet == 0:
+        raise ValueError('cannot split {} processors into {} sets'.format(cpuCount, count))
+
+    return [list(range(s * coresPerSet, (s + 1) * coresPerSet)) for s in range(0, count)]
+
+def pin_command(cmd, cores, windows, title = 'JitBench', high = False):
+    # START /AFFINITY on Windows, taskset everywhere else. high also raises
+    # the priority class on Windows. cmd may also be an argv list, which
+    # gives an argv list back on POSIX. START is a shell builtin, so on
+    # Windows the result is always a command line.
+    if windows:
+        if isinstance(cmd, list):
+            cmd = subprocess.list2cmdline(cmd)
+        mask = 0
+        for core in cores:
+            mask |= 1 << core
+        return 'START "{}" /B /WAIT{} /AFFINITY {} {}'.format(title, ' /HIGH' if high else '', hex(mask), cmd)
+    elif isinstance(cmd, list):
+        return ['taskset', '-c', ','.join(str(c) for c in cores)] + cmd
+    else:
+        return 'taskset -c {} {}'.format(','.join(str(c) for c in cores), cmd)
@@ -0,0 +1,181 @@
+# Content addressed cache of downloaded benchmark archives, used by the
+# native stability runners.
+#
+# Archives are kept under the cache directory by the hash of their URL, next
+# to a record of their sha256. A cached archive is only used if it still
+# hashes to that record, and to the expected hash when the caller has one,
+# so a corrupt or partial download is fetched again instead of trusted.
+# Downloads go to a .partial file that is only renamed into place once
+# complete.
+#
+# Unpacking leaves a marker in the target directory listing the archive's
+# hash and every file it produced with its size. While the marker matches
+# the archive and the files are all there, unpacking is skipped.
+
+import hashlib
+import json
+import os
+import tarfile
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+chunkSize = 1024 * 1024
+
+def is_url(location):
+    return location.startswith('http://') or location.startswith('https://')
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    f = open(path, 'rb')
+    try:
+        while True:
+            chunk = f.read(chunkSize)
+            if not chunk:
+                break
+            digest.update(chunk)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+def load_json(path):
+    if not os.path.isfile(path):
+        return None
+    f = open(path, 'r')
+    try:
+        return json.load(f)
+    except ValueError:
+        return None
+    finally:
+        f.close()
+
+def write_json(path, data):
+    # Written to a temporary file and renamed so a reader never sees half of it
+    tempPath = path + '.tmp'
+    f = open(tempPath, 'w')
+    json.dump(data, f, indent = 2, sort_keys = True)
+    f.close()
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tempPath, path)
+
+def make_dirs(path):
+    # Benchmarks may be fetched from several threads at once
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+class DownloadCache:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def entry_path(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, key, os.path.basename(url))
+
+    def fetch(self, location, expectedHash = None, offline = False):
+        # Returns (path, sha256) of the archive at location, downloading it
+        # only if there is no intact cached copy. Local paths are used in
+        # place. Raises IOError if the archive does not match expectedHash or
+        # is needed while offline.
+        if not is_url(location):
+            digest = hash_file(location)
+            self.check_hash(location, digest, expectedHash)
+            return location, digest
+
+        path = self.entry_path(location)
+        recordPath = path + '.json'
+        record = load_json(recordPath)
+        if record is not None and record.get('url') == location and os.path.isfile(path):
+            if expectedHash is None or record['sha256'] == expectedHash:
+                if os.path.getsize(path) == record['size'] and hash_file(path) == record['sha256']:
+                    print("Using cached %s" % (path))
+                    return path, record['sha256']
+                print("Cached %s is corrupt, downloading it again" % (path))
+
+        if offline:
+            raise IOError('%s is not in the download cache and downloads are disabled' % (location))
+
+        make_dirs(os.path.dirname(path))
+        if os.path.exists(recordPath):
+            os.remove(recordPath)
+        print("Downloading from %s to %s" % (location, path))
+        partialPath = path + '.partial'
+        digest = hashlib.sha256()
+        size = 0
+        response = urlopen(location)
+        partialFile = open(partialPath, 'wb')
+        try:
+            while True:
+                chunk = response.read(chunkSize)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                partialFile.write(chunk)
+                size += len(chunk)
+        finally:
+            partialFile.close()
+            response.close()
+
+        digest = digest.hexdigest()
+        try:
+            self.check_hash(location, digest, expectedHash)
+        except IOError:
+            os.remove(partialPath)
+            raise
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(partialPath, path)
+        write_json(recordPath, {'url': location, 'sha256': digest, 'size': size})
+        return path, digest
+
+    def check_hash(self, location, digest, expectedHash):
+        if expectedHash is not None and digest != expectedHash:
+            raise IOError('%s has sha256 %s, expected %s' % (location, digest, expectedHash))
+
+def unpacked_marker(archivePath, targetDir):
+    return os.path.join(targetDir, '.%s.unpacked.json' % (os.path.basename(archivePath)))
+
+def is_unpacked(archivePath, digest, targetDir):
+    # Whether the marker says this exact archive was unpacked into targetDir
+    # and every file it produced is still there at its original size
+    marker = load_json(unpacked_marker(archivePath, targetDir))
+    if marker is None or marker.get('sha256') != digest:
+        return False
+    for name, size in marker['files'].items():
+        path = os.path.join(targetDir, name)
+        if not os.path.isfile(path) or os.path.getsize(path) != size:
+            return False
+    return True
+
+def unpack(archivePath, digest, targetDir):
+    # Extracts the archive into targetDir unless it already is. Members are
+    # read in one streaming pass. Returns True if anything was extracted.
+    if is_unpacked(archivePath, digest, targetDir):
+        print("%s is already unpacked in %s" % (archivePath, targetDir))
+        return False
+
+    markerPath = unpacked_marker(archivePath, targetDir)
+    if os.path.exists(markerPath):
+        os.remove(markerPath)
+
+    print("Unpacking from %s" % (archivePath))
+    files = {}
+    archive = tarfile.open(archivePath, 'r|*')
+    try:
+        for member in archive:
+            name = os.path.normpath(member.name)
+            if os.path.isabs(name) or name.startswith('..'):
+                raise IOError('%s contains %s, which is outside the target directory' % (archivePath, member.name))
+            archive.extract(member, targetDir)
+            if member.isfile():
+                files[name] = member.size
+    finally:
+        archive.close()
+
+    write_json(markerPath, {'archive': archivePath, 'sha256': digest, 'files': files})
+    return True
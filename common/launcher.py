@@ -0,0 +1,90 @@
+# Direct launching of benchmark processes and the clock the harness times
+# them with, shared by the JitBench timing harness.
+#
+# Benchmark iterations are started from an argv list with the executable
+# already resolved against PATH, so no shell runs in between and its startup
+# does not end up in the numbers. Popen then execs the program directly,
+# through posix_spawn where Python supports it for the given arguments and
+# fork/exec otherwise, or CreateProcess on Windows.
+
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+def _posix_monotonic():
+    # time.monotonic only exists from Python 3.3
+    import ctypes
+    import ctypes.util
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+    clock_gettime = libc.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    def monotonic():
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+# Seconds on a clock that only moves forward, for differences only
+if hasattr(time, 'monotonic'):
+    monotonic = time.monotonic
+elif sys.platform == 'win32':
+    # QueryPerformanceCounter since the first call
+    monotonic = time.clock
+else:
+    try:
+        monotonic = _posix_monotonic()
+    except (OSError, AttributeError):
+        monotonic = time.time
+
+def find_program(name, env = None):
+    # The full path of the program name would run as, searched for on the
+    # PATH of env (os.environ by default), or None if it is not found
+    if env is None:
+        env = os.environ
+    extensions = ['']
+    if sys.platform == 'win32':
+        extensions += env.get('PATHEXT', '.COM;.EXE;.BAT;.CMD').lower().split(';')
+    if os.path.dirname(name):
+        directories = ['']
+    else:
+        directories = env.get('PATH', os.defpath).split(os.pathsep)
+    for directory in directories:
+        for extension in extensions:
+            path = os.path.join(directory, name + extension)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return os.path.abspath(path)
+    return None
+
+def resolve_argv(argv, env = None):
+    # argv with its program replaced by its full path, when it can be found
+    path = find_program(argv[0], env)
+    if path is None:
+        return list(argv)
+    return [path] + list(argv[1:])
+
+def split_command(commandLine):
+    # Splits a command line into argv the way the platform's shell would,
+    # without the shell's expansions
+    if sys.platform == 'win32':
+        return [token[1:-1] if len(token) > 1 and token[0] == token[-1] == '"' else token
+                for token in shlex.split(commandLine, posix = False)]
+    return shlex.split(commandLine)
+
+def command_line(argv):
+    # argv as a single command line, for logs
+    if sys.platform == 'win32':
+        return subprocess.list2cmdline(argv)
+    try:
+        from shlex import quote
+    except ImportError:
+        from pipes import quote
+    return ' '.join(quote(arg) for arg in argv)
@@ -0,0 +1,134 @@
+# Single pass parser for benchmark output shared by the JitBench timing
+# harness and the native stability runners.
+#
+# All the patterns a harness looks for are compiled into one alternation, so
+# each line is tested once no matter how many metrics there are, and numbers
+# are read with their unit instead of assuming an integer number of ms.
+#
+# Run this file to time it on a synthetic MusicStore log:
+#   python logparser.py --lines 2000000
+
+import re
+
+# Scale of each unit we understand relative to a second
+unitScales = {'ns': 1e-9, 'us': 1e-6, 'ms': 1e-3, 's': 1.0}
+
+# A decimal number followed by an optional unit, for use in patterns
+numberPattern = r'(\d+(?:\.\d+)?)\s*(ns|us|ms|s)?\b'
+
+def convert(number, unit, targetUnit):
+    # number is the text of a number in unit. Without a targetUnit it is
+    # returned as is.
+    if targetUnit is None:
+        return float(number)
+    return float(number) * unitScales[unit] / unitScales[targetUnit]
+
+class LogParser:
+    # patterns is a list of (name, regex, unit). A regex either has no
+    # groups, for lines that only need to be recognized, or a number group
+    # optionally followed by a unit group, as numberPattern provides. Values
+    # are converted to unit; a number without a unit is taken to be in unit
+    # already. Integers that need no conversion stay integers so they are
+    # written back out exactly as printed. With anchored the patterns must match at the start of the line.
+    def __init__(self, patterns, anchored = True):
+        # Each pattern's outer group is the last one to close when it matches,
+        # so lastindex says which pattern matched. patternAt maps it to the
+        # pattern's (name, number group, unit group, unit).
+        self.patternAt = [None]
+        alternatives = []
+        for name, regex, unit in patterns:
+            groups = re.compile(regex).groups
+            if groups > 2:
+                raise ValueError('pattern for {} has more than a number and a unit group'.format(name))
+            alternatives.append('(' + regex + ')')
+            group = len(self.patternAt)
+            numberGroup = group + 1 if groups > 0 else None
+            unitGroup = group + 2 if groups == 2 else None
+            self.patternAt += [(name, numberGroup, unitGroup, unit)] + [None] * groups
+
+        combined = re.compile('|'.join(alternatives))
+        self.find = combined.match if anchored else combined.search
+
+    def parse_line(self, line):
+        # (name, value) for the pattern line matches, or None. value is None
+        # for patterns without a number.
+        m = self.find(line)
+        if m is None:
+            return None
+        return self.result(m)
+
+    def result(self, m):
+        name, numberGroup, unitGroup, unit = self.patternAt[m.lastindex]
+        if numberGroup is None:
+            return name, None
+        number = m.group(numberGroup)
+        if unitGroup is not None:
+            numberUnit = m.group(unitGroup)
+            if numberUnit is not None and numberUnit != unit:
+                return name, convert(number, numberUnit, unit)
+        return name, float(number) if '.' in number else int(number)
+
+    def parse_lines(self, lines):
+        # Yields (name, value) for every matching line
+        find = self.find
+        for line in lines:
+            m = find(line)
+            if m is not None:
+                yield self.result(m)
+
+    def first(self, text):
+        # The first (name, value) in text, or None
+        for result in self.parse_lines(text.splitlines()):
+            return result
+        return None
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    argParser = argparse.ArgumentParser(description = 'Times LogParser on a synthetic MusicStore log')
+    argParser.add_argument('--lines', type = int, default = 2000000)
+    args = argParser.parse_args()
+
+    iteration = ['Server started in 1234ms\n',
+                 'Hosting environment: Production\n',
+                 'Now listening on: http://localhost:5000\n',
+                 'Request took 456ms\n',
+                 'Steadystate min response time: 3ms\n',
+                 'Steadystate max response time: 12.5ms\n',
+                 'Steadystate average response time: 5ms\n',
+                 'Application is shutting down...\n']
+    lines = iteration * (args.lines // len(iteration))
+
+    prefixes = ['Server started in', 'Request took', 'Steadystate min response time',
+                'Steadystate max response time', 'Steadystate average response time']
+    parser = LogParser([(prefix, re.escape(prefix) + r'\D*' + numberPattern, 'ms') for prefix in prefixes])
+
+    # What startup.py did before: a startswith per prefix, then split the
+    # line again to find the number, which had to be an integer of ms
+    def parse_num_from_string(line):
+        for s in line.split():
+            if s[0].isdigit():
+                numString = s[:-2]
+                if not numString.isdigit():
+                    return None
+                return numString
+        return -1
+
+    start = time.time()
+    for line in lines:
+        for prefix in prefixes:
+            if line.startswith(prefix):
+                parse_num_from_string(line)
+                break
+    legacy = time.time() - start
+
+    start = time.time()
+    parsed = 0
+    for result in parser.parse_lines(lines):
+        parsed += 1
+    single = time.time() - start
+
+    print('{} lines, {} values'.format(len(lines), parsed))
+    print('startswith and split: {:.3f}s ({:.0f} lines/s)'.format(legacy, len(lines) / legacy))
+    print('LogParser:            {:.3f}s ({:.0f} lines/s)'.format(single, len(lines) / single))
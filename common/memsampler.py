@@ -0,0 +1,144 @@
+# Samples the memory, thread and handle counts of a benchmark process tree
+# while it runs.
+#
+# On Linux the numbers come straight from /proc. Elsewhere psutil is used if
+# it is installed; without it sampling is unavailable.
+
+import os
+import sys
+import threading
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Fields of each sample after its timestamp. Sizes are in KB and summed over
+# the process tree; privateKB is RssAnon on Linux and private bytes on Windows.
+sampleFields = ['rssKB', 'privateKB', 'threads', 'handles']
+
+def sampling_available():
+    return sys.platform.startswith('linux') or psutil is not None
+
+def read_proc_status(pid):
+    values = {}
+    f = open('/proc/{}/status'.format(pid), 'r')
+    try:
+        for line in f:
+            name, sep, value = line.partition(':')
+            values[name] = value.split()
+    finally:
+        f.close()
+    return values
+
+def proc_children():
+    # Maps every pid to the pids whose parent it is
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            f = open('/proc/{}/stat'.format(entry), 'r')
+            try:
+                stat = f.read()
+            finally:
+                f.close()
+        except (IOError, OSError):
+            continue
+        # The command name is in parentheses and may contain spaces
+        parent = int(stat[stat.rindex(')') + 2:].split()[1])
+        children.setdefault(parent, []).append(int(entry))
+    return children
+
+def sample_proc_tree(rootPid):
+    children = proc_children()
+    pending = [rootPid]
+    totals = dict((field, 0) for field in sampleFields)
+    sawPrivate = False
+    while pending:
+        pid = pending.pop()
+        pending.extend(children.get(pid, []))
+        try:
+            status = read_proc_status(pid)
+            handles = len(os.listdir('/proc/{}/fd'.format(pid)))
+        except (IOError, OSError):
+            # Exited between listing and reading
+            continue
+        totals['rssKB'] += int(status.get('VmRSS', ['0'])[0])
+        if 'RssAnon' in status:
+            totals['privateKB'] += int(status['RssAnon'][0])
+            sawPrivate = True
+        totals['threads'] += int(status.get('Threads', ['0'])[0])
+        totals['handles'] += handles
+    if not sawPrivate:
+        totals['privateKB'] = None
+    return totals
+
+def sample_psutil_tree(rootPid):
+    totals = dict((field, 0) for field in sampleFields)
+    try:
+        root = psutil.Process(rootPid)
+        processes = [root] + root.children(recursive = True)
+    except psutil.Error:
+        return totals
+    for process in processes:
+        try:
+            memory = process.memory_info()
+            totals['rssKB'] += memory.rss // 1024
+            totals['privateKB'] += getattr(memory, 'private', 0) // 1024
+            totals['threads'] += process.num_threads()
+            if hasattr(process, 'num_handles'):
+                totals['handles'] += process.num_handles()
+            else:
+                totals['handles'] += process.num_fds()
+        except psutil.Error:
+            continue
+    return totals
+
+class MemorySampler:
+    # Polls the tree rooted at pid every interval seconds on a background
+    # thread until stop() is called. Samples are (time.time(), rssKB,
+    # privateKB, threads, handles) tuples.
+    def __init__(self, pid, interval):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.stopEvent = threading.Event()
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def sample(self):
+        if sys.platform.startswith('linux'):
+            totals = sample_proc_tree(self.pid)
+        else:
+            totals = sample_psutil_tree(self.pid)
+        self.samples.append(tuple([time.time()] + [totals[field] for field in sampleFields]))
+
+    def run(self):
+        while not self.stopEvent.is_set():
+            self.sample()
+            self.stopEvent.wait(self.interval)
+
+    def stop(self):
+        self.stopEvent.set()
+        self.thread.join()
+        return self.samples
+
+def sample_at(samples, timestamp, after = True):
+    # The first sample taken at or after timestamp, or the last one taken at
+    # or before it. Falls back to the nearest sample on the other side.
+    if not samples:
+        return None
+    if after:
+        for sample in samples:
+            if sample[0] >= timestamp:
+                return sample
+        return samples[-1]
+    for sample in reversed(samples):
+        if sample[0] <= timestamp:
+            return sample
+    return samples[0]
@@ -0,0 +1,172 @@
+# Resource accounting for benchmark processes shared by the JitBench timing
+# harness and the native stability runners.
+#
+# On POSIX the child is reaped with wait4, whose rusage covers the child and
+# every descendant it waited for, so the shell that shell=True puts in between
+# does not hide the benchmark. On Windows the child is put in a job object and
+# the job's accounting is read back, which likewise covers the whole tree.
+# Windows has no split between major and minor faults and no per process
+# context switch counts, so those are None there, and its peak memory is the
+# peak committed memory of any process in the job rather than peak RSS.
+
+import os
+import signal
+import subprocess
+import sys
+
+# Keys of the dict returned by wait_with_usage, in report order
+usageMetrics = ['userTime', 'systemTime', 'peakMemoryKB', 'pageFaults', 'majorFaults', 'minorFaults', 'voluntarySwitches', 'involuntarySwitches']
+
+if sys.platform == 'win32':
+    import ctypes
+    from ctypes import wintypes
+
+    JobObjectBasicAccountingInformation = 1
+    JobObjectExtendedLimitInformation = 9
+
+    class JOBOBJECT_BASIC_ACCOUNTING_INFORMATION(ctypes.Structure):
+        _fields_ = [('TotalUserTime', ctypes.c_int64),
+                    ('TotalKernelTime', ctypes.c_int64),
+                    ('ThisPeriodTotalUserTime', ctypes.c_int64),
+                    ('ThisPeriodTotalKernelTime', ctypes.c_int64),
+                    ('TotalPageFaultCount', wintypes.DWORD),
+                    ('TotalProcesses', wintypes.DWORD),
+                    ('ActiveProcesses', wintypes.DWORD),
+                    ('TotalTerminatedProcesses', wintypes.DWORD)]
+
+    class JOBOBJECT_BASIC_LIMIT_INFORMATION(ctypes.Structure):
+        _fields_ = [('PerProcessUserTimeLimit', ctypes.c_int64),
+                    ('PerJobUserTimeLimit', ctypes.c_int64),
+                    ('LimitFlags', wintypes.DWORD),
+                    ('MinimumWorkingSetSize', ctypes.c_size_t),
+                    ('MaximumWorkingSetSize', ctypes.c_size_t),
+                    ('ActiveProcessLimit', wintypes.DWORD),
+                    ('Affinity', ctypes.c_size_t),
+                    ('PriorityClass', wintypes.DWORD),
+                    ('SchedulingClass', wintypes.DWORD)]
+
+    class IO_COUNTERS(ctypes.Structure):
+        _fields_ = [('ReadOperationCount', ctypes.c_uint64),
+                    ('WriteOperationCount', ctypes.c_uint64),
+                    ('OtherOperationCount', ctypes.c_uint64),
+                    ('ReadTransferCount', ctypes.c_uint64),
+                    ('WriteTransferCount', ctypes.c_uint64),
+                    ('OtherTransferCount', ctypes.c_uint64)]
+
+    class JOBOBJECT_EXTENDED_LIMIT_INFORMATION(ctypes.Structure):
+        _fields_ = [('BasicLimitInformation', JOBOBJECT_BASIC_LIMIT_INFORMATION),
+                    ('IoInfo', IO_COUNTERS),
+                    ('ProcessMemoryLimit', ctypes.c_size_t),
+                    ('JobMemoryLimit', ctypes.c_size_t),
+                    ('PeakProcessMemoryUsed', ctypes.c_size_t),
+                    ('PeakJobMemoryUsed', ctypes.c_size_t)]
+
+    kernel32 = ctypes.WinDLL('kernel32', use_last_error = True)
+    kernel32.CreateJobObjectW.restype = wintypes.HANDLE
+    kernel32.CreateJobObjectW.argtypes = [ctypes.c_void_p, wintypes.LPCWSTR]
+    kernel32.AssignProcessToJobObject.argtypes = [wintypes.HANDLE, wintypes.HANDLE]
+    kernel32.QueryInformationJobObject.argtypes = [wintypes.HANDLE, ctypes.c_int, ctypes.c_void_p, wintypes.DWORD, ctypes.c_void_p]
+    kernel32.CloseHandle.argtypes = [wintypes.HANDLE]
+    kernel32.TerminateJobObject.argtypes = [wintypes.HANDLE, wintypes.UINT]
+
+def process_group_args():
+    # Extra Popen arguments that start the child in its own process group so
+    # kill_tree can reach everything it starts. start_new_session makes it
+    # the leader of a new session, and of a group with its pid, from C in the
+    # child. A preexec_fn runs Python in the forked child, which is not safe
+    # while other threads run, so it is only used where Python 2 has nothing
+    # else.
+    if sys.platform == 'win32':
+        return {}
+    if sys.version_info[0] >= 3:
+        return {'start_new_session': True}
+    return {'preexec_fn': os.setpgrp}
+
+def kill_tree(proc, job = None):
+    # Kills proc and every process it started. On Windows that is everything
+    # in its job, or whatever taskkill finds without one. Elsewhere it is its
+    # process group, which process_group_args made it the leader of.
+    if sys.platform == 'win32':
+        if job is not None and kernel32.TerminateJobObject(job, 1):
+            return
+        subprocess.call('taskkill /T /F /PID {}'.format(proc.pid), shell = True)
+        return
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        # Already gone
+        pass
+
+def start_accounting(proc):
+    # Call right after starting proc. Returns the state wait_with_usage needs.
+    if sys.platform != 'win32':
+        return None
+    job = kernel32.CreateJobObjectW(None, None)
+    if not job:
+        return None
+    if not kernel32.AssignProcessToJobObject(job, int(proc._handle)):
+        kernel32.CloseHandle(job)
+        return None
+    return job
+
+def query_job(job, infoClass, info):
+    if not kernel32.QueryInformationJobObject(job, infoClass, ctypes.byref(info), ctypes.sizeof(info), None):
+        return False
+    return True
+
+def wait_with_usage(proc, job = None):
+    # Waits for proc like proc.wait() and returns (returncode, usage), where
+    # usage maps each of usageMetrics to a number, or None when the platform
+    # does not provide it or accounting failed.
+    usage = dict((name, None) for name in usageMetrics)
+
+    if sys.platform == 'win32':
+        returnCode = proc.wait()
+        if job is None:
+            return returnCode, usage
+        accounting = JOBOBJECT_BASIC_ACCOUNTING_INFORMATION()
+        limits = JOBOBJECT_EXTENDED_LIMIT_INFORMATION()
+        if query_job(job, JobObjectBasicAccountingInformation, accounting):
+            # Times are in 100ns units
+            usage['userTime'] = accounting.TotalUserTime / 1e7
+            usage['systemTime'] = accounting.TotalKernelTime / 1e7
+            usage['pageFaults'] = accounting.TotalPageFaultCount
+        if query_job(job, JobObjectExtendedLimitInformation, limits):
+            usage['peakMemoryKB'] = limits.PeakProcessMemoryUsed // 1024
+        kernel32.CloseHandle(job)
+        return returnCode, usage
+
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    if os.WIFSIGNALED(status):
+        returnCode = -os.WTERMSIG(status)
+    else:
+        returnCode = os.WEXITSTATUS(status)
+    # We reaped the child ourselves, so Popen must not try to
+    proc.returncode = returnCode
+
+    usage['userTime'] = rusage.ru_utime
+    usage['systemTime'] = rusage.ru_stime
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    usage['peakMemoryKB'] = rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss
+    usage['majorFaults'] = rusage.ru_majflt
+    usage['minorFaults'] = rusage.ru_minflt
+    usage['pageFaults'] = rusage.ru_majflt + rusage.ru_minflt
+    usage['voluntarySwitches'] = rusage.ru_nvcsw
+    usage['involuntarySwitches'] = rusage.ru_nivcsw
+    return returnCode, usage
+
+def check_output_with_usage(commandLine):
+    # subprocess.check_output(commandLine, shell=True) that also returns the
+    # resource usage of the command. The output is decoded, so it can be
+    # matched with text patterns under Python 3 as well.
+    proc = subprocess.Popen(commandLine, shell = True, stdout = subprocess.PIPE)
+    job = start_accounting(proc)
+    output = proc.stdout.read().decode('utf-8', 'replace')
+    proc.stdout.close()
+    returnCode, usage = wait_with_usage(proc, job)
+    if returnCode != 0:
+        raise subprocess.CalledProcessError(returnCode, commandLine, output = output)
+    return output, usage
+
+def format_usage(usage):
+    return ', '.join('{}={}'.format(name, usage[name]) for name in usageMetrics if usage[name] is not None)
@@ -0,0 +1,179 @@
+# Compares a run's per-iteration results against the previous runs in the
+# result store and reports likely regressions.
+#
+# Each series (benchmark, metric, config on one machine) is compared with a
+# Mann-Whitney U test, which does not assume the timings are normally
+# distributed, and the size of the change is given as the Hodges-Lehmann
+# shift and Cliff's delta. A change point search over the per-run medians
+# shows whether the shift started with this run or earlier. Every metric we
+# record (durations, CPU time, memory, page faults) is better when lower.
+
+import math
+import random
+
+def ranks(values):
+    # Average ranks (1 based) of values, with ties sharing their mean rank.
+    # Also returns the tie correction term sum(t^3 - t).
+    order = sorted(range(len(values)), key = lambda i: values[i])
+    result = [0.0] * len(values)
+    tieTerm = 0.0
+    i = 0
+    while i < len(order):
+        j = i
+        while j + 1 < len(order) and values[order[j + 1]] == values[order[i]]:
+            j += 1
+        rank = (i + j) / 2.0 + 1
+        for k in range(i, j + 1):
+            result[order[k]] = rank
+        ties = j - i + 1
+        tieTerm += ties ** 3 - ties
+        i = j + 1
+    return result, tieTerm
+
+def mann_whitney_u(baseline, current):
+    # Two sided Mann-Whitney U test using the normal approximation with tie
+    # correction. Returns (U, p) where U counts pairs in which the current
+    # value is larger.
+    n1 = len(baseline)
+    n2 = len(current)
+    allRanks, tieTerm = ranks(list(baseline) + list(current))
+    rankSum = sum(allRanks[n1:])
+    u = rankSum - n2 * (n2 + 1) / 2.0
+    mean = n1 * n2 / 2.0
+    n = n1 + n2
+    variance = n1 * n2 / 12.0 * ((n + 1) - tieTerm / (n * (n - 1)))
+    if variance <= 0:
+        return u, 1.0
+    z = (u - mean) / math.sqrt(variance)
+    return u, math.erfc(abs(z) / math.sqrt(2))
+
+def median(values):
+    ordered = sorted(values)
+    count = len(ordered)
+    if count % 2 == 1:
+        return ordered[count // 2]
+    return (ordered[count // 2 - 1] + ordered[count // 2]) / 2.0
+
+def hodges_lehmann(baseline, current):
+    # Median of all pairwise differences current - baseline
+    return median([c - b for c in current for b in baseline])
+
+def change_point(series, permutations = 200, seed = 0, maxIndex = None):
+    # Most likely single shift in the mean of series and its permutation test
+    # p value. Returns (index of the first value after the shift, p), or
+    # (None, 1.0) when the series is too short. maxIndex limits the search to
+    # shifts within the first maxIndex values.
+    if len(series) < 4:
+        return None, 1.0
+
+    def best_split(values):
+        n = len(values)
+        total = sum(values)
+        left = 0.0
+        bestIndex = None
+        bestScore = -1.0
+        for k in range(1, n if maxIndex is None else min(maxIndex + 1, n)):
+            left += values[k - 1]
+            leftMean = left / k
+            rightMean = (total - left) / (n - k)
+            score = (k * (n - k) / float(n)) * (leftMean - rightMean) ** 2
+            if score > bestScore:
+                bestIndex = k
+                bestScore = score
+        return bestIndex, bestScore
+
+    index, score = best_split(series)
+    rng = random.Random(seed)
+    shuffled = list(series)
+    atLeastAsExtreme = 0
+    for i in range(0, permutations):
+        rng.shuffle(shuffled)
+        if best_split(shuffled)[1] >= score:
+            atLeastAsExtreme += 1
+    return index, (atLeastAsExtreme + 1) / float(permutations + 1)
+
+def compare_series(baselineRuns, currentValues, alpha = 0.01, minEffect = 1.0, changeAlpha = 0.05):
+    # baselineRuns is a list of per-iteration value lists, oldest run first.
+    # A change is only reported when it is both significant at alpha and at
+    # least minEffect percent of the baseline median. A change point is only
+    # reported when significant at changeAlpha.
+    baseline = [v for run in baselineRuns for v in run]
+    baselineMedian = median(baseline)
+    currentMedian = median(currentValues)
+    u, p = mann_whitney_u(baseline, currentValues)
+    shift = hodges_lehmann(baseline, currentValues)
+    # Relative to the size of the baseline, so a shift towards more
+    # negative values is negative whatever the sign of the metric. Any shift
+    # from a baseline of zero is unbounded rather than hidden.
+    if baselineMedian != 0:
+        shiftPercent = shift / abs(baselineMedian) * 100.0
+    else:
+        shiftPercent = math.copysign(float('inf'), shift) if shift != 0 else 0.0
+    cliffsDelta = 2.0 * u / (len(baseline) * len(currentValues)) - 1.0
+
+    medians = [median(run) for run in baselineRuns] + [currentMedian]
+    changeIndex, changeP = change_point(medians)
+
+    verdict = 'unchanged'
+    if p < alpha and abs(shiftPercent) >= minEffect:
+        verdict = 'regression' if shift > 0 else 'improvement'
+
+    return {
+        'baselineRuns': len(baselineRuns),
+        'baselineMedian': baselineMedian,
+        'currentMedian': currentMedian,
+        'shift': shift,
+        'shiftPercent': shiftPercent,
+        'cliffsDelta': cliffsDelta,
+        'p': p,
+        # How many runs before this one the most likely shift started
+        'changeRunsAgo': (len(medians) - 1 - changeIndex) if changeIndex is not None and changeP < changeAlpha else None,
+        'verdict': verdict
+    }
+
+def compare_run(store, runId, baselineCount = 10, alpha = 0.01, minEffect = 1.0):
+    # Compares every series recorded by runId with the same series in the
+    # baselineCount previous runs on the same machine.
+    findings = []
+    series = set(store.scan(selected = ('benchmark', 'metric', 'config', 'machine'), run = runId))
+    for benchmark, metric, config, machine in sorted(series):
+        filters = {'benchmark': benchmark, 'metric': metric, 'config': config, 'machine': machine}
+        runs = store.runs(**filters)
+        if runId not in runs:
+            continue
+        previous = runs[:runs.index(runId)][-baselineCount:]
+        if len(previous) == 0:
+            continue
+
+        baselineRuns = [store.values(run = r, **filters) for r in previous]
+        current = store.values(run = runId, **filters)
+        finding = compare_series(baselineRuns, current, alpha, minEffect)
+        finding.update(filters)
+        finding['run'] = runId
+        findings.append(finding)
+
+    # Regressions first, largest first, then improvements, then the rest
+    order = {'regression': 0, 'improvement': 1, 'unchanged': 2}
+    findings.sort(key = lambda f: (order[f['verdict']], -abs(f['shiftPercent'])))
+    return findings
+
+def write_report(findings, path):
+    reportFile = open(path, 'w')
+    header = '{:<11} {:<12} {:<24} {:<18} {:>6} {:>10} {:>10} {:>9} {:>7} {:>9} {:>12}'.format(
+        'verdict', 'benchmark', 'metric', 'config', 'runs', 'baseline', 'current', 'shift%', 'delta', 'p', 'since')
+    reportFile.write(header + '\n')
+    print(header)
+    for f in findings:
+        if f['changeRunsAgo'] is None:
+            since = '-'
+        elif f['changeRunsAgo'] == 0:
+            since = 'this run'
+        else:
+            since = '{} runs ago'.format(f['changeRunsAgo'])
+        line = '{:<11} {:<12} {:<24} {:<18} {:>6} {:>10.3f} {:>10.3f} {:>8.2f}% {:>7.2f} {:>9.2g} {:>12}'.format(
+            f['verdict'], f['benchmark'], f['metric'], f['config'] or '-', f['baselineRuns'], f['baselineMedian'],
+            f['currentMedian'], f['shiftPercent'], f['cliffsDelta'], f['p'], since)
+        reportFile.write(line + '\n')
+        print(line)
+    reportFile.close()
+    return len([f for f in findings if f['verdict'] == 'regression'])
@@ -0,0 +1,108 @@
+# Local, append-only store of per-iteration benchmark results shared by the
+# JitBench timing harness and the native stability runners.
+
+import os
+import platform
+import sqlite3
+import time
+import uuid
+
+# Every row is one iteration of one metric of one run
+columns = ['run', 'benchmark', 'metric', 'config', 'commit_id', 'machine', 'timestamp', 'iteration', 'value']
+
+schema = '''
+CREATE TABLE IF NOT EXISTS results (
+    run TEXT NOT NULL,
+    benchmark TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    config TEXT NOT NULL,
+    commit_id TEXT NOT NULL,
+    machine TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    iteration INTEGER NOT NULL,
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_series ON results (benchmark, metric, config, timestamp);
+CREATE INDEX IF NOT EXISTS results_machine ON results (machine, timestamp);
+CREATE INDEX IF NOT EXISTS results_run ON results (run);
+'''
+
+def new_run_id():
+    return '{}-{}'.format(time.strftime('%Y%m%dT%H%M%S'), uuid.uuid4().hex[:8])
+
+class ResultStore:
+    # SQLite database in WAL mode so appends are cheap and readers do not
+    # block the harness. The indexes cover the usual scans: one metric of one
+    # benchmark/config over time, one machine over time, and one run.
+    def __init__(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(schema)
+        self.machine = platform.node()
+
+    def append(self, rows):
+        # rows is a list of dicts keyed by column name. machine and timestamp
+        # default to this machine and now, commit_id and config to ''.
+        now = time.time()
+        values = []
+        for row in rows:
+            values.append((
+                row['run'],
+                row['benchmark'],
+                row['metric'],
+                row.get('config', ''),
+                row.get('commit_id', ''),
+                row.get('machine', self.machine),
+                row.get('timestamp', now),
+                row['iteration'],
+                float(row['value'])))
+        self.connection.executemany('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', values)
+        self.connection.commit()
+
+    def scan(self, selected = ('timestamp', 'run', 'iteration', 'value'), since = None, until = None, **filters):
+        # Returns the selected columns of every row matching the equality
+        # filters (any column name) and timestamp range, oldest first.
+        for name in list(selected) + list(filters.keys()):
+            if name not in columns:
+                raise ValueError('unknown column {}'.format(name))
+
+        clauses = []
+        parameters = []
+        for name in sorted(filters.keys()):
+            clauses.append('{} = ?'.format(name))
+            parameters.append(filters[name])
+        if since is not None:
+            clauses.append('timestamp >= ?')
+            parameters.append(since)
+        if until is not None:
+            clauses.append('timestamp < ?')
+            parameters.append(until)
+
+        query = 'SELECT {} FROM results'.format(', '.join(selected))
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        query += ' ORDER BY timestamp, run, iteration'
+        return self.connection.execute(query, parameters).fetchall()
+
+    def runs(self, **filters):
+        # Ids of the runs that have rows matching the equality filters, in the
+        # order they started
+        for name in filters.keys():
+            if name not in columns:
+                raise ValueError('unknown column {}'.format(name))
+        names = sorted(filters.keys())
+        query = 'SELECT run FROM results'
+        if names:
+            query += ' WHERE ' + ' AND '.join('{} = ?'.format(name) for name in names)
+        query += ' GROUP BY run ORDER BY MIN(timestamp)'
+        return [row[0] for row in self.connection.execute(query, [filters[name] for name in names]).fetchall()]
+
+    def values(self, **filters):
+        return [row[0] for row in self.scan(selected = ('value',), **filters)]
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,237 @@
+# Incremental statistics shared by the JitBench timing harness and the native
+# stability runners.
+
+import math
+import random
+from collections import deque
+from itertools import islice
+
+# Two sided 95% critical values of Student's t distribution, indexed by degrees
+# of freedom. Past the end of the table the normal approximation is used.
+tCriticalValues = [None, 12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+                   2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+                   2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+class IndexableSkiplist:
+    # A sorted multiset with O(log n) expected insert, remove and lookup by
+    # index. Every link also stores how many values it skips, so an index is
+    # found by walking down the levels like a value is.
+    #
+    # Nodes are [value, links, widths] lists. maxLevels should be about
+    # log2 of the largest expected size; larger sizes still work, just slower.
+    def __init__(self, maxLevels = 24):
+        self.size = 0
+        self.maxLevels = maxLevels
+        self.end = [None, [], []]
+        self.head = [None, [self.end] * maxLevels, [1] * maxLevels]
+        # Node heights come from a generator of their own, so they neither
+        # use nor disturb the seeded global one
+        self.random = random.Random(0)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if index < 0 or index >= self.size:
+            raise IndexError('skiplist index out of range')
+        node = self.head
+        index += 1
+        for level in reversed(range(self.maxLevels)):
+            while node[2][level] <= index:
+                index -= node[2][level]
+                node = node[1][level]
+        return node[0]
+
+    def __iter__(self):
+        node = self.head[1][0]
+        while node is not self.end:
+            yield node[0]
+            node = node[1][0]
+
+    def insert(self, value):
+        # The last node before value on every level, and how far it is
+        chain = [None] * self.maxLevels
+        steps = [0] * self.maxLevels
+        node = self.head
+        for level in reversed(range(self.maxLevels)):
+            while node[1][level] is not self.end and node[1][level][0] <= value:
+                steps[level] += node[2][level]
+                node = node[1][level]
+            chain[level] = node
+
+        height = min(self.maxLevels, 1 - int(math.log(1.0 - self.random.random(), 2.0)))
+        newNode = [value, [None] * height, [None] * height]
+        distance = 0
+        for level in range(height):
+            previous = chain[level]
+            newNode[1][level] = previous[1][level]
+            previous[1][level] = newNode
+            newNode[2][level] = previous[2][level] - distance
+            previous[2][level] = distance + 1
+            distance += steps[level]
+        for level in range(height, self.maxLevels):
+            chain[level][2][level] += 1
+        self.size += 1
+
+    def remove(self, value):
+        # Removes one occurrence of value
+        chain = [None] * self.maxLevels
+        node = self.head
+        for level in reversed(range(self.maxLevels)):
+            while node[1][level] is not self.end and node[1][level][0] < value:
+                node = node[1][level]
+            chain[level] = node
+
+        target = chain[0][1][0]
+        if target is self.end or target[0] != value:
+            raise ValueError('{} is not in the skiplist'.format(value))
+        for level in range(len(target[1])):
+            previous = chain[level]
+            previous[2][level] += target[2][level] - 1
+            previous[1][level] = target[1][level]
+        for level in range(len(target[1]), self.maxLevels):
+            chain[level][2][level] -= 1
+        self.size -= 1
+
+class RollingStats:
+    # Statistics over the last windowSize values pushed (every value if
+    # windowSize is None), ignoring the trim smallest and trim largest of them.
+    #
+    # A sorted copy of the window is kept in an indexable skiplist, so a push
+    # costs O(log n) expected time, and the median, percentiles and trimmed
+    # values are found by index in O(log n) each. Running sums give the mean
+    # and variance without re-summing the window. Sums are kept relative to
+    # the first value pushed so the variance does not lose precision when the
+    # values are large compared to their spread. Statistics of an empty
+    # window are 0.
+    def __init__(self, windowSize = None, trim = 0):
+        self.windowSize = windowSize
+        self.trim = trim
+        self.window = deque()
+        self.sortedValues = IndexableSkiplist(int(math.log(windowSize, 2)) + 1 if windowSize else 24)
+        self.shift = None
+        self.sum = 0.0
+        self.sumSquares = 0.0
+
+    def __len__(self):
+        return len(self.window)
+
+    def push(self, value):
+        value = float(value)
+        if self.shift is None:
+            self.shift = value
+
+        self.window.append(value)
+        self.sortedValues.insert(value)
+        delta = value - self.shift
+        self.sum += delta
+        self.sumSquares += delta * delta
+
+        if self.windowSize is not None and len(self.window) > self.windowSize:
+            oldest = self.window.popleft()
+            self.sortedValues.remove(oldest)
+            delta = oldest - self.shift
+            self.sum -= delta
+            self.sumSquares -= delta * delta
+
+    def trim_count(self):
+        # Trimming only applies once something is left afterwards
+        if len(self.sortedValues) > 2 * self.trim:
+            return self.trim
+        return 0
+
+    def values(self):
+        # Iterates over the values that survive trimming, smallest first,
+        # straight off the skiplist
+        trim = self.trim_count()
+        return islice(self.sortedValues, trim, len(self.sortedValues) - trim)
+
+    def trimmed_sums(self):
+        count = len(self.sortedValues)
+        trim = self.trim_count()
+        total = self.sum
+        totalSquares = self.sumSquares
+        for index in list(range(0, trim)) + list(range(count - trim, count)):
+            value = self.sortedValues[index]
+            delta = value - self.shift
+            total -= delta
+            totalSquares -= delta * delta
+        return count - 2 * trim, total, totalSquares
+
+    def median(self):
+        # Trimming is symmetric, so it does not move the median
+        count = len(self.sortedValues)
+        if count == 0:
+            return 0.0
+        middle = count // 2
+        if count % 2 == 1:
+            return self.sortedValues[middle]
+        return (self.sortedValues[middle - 1] + self.sortedValues[middle]) / 2.0
+
+    def mean(self):
+        count, total, totalSquares = self.trimmed_sums()
+        if count == 0:
+            return 0.0
+        return self.shift + total / count
+
+    def variance(self, sample = False):
+        # Population variance by default, which is what the stability
+        # threshold has always been computed with.
+        count, total, totalSquares = self.trimmed_sums()
+        if count < 2:
+            return 0.0
+        meanDelta = total / count
+        variance = max(totalSquares / count - meanDelta * meanDelta, 0.0)
+        if sample:
+            variance = variance * count / (count - 1)
+        return variance
+
+    def stddev(self, sample = False):
+        return math.sqrt(self.variance(sample))
+
+    def percent_of_median(self):
+        # Standard deviation as a percentage of the median
+        median = self.median()
+        if median == 0:
+            return 0.0
+        return (self.stddev() / median) * 100.0
+
+    def percentile(self, p):
+        # Nearest rank percentile of the trimmed window, p in [0, 100]
+        trim = self.trim_count()
+        count = len(self.sortedValues) - 2 * trim
+        if count == 0:
+            return 0.0
+        rank = int(math.ceil(p / 100.0 * count))
+        return self.sortedValues[trim + min(max(rank, 1), count) - 1]
+
+    def mean_confidence_interval(self):
+        # Half width of the 95% confidence interval of the mean
+        count = len(self.sortedValues) - 2 * self.trim_count()
+        if count < 2:
+            return float('inf')
+        degrees = count - 1
+        t = tCriticalValues[degrees] if degrees < len(tCriticalValues) else 1.96
+        return t * math.sqrt(self.variance(True) / count)
+
+    def bootstrap_ci(self, statistic = 'median', confidence = 0.95, resamples = 1000, seed = None):
+        # Percentile bootstrap confidence interval of the median or mean of the
+        # trimmed window. Returns (low, high), (0, 0) for an empty window.
+        values = list(self.values())
+        count = len(values)
+        if count == 0:
+            return 0.0, 0.0
+        rng = random.Random(seed)
+        estimates = []
+        for i in range(0, resamples):
+            sample = sorted(values[rng.randrange(count)] for j in range(0, count))
+            if statistic == 'mean':
+                estimates.append(sum(sample) / float(count))
+            elif count % 2 == 1:
+                estimates.append(sample[count // 2])
+            else:
+                estimates.append((sample[count // 2 - 1] + sample[count // 2]) / 2.0)
+        estimates.sort()
+        low = estimates[int(((1.0 - confidence) / 2.0) * resamples)]
+        high = estimates[min(int(((1.0 + confidence) / 2.0) * resamples), resamples - 1)]
+        return low, high
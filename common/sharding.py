@@ -0,0 +1,303 @@
+# Splitting the iterations of a benchmark run across several machines, used
+# by the JitBench timing harness.
+#
+# A coordinator listens on a TCP port and agents, one per machine or several
+# on one machine, connect to it. The protocol is one JSON object per line in
+# both directions:
+#
+#   agent       -> coordinator  {"type": "hello", "name", "host", "machine", "fingerprint", "settings"}
+#   coordinator -> agent        {"type": "welcome", "name"} or {"type": "rejected", "reason"}
+#   coordinator -> agent        {"type": "task", "id", "task"}
+#   agent       -> coordinator  {"type": "result", "id", "result"} or {"type": "failed", "id", "reason"}
+#   coordinator -> agent        {"type": "done"}
+#
+# Each agent runs one task at a time. The tasks of an agent that fails or
+# disconnects go to the agents that are left. Machines are told apart by a
+# fingerprint of their hardware and OS, so timings can be normalized per
+# kind of machine before they are merged. Host names are only reported, so
+# that results can be stored under the machine that measured them.
+
+import json
+import multiprocessing
+import platform
+import socket
+import threading
+import time
+
+from checkpoint import fingerprint
+from regression import median
+
+class ShardError(Exception):
+    pass
+
+def machine_info():
+    # What makes the timings of one machine differ from another's. Machines
+    # that are the same in all of it share a fingerprint and are normalized
+    # together.
+    return {
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpus': multiprocessing.cpu_count()
+    }
+
+def host_name():
+    # The name results of this machine are stored under, as the result store
+    # itself names it
+    return platform.node()
+
+def parse_address(text, defaultHost = '127.0.0.1'):
+    # HOST:PORT or just PORT
+    host, sep, port = text.rpartition(':')
+    if not port.isdigit():
+        raise ShardError('expected HOST:PORT or PORT, not {}'.format(text))
+    return host or defaultHost, int(port)
+
+def send_message(f, message):
+    f.write((json.dumps(message, sort_keys = True) + '\n').encode('utf-8'))
+    f.flush()
+
+def receive_message(f):
+    # The next message, or None once the other side has gone away
+    try:
+        line = f.readline()
+    except socket.error:
+        return None
+    if not line:
+        return None
+    return json.loads(line.decode('utf-8'))
+
+def normalize_machines(records, metrics, key = 'machine'):
+    # Scales the metrics of each machine's records so that machine's median
+    # matches the median of all the records, which takes the difference in
+    # speed between machines out of the spread. The values as measured are
+    # kept in each record's 'raw'. Returns the factors, by machine and metric.
+    machines = {}
+    for record in records:
+        machines.setdefault(record[key], []).append(record)
+
+    factors = {}
+    for metric in metrics:
+        pooled = median([float(r[metric]) for r in records])
+        for machine, machineRecords in machines.items():
+            own = median([float(r[metric]) for r in machineRecords])
+            factor = pooled / own if own != 0 else 1.0
+            factors.setdefault(machine, {})[metric] = factor
+            for record in machineRecords:
+                raw = record.setdefault('raw', {})
+                raw.setdefault(metric, record[metric])
+                record[metric] = float(raw[metric]) * factor
+    return factors
+
+class AgentConnection:
+    def __init__(self, sock, hello):
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+        self.writer = sock.makefile('wb')
+        self.name = hello['name']
+        self.hostName = hello.get('host', '')
+        self.machine = hello['machine']
+        self.fingerprint = hello['fingerprint']
+        self.settings = hello.get('settings', {})
+        self.queue = []
+        self.alive = True
+
+    def close(self):
+        for f in [self.reader, self.writer]:
+            try:
+                f.close()
+            except socket.error:
+                pass
+        self.sock.close()
+
+class Coordinator:
+    def __init__(self, host, port):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(16)
+        self.port = self.server.getsockname()[1]
+        self.agents = []
+        self.condition = threading.Condition()
+
+    def accept(self, count, timeout, check = None):
+        # Waits up to timeout seconds for count agents to say hello. check is
+        # given each hello and returns why the agent cannot take part, or
+        # None. Agents with the same name are told apart by a number.
+        deadline = time.time() + timeout
+        while len(self.agents) < count:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise ShardError('only {} of {} agents connected within {} seconds'.format(len(self.agents), count, timeout))
+            self.server.settimeout(remaining)
+            try:
+                sock, address = self.server.accept()
+            except socket.timeout:
+                continue
+            sock.settimeout(None)
+            reader = sock.makefile('rb')
+            try:
+                hello = receive_message(reader)
+            except ValueError:
+                hello = None
+            finally:
+                reader.close()
+            if hello is None or hello.get('type') != 'hello':
+                sock.close()
+                continue
+
+            agent = AgentConnection(sock, hello)
+            reason = check(hello) if check is not None else None
+            if reason is not None:
+                print('rejected agent {} from {}: {}'.format(agent.name, address[0], reason))
+                send_message(agent.writer, {'type': 'rejected', 'reason': reason})
+                agent.close()
+                continue
+
+            names = [a.name for a in self.agents]
+            name = agent.name
+            number = 2
+            while name in names:
+                name = '{}-{}'.format(agent.name, number)
+                number += 1
+            agent.name = name
+            send_message(agent.writer, {'type': 'welcome', 'name': name})
+            self.agents.append(agent)
+            print('agent {} connected from {} ({} of {})'.format(name, address[0], len(self.agents), count))
+        self.server.settimeout(None)
+
+    def alive_agents(self):
+        return [agent for agent in self.agents if agent.alive]
+
+    def run(self, tasks):
+        # Runs tasks, a list of (agent, task) pairs, and returns one
+        # (agent, result) pair per task in the same order. An agent that
+        # fails hands its tasks on to the others; the run only fails once
+        # there is no agent left.
+        self.results = [None] * len(tasks)
+        self.outstanding = len(tasks)
+        self.orphans = []
+        for agent in self.agents:
+            agent.queue = []
+        for index, (agent, task) in enumerate(tasks):
+            agent.queue.append((index, task))
+
+        threads = []
+        for agent in self.agents:
+            if agent.alive:
+                thread = threading.Thread(target = self.serve, args = (agent,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if self.outstanding != 0:
+            raise ShardError('no agent is left to run the remaining {} tasks'.format(self.outstanding))
+        return self.results
+
+    def next_task(self, agent):
+        # An agent's own tasks come first, then those of failed agents. An
+        # agent that has nothing left waits until every task is done in case
+        # another one fails.
+        with self.condition:
+            while True:
+                if self.outstanding == 0 or not any(a.alive for a in self.agents):
+                    return None
+                if len(agent.queue) != 0:
+                    return agent.queue.pop(0)
+                if len(self.orphans) != 0:
+                    return self.orphans.pop(0)
+                self.condition.wait(1.0)
+
+    def serve(self, agent):
+        while True:
+            entry = self.next_task(agent)
+            if entry is None:
+                return
+            index, task = entry
+            try:
+                send_message(agent.writer, {'type': 'task', 'id': index, 'task': task})
+                reply = receive_message(agent.reader)
+            except (socket.error, ValueError) as e:
+                reply = {'type': 'failed', 'reason': str(e)}
+            if reply is None:
+                reply = {'type': 'failed', 'reason': 'disconnected'}
+
+            with self.condition:
+                if reply.get('type') == 'result' and reply.get('id') == index:
+                    self.results[index] = (agent, reply['result'])
+                    self.outstanding -= 1
+                    self.condition.notify_all()
+                    continue
+
+                agent.alive = False
+                handedOn = [entry] + agent.queue
+                self.orphans += handedOn
+                agent.queue = []
+                print('agent {} failed: {}. {} of its tasks go to the other agents'.format(agent.name, reply.get('reason', reply), len(handedOn)))
+                self.condition.notify_all()
+            agent.close()
+            return
+
+    def close(self):
+        # Tells the agents there is nothing more to run
+        for agent in self.agents:
+            if agent.alive:
+                try:
+                    send_message(agent.writer, {'type': 'done'})
+                except socket.error:
+                    pass
+                agent.close()
+        self.server.close()
+
+class Agent:
+    def __init__(self, host, port, name, settings = None):
+        self.host = host
+        self.port = port
+        self.name = name
+        self.settings = settings or {}
+        self.hostName = host_name()
+        self.machine = machine_info()
+        self.fingerprint = fingerprint(self.machine)
+
+    def connect(self, timeout):
+        # Keeps trying for up to timeout seconds, since the coordinator may
+        # not be listening yet
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self.sock = socket.create_connection((self.host, self.port))
+                break
+            except socket.error as e:
+                if time.time() >= deadline:
+                    raise ShardError('cannot connect to the coordinator at {}:{}: {}'.format(self.host, self.port, e))
+                time.sleep(1)
+        self.reader = self.sock.makefile('rb')
+        self.writer = self.sock.makefile('wb')
+        send_message(self.writer, {'type': 'hello', 'name': self.name, 'host': self.hostName, 'machine': self.machine, 'fingerprint': self.fingerprint, 'settings': self.settings})
+        reply = receive_message(self.reader)
+        if reply is None:
+            raise ShardError('the coordinator closed the connection')
+        if reply['type'] == 'rejected':
+            raise ShardError('the coordinator rejected this agent: {}'.format(reply['reason']))
+        self.name = reply['name']
+
+    def serve(self, handler):
+        # Runs handler on every task until the coordinator is done. If a task
+        # fails the coordinator is told before the failure is passed on.
+        try:
+            while True:
+                message = receive_message(self.reader)
+                if message is None or message['type'] == 'done':
+                    return
+                try:
+                    result = handler(message['task'])
+                except BaseException as e:
+                    send_message(self.writer, {'type': 'failed', 'id': message['id'], 'reason': '{}: {}'.format(type(e).__name__, e)})
+                    raise
+                send_message(self.writer, {'type': 'result', 'id': message['id'], 'result': result})
+        finally:
+            self.reader.close()
+            self.writer.close()
+            self.sock.close()
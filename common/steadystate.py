@@ -0,0 +1,30 @@
+# Finds where a series of per-iteration timings settles, so the harnesses can
+# discard the iterations that ran while the disk cache and the JIT/crossgen
+# state were still warming up instead of assuming a fixed warm-up.
+
+from regression import change_point, median
+
+def warmup_length(series, maxWarmup, alpha = 0.05, minShift = 0.05):
+    # Number of leading values of series that belong to a warm-up phase, at
+    # most maxWarmup and never more than half the series.
+    #
+    # The most likely shift within the first maxWarmup values is tested with
+    # a permutation test. If it is significant and the median of the values
+    # before it is more than minShift (a fraction) above the median of the
+    # rest, they are warm-up and the rest of the series is tested again,
+    # since a cold machine often settles in more than one step. Without the
+    # minimum shift, noise on a machine that is already warm is taken for
+    # warm-up in about alpha of the runs. Callers that test several metrics
+    # of the same iterations should divide alpha between them.
+    maxWarmup = min(maxWarmup, len(series) // 2)
+    start = 0
+    while start < maxWarmup:
+        remaining = series[start:]
+        index, p = change_point(remaining, maxIndex = maxWarmup - start)
+        if index is None or p >= alpha:
+            break
+        settled = median(remaining[index:])
+        if median(remaining[:index]) - settled <= minShift * abs(settled):
+            break
+        start += index
+    return start
@@ -0,0 +1,168 @@
+# Live progress metrics of a benchmark run in the OpenMetrics text format,
+# shared by the JitBench timing harness and the native stability runners.
+#
+# Metrics are kept in memory and can be served on a local HTTP endpoint for
+# scraping, rewritten to a textfile every few seconds for a node exporter's
+# textfile collector, or both. Either way a dashboard can follow a long run as
+# it happens.
+
+import os
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+contentType = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# Histogram buckets for iteration durations, in seconds
+durationBuckets = [0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0]
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append('{}="{}"'.format(name, value))
+    return '{' + ','.join(escaped) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+class Telemetry:
+    # Metrics are declared once with describe() and then updated with inc()
+    # for counters, set() for gauges and observe() for histograms. labels is
+    # a dict of label names to values. Every method may be called from any
+    # thread.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+        self.kinds = {}
+        self.helps = {}
+        self.buckets = {}
+        self.values = {}
+        self.server = None
+        self.stopEvent = threading.Event()
+        self.writer = None
+
+    def describe(self, name, kind, help, buckets = None):
+        if kind not in ['counter', 'gauge', 'histogram']:
+            raise ValueError('unknown metric type {}'.format(kind))
+        with self.lock:
+            if name not in self.kinds:
+                self.metrics.append(name)
+            self.kinds[name] = kind
+            self.helps[name] = help
+            self.buckets[name] = list(buckets or durationBuckets) if kind == 'histogram' else None
+            self.values.setdefault(name, {})
+
+    def key(self, name, labels, kind):
+        if self.kinds.get(name) != kind:
+            raise ValueError('{} is not a declared {}'.format(name, kind))
+        return tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, labels = None, amount = 1):
+        with self.lock:
+            key = self.key(name, labels, 'counter')
+            self.values[name][key] = self.values[name].get(key, 0) + amount
+
+    def set(self, name, labels = None, value = 0):
+        with self.lock:
+            key = self.key(name, labels, 'gauge')
+            self.values[name][key] = value
+
+    def observe(self, name, labels = None, value = 0):
+        with self.lock:
+            key = self.key(name, labels, 'histogram')
+            counts, total, count = self.values[name].get(key, ([0] * len(self.buckets[name]), 0.0, 0))
+            counts = [c + 1 if value <= bound else c for c, bound in zip(counts, self.buckets[name])]
+            self.values[name][key] = (counts, total + value, count + 1)
+
+    def render(self):
+        # The OpenMetrics text exposition of every metric
+        lines = []
+        with self.lock:
+            for name in self.metrics:
+                kind = self.kinds[name]
+                lines.append('# TYPE {} {}'.format(name, kind))
+                lines.append('# HELP {} {}'.format(name, self.helps[name]))
+                for key in sorted(self.values[name].keys()):
+                    value = self.values[name][key]
+                    if kind == 'counter':
+                        lines.append('{}_total{} {}'.format(name, format_labels(key), format_value(value)))
+                    elif kind == 'gauge':
+                        lines.append('{}{} {}'.format(name, format_labels(key), format_value(value)))
+                    else:
+                        counts, total, count = value
+                        for bound, bucketCount in zip(self.buckets[name], counts):
+                            lines.append('{}_bucket{} {}'.format(name, format_labels(key + (('le', format_value(float(bound))),)), bucketCount))
+                        lines.append('{}_bucket{} {}'.format(name, format_labels(key + (('le', '+Inf'),)), count))
+                        lines.append('{}_sum{} {}'.format(name, format_labels(key), format_value(total)))
+                        lines.append('{}_count{} {}'.format(name, format_labels(key), count))
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        # Written to a temporary file and renamed so a reader never sees half of it
+        tempPath = path + '.tmp'
+        f = open(tempPath, 'w')
+        f.write(self.render())
+        f.close()
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tempPath, path)
+
+    def start_textfile(self, path, interval):
+        # Rewrites path every interval seconds until stop()
+        def run():
+            while not self.stopEvent.is_set():
+                self.write_textfile(path)
+                self.stopEvent.wait(interval)
+            self.write_textfile(path)
+        self.writer = threading.Thread(target = run)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def start_http(self, port, host = '127.0.0.1'):
+        # Serves the metrics on http://host:port/metrics until stop(). Returns
+        # the port, which is picked by the OS when port is 0.
+        telemetry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ['/', '/metrics']:
+                    self.send_error(404)
+                    return
+                body = telemetry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', contentType)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes would drown out the benchmark output
+                pass
+
+        self.server = HTTPServer((host, port), Handler)
+        thread = threading.Thread(target = self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.server.server_address[1]
+
+    def stop(self):
+        # Writes the textfile one last time and stops serving
+        self.stopEvent.set()
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
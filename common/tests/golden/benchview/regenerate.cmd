@@ -0,0 +1,14 @@
+@rem Regenerates the golden measurement.json files from the CSVs next to this
+@rem script with BenchView's own measurement.py, the way startup.groovy and
+@rem runPythonOnWindows.bat used to run it. Run it from this directory in a
+@rem workspace with the Microsoft.BenchView.JSONFormat package restored.
+
+del measurement.json 2>nul
+py %WORKSPACE%\Microsoft.BenchView.JSONFormat\tools\measurement.py csv -m "Duration" -u "ms" --better desc --drop-first-value --append startup.txt
+py %WORKSPACE%\Microsoft.BenchView.JSONFormat\tools\measurement.py csv -m "Duration" -u "ms" --better desc --drop-first-value --append request.txt
+py %WORKSPACE%\Microsoft.BenchView.JSONFormat\tools\measurement.py csv -m "Duration" -u "ms" --better desc --drop-first-value --append startup_TieredCompilation.txt
+move /y measurement.json startup.json
+
+del measurement.json 2>nul
+py %WORKSPACE%\Microsoft.BenchView.JSONFormat\tools\measurement.py csv "stability.csv" --metric "Elapsed Time" --unit "Seconds" --better desc --drop-first-value
+move /y measurement.json stability.json
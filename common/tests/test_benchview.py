@@ -0,0 +1,118 @@
+# Checks the measurement.json documents common/benchview.py builds against
+# golden files, for the JitBench timing harness and the Windows stability
+# runner. The golden files stand for what BenchView's measurement.py makes of
+# the CSV files next to them with the flags the CI jobs passed it. They were
+# written by hand from its documented output; regenerate.cmd replaces them
+# with measurement.py's own in a workspace that has the BenchView tools.
+#
+# Run from the repository root with: python -m unittest discover -s common/tests
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+testsDir = os.path.dirname(os.path.abspath(__file__))
+goldenDir = os.path.join(testsDir, 'golden', 'benchview')
+sys.path.insert(0, os.path.join(testsDir, '..'))
+sys.path.insert(0, os.path.join(testsDir, '..', '..', 'JitBench_Timing'))
+
+from benchview import Measurement
+
+def read_csv(name, directory = goldenDir):
+    # The (test path, value) rows of a CSV file, a golden one by default
+    rows = []
+    f = open(os.path.join(directory, name), 'r')
+    for line in f:
+        columns = line.strip().split(',')
+        rows.append((columns[:-1], float(columns[-1])))
+    f.close()
+    return rows
+
+def read_json(path):
+    f = open(path, 'r')
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def add_csv(measurement, name, metric, unit, dropFirst = False):
+    # Adds the rows of a CSV file with the values of each test together
+    tests = []
+    for path, value in read_csv(name):
+        if len(tests) == 0 or tests[-1][0] != path:
+            tests.append((path, []))
+        tests[-1][1].append(value)
+    for path, values in tests:
+        measurement.add(path, metric, unit, 'desc', values, dropFirst = dropFirst)
+
+class MeasurementTest(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def written(self, measurement):
+        path = os.path.join(self.tempDir, 'measurement.json')
+        measurement.write(path)
+        return read_json(path)
+
+    def test_startup(self):
+        # startup.groovy used to run 'measurement.py csv -m Duration -u ms
+        # --better desc --drop-first-value --append' on every text file in
+        # turn
+        measurement = Measurement()
+        for name in ['startup.txt', 'request.txt', 'startup_TieredCompilation.txt']:
+            add_csv(measurement, name, 'Duration', 'ms', dropFirst = True)
+        self.assertEqual(self.written(measurement), read_json(os.path.join(goldenDir, 'startup.json')))
+
+    def test_startup_write_results(self):
+        # The harness builds the same document from the records of its
+        # iterations. Without warm-up detection it drops the first iteration
+        # itself, so its text files start one iteration later than the ones
+        # the upload used to drop it from.
+        import startup
+        config = {'WarmupDetection': False, 'MaxWarmup': 10, 'MinWarmupShift': 5.0}
+        measurement = Measurement()
+        cwd = os.getcwd()
+        os.chdir(self.tempDir)
+        try:
+            for suffix in ['', '_TieredCompilation']:
+                startups = [value for path, value in read_csv('startup{}.txt'.format(suffix))]
+                requests = [value for path, value in read_csv('request.txt')]
+                records = []
+                for index, value in enumerate(startups):
+                    record = dict((metric, 0.0) for metric, title in startup.benchviewTitles)
+                    record['startup'] = value
+                    record['request'] = requests[index]
+                    records.append(record)
+                records, warmup = startup.discard_warmup(config, records)
+                startup.write_results(records, len(records), suffix, measurement)
+                self.assertEqual(read_csv('startup{}.txt'.format(suffix), self.tempDir), read_csv('startup{}.txt'.format(suffix))[1:])
+            self.assertEqual(read_csv('request.txt', self.tempDir), read_csv('request.txt')[1:])
+        finally:
+            os.chdir(cwd)
+
+        # Only the tests with golden CSV files are compared
+        golden = read_json(os.path.join(goldenDir, 'startup.json'))
+        names = [test['name'] for test in golden['tests']]
+        document = self.written(measurement)
+        document['tests'] = sorted([test for test in document['tests'] if test['name'] in names], key = lambda test: names.index(test['name']))
+        self.assertEqual(document, golden)
+
+    def test_stability(self):
+        # runPythonOnWindows.bat used to run 'measurement.py csv stability.csv
+        # --metric "Elapsed Time" --unit Seconds --better desc
+        # --drop-first-value', on a file of benchmark,stability,value rows
+        measurement = Measurement()
+        add_csv(measurement, 'stability.csv', 'Elapsed Time', 'Seconds', dropFirst = True)
+        self.assertEqual(self.written(measurement), read_json(os.path.join(goldenDir, 'stability.json')))
+
+    def test_better(self):
+        self.assertRaises(ValueError, Measurement().add, ['test'], 'Duration', 'ms', 'lower', [1])
+
+if __name__ == '__main__':
+    unittest.main()
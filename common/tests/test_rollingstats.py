@@ -0,0 +1,94 @@
+# Checks RollingStats and its skiplist against statistics recomputed from
+# scratch over the same window.
+#
+# Run from the repository root with: python -m unittest discover -s common/tests
+
+import math
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from rollingstats import IndexableSkiplist, RollingStats
+
+def reference(values, trim):
+    # The trimmed window, its median and its population variance
+    ordered = sorted(values)
+    if len(ordered) > 2 * trim:
+        kept = ordered[trim:len(ordered) - trim]
+    else:
+        kept = ordered
+    count = len(ordered)
+    median = ordered[count // 2] if count % 2 == 1 else (ordered[count // 2 - 1] + ordered[count // 2]) / 2.0
+    mean = sum(kept) / len(kept)
+    variance = sum((v - mean) ** 2 for v in kept) / len(kept)
+    return kept, median, mean, variance
+
+class IndexableSkiplistTest(unittest.TestCase):
+    def test_matches_sorted_list(self):
+        rng = random.Random(1)
+        skiplist = IndexableSkiplist(4)
+        expected = []
+        for step in range(0, 2000):
+            if expected and rng.random() < 0.4:
+                value = rng.choice(expected)
+                expected.remove(value)
+                skiplist.remove(value)
+            else:
+                # Few distinct values, so there are plenty of ties
+                value = float(rng.randint(0, 20))
+                expected.append(value)
+                expected.sort()
+                skiplist.insert(value)
+            self.assertEqual(len(skiplist), len(expected))
+            self.assertEqual(list(skiplist), expected)
+            if expected:
+                index = rng.randrange(len(expected))
+                self.assertEqual(skiplist[index], expected[index])
+
+    def test_remove_missing(self):
+        skiplist = IndexableSkiplist()
+        skiplist.insert(1.0)
+        self.assertRaises(ValueError, skiplist.remove, 2.0)
+        self.assertRaises(IndexError, skiplist.__getitem__, 1)
+
+class RollingStatsTest(unittest.TestCase):
+    def check(self, windowSize, trim):
+        rng = random.Random(windowSize or 0)
+        stats = RollingStats(windowSize, trim)
+        pushed = []
+        for step in range(0, 300):
+            value = 1000.0 + rng.gauss(0, 5) if rng.random() < 0.9 else 1000.0 + rng.choice([-50, 80])
+            stats.push(value)
+            pushed.append(value)
+            window = pushed[-windowSize:] if windowSize else pushed
+            kept, median, mean, variance = reference(window, trim)
+            self.assertEqual(list(stats.values()), kept)
+            self.assertEqual(stats.median(), median)
+            self.assertAlmostEqual(stats.mean(), mean, 6)
+            self.assertAlmostEqual(stats.variance(), variance, 4)
+            rank = int(math.ceil(0.9 * len(kept)))
+            self.assertEqual(stats.percentile(90), kept[min(max(rank, 1), len(kept)) - 1])
+
+    def test_unbounded(self):
+        self.check(None, 0)
+
+    def test_window(self):
+        self.check(5, 0)
+
+    def test_trimmed_window(self):
+        self.check(10, 2)
+
+    def test_empty(self):
+        stats = RollingStats(5)
+        self.assertEqual(stats.median(), 0.0)
+        self.assertEqual(stats.mean(), 0.0)
+        self.assertEqual(stats.percentile(95), 0.0)
+        self.assertEqual(stats.variance(), 0.0)
+        self.assertEqual(stats.bootstrap_ci(), (0.0, 0.0))
+        self.assertEqual(list(stats.values()), [])
+
+if __name__ == '__main__':
+    unittest.main()
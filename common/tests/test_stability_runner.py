@@ -0,0 +1,59 @@
+# Runs the portable native stability runner under the current interpreter on
+# a benchmark that only prints a result, the way the JitBench machine noise
+# check runs it.
+#
+# Run from the repository root with: python -m unittest discover -s common/tests
+
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+testsDir = os.path.dirname(os.path.abspath(__file__))
+runnerPath = os.path.join(testsDir, '..', '..', 'stability', 'stability', 'native-stability-test.py')
+
+class StabilityRunnerTest(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def run_runner(self, *arguments):
+        registry = {
+            'printer': {
+                'sources': {platform.system(): 'unused'},
+                'command': '"{}" -c "print(\'[HOOKS] Total time spent in ROI: 1.500s\')"'.format(sys.executable),
+                'resultRegex': '\\[HOOKS\\] Total time spent in ROI: (\\d+(?:\\.\\d+)?)s',
+                'metric': 'Elapsed Time',
+                'units': 'Seconds',
+                'stdDev': 1.0
+            }
+        }
+        registryPath = os.path.join(self.tempDir, 'benchmarks.json')
+        registryFile = open(registryPath, 'w')
+        json.dump(registry, registryFile)
+        registryFile.close()
+
+        command = [sys.executable, runnerPath, '--registry', registryPath, '--target-dir', self.tempDir, '--no-unpack', '--no-result-store'] + list(arguments)
+        proc = subprocess.Popen(command, cwd = self.tempDir, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+        output = proc.communicate()[0].decode('utf-8', 'replace')
+        return proc.returncode, output
+
+    def test_stabilization(self):
+        # The output the machine noise check reads its result from
+        returnCode, output = self.run_runner('--stabilization', '--stabilization-iterations', '3', '--iterations', '5')
+        self.assertEqual(returnCode, 0, output)
+        self.assertTrue('Standard deviation was 0.00% of median 1.500 over the last 3 iterations' in output, output)
+
+    def test_iterations(self):
+        returnCode, output = self.run_runner('--iterations', '3')
+        self.assertEqual(returnCode, 0, output)
+        self.assertTrue('Iteration 3 of 3 - 1.500000s' in output, output)
+
+if __name__ == '__main__':
+    unittest.main()
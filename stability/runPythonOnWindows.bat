@@ -5,7 +5,6 @@ set timestamp=%mydate%T%mytime%:00Z
 py %WORKSPACE%\Microsoft.BenchView.JSONFormat\tools\submission-metadata.py --name "%COMPUTERNAME% Stability Run %mydate%-%mytime%" --user-email "dotnet-bot@microsoft.com"
 py %WORKSPACE%\Microsoft.BenchView.JSONFormat\tools\build.py git --type rolling --branch master --number %mydate%-%mytime% --source-timestamp "%timestamp%"
 py %WORKSPACE%\Microsoft.BenchView.JSONFormat\tools\machinedata.py
-py %WORKSPACE%\Microsoft.BenchView.JSONFormat\tools\measurement.py csv "stability.csv" --metric "Elapsed Time" --unit "Seconds" --better desc --drop-first-value
 py %WORKSPACE%\Microsoft.BenchView.JSONFormat\tools\submission.py measurement.json ^
                                                                --build build.json ^
                                                                --machine-data machinedata.json ^
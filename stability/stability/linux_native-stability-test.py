@@ -5,154 +5,288 @@ import os.path
 import platform
 import sys
 import argparse
-import urllib
-import tarfile
-import shutil
 import time
 import subprocess
-import re
-import math
+import threading
+import traceback
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common'))
+from rollingstats import RollingStats
+from resultstore import ResultStore, new_run_id
+from regression import compare_run, write_report
+from procstats import check_output_with_usage, format_usage, usageMetrics
+from benchmarks import load_registry, parse_result
+from cpusets import split_cores, pin_command
+from downloadcache import DownloadCache, unpack
+from telemetry import Telemetry
+from checkpoint import Checkpoint, RetryBudget, fingerprint
 
 argParser = argparse.ArgumentParser()
 argParser.add_argument('--stabilization', help="Run in stabilization mode.  Run until the standard deviation of the last N runs (stabilization-iterations) dips below a threshold", action="store_true")
 argParser.add_argument('--stabilization-iterations', help="Number of successive iterations to measure in stabilization mode.", type=int, default=5)
-argParser.add_argument('--std-dev', help='Target standard deviation in stabilization mode.  In %% points', type=float, default=1)
+argParser.add_argument('--std-dev', help='Target standard deviation in stabilization mode.  In %% points.  Defaults to the target of each benchmark in the registry', type=float, default=None)
 argParser.add_argument('--iterations', help="Number of iterations to run.  If in stabilization mode, this is the maximum number of iterations to run before giving up.  Otherwise this is the desired number of iterations.", type=int, default=1)
 argParser.add_argument('--target-dir', help="Target directory for downloaded benchmarks", type=str, default=os.getcwd())
-argParser.add_argument('--offline', help="Skip download of benchmarks", action="store_true")
+argParser.add_argument('--offline', help="Skip download of benchmarks.  They must already be in the download cache", action="store_true")
 argParser.add_argument('--no-unpack', help="Skip unpack of benchmarks (assumes already unpacked in target dir).  Implies offline", action="store_true")
+argParser.add_argument('--cache-dir', help="Directory downloaded benchmarks are cached in.  Defaults to download-cache in the target dir", type=str, default=None)
+argParser.add_argument('--result-store', help="SQLite result store that every iteration is appended to", type=str, default=os.path.join(os.getcwd(), 'results.db'))
+argParser.add_argument('--no-result-store', help="Do not append iterations to the result store", action="store_true")
+argParser.add_argument('--baseline-runs', help="Number of previous runs in the result store to compare this run against", type=int, default=10)
+argParser.add_argument('--registry', help="Benchmark registry to read the benchmarks from", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks.json'))
+argParser.add_argument('--benchmarks', help="Comma separated names of the registered benchmarks to run.  Defaults to all of them", type=str, default=None)
+argParser.add_argument('--parallel', help="Run the selected benchmarks at the same time, each pinned to its own set of processors", action="store_true")
+argParser.add_argument('--resume', help="Continue each benchmark from the iterations an interrupted run saved in its checkpoint, if the command line and settings are the same", action="store_true")
+argParser.add_argument('--retries', help="Number of failed benchmark launches the whole run may retry before it fails", type=int, default=2)
+argParser.add_argument('--telemetry-port', help="Serve live progress metrics in the OpenMetrics format on http://127.0.0.1:PORT/metrics", type=int, default=None)
+argParser.add_argument('--telemetry-file', help="Rewrite live progress metrics in the OpenMetrics format to this file every --telemetry-interval seconds", type=str, default=None)
+argParser.add_argument('--telemetry-interval', help="Seconds between rewrites of --telemetry-file", type=int, default=10)
 args = None
 
-# Downloads the benchmark to the target location
-def downloadAndUnpack(sourceLocation, targetLocation):
-    if (sourceLocation.find("http://") == 0) or (sourceLocation.find("https://") == 0):
-        if ((not args.offline) and (not args.no_unpack)):
-            print("Downloading from %s to %s" % (sourceLocation, targetLocation))
-            # Download
-            urllib.urlretrieve (sourceLocation, targetLocation)
-    else:
-        # Copy to target location
-        print("Copying from %s to %s" % (sourceLocation, targetLocation))
-        shutil.copy(sourceLocation, targetLocation)
-    
-    if (not args.no_unpack):
-        print("Unpacking from %s" % (targetLocation))
-        # Unpack. Check extension Assumed to be zip
-        benchmarkTar = tarfile.open(targetLocation)
-        benchmarkTar.extractall()
-        benchmarkTar.close()
+# Ids of the runs appended to the result store by this invocation
+storedRuns = []
+
+# Serializes output when benchmarks run in parallel
+outputLock = threading.Lock()
+
+# Live metrics of the run, None unless --telemetry-port or --telemetry-file asked for them
+telemetry = None
+
+def startTelemetry():
+    global telemetry
+    if (args.telemetry_port == None and args.telemetry_file == None):
+        return
+    telemetry = Telemetry()
+    telemetry.describe('stability_iterations', 'counter', 'Benchmark iterations completed.')
+    telemetry.describe('stability_last_value', 'gauge', 'Result of the latest iteration.')
+    telemetry.describe('stability_median_value', 'gauge', 'Median result so far.')
+    telemetry.describe('stability_p95_value', 'gauge', '95th percentile result so far.')
+    telemetry.describe('stability_stddev_percent', 'gauge', 'Standard deviation of the last stabilization-iterations results in percent of their median.')
+    telemetry.describe('stability_stddev_target_percent', 'gauge', 'Standard deviation the benchmark has to get below.')
+    telemetry.describe('stability_iteration_duration_seconds', 'histogram', 'Wall time of each iteration.')
+    if (args.telemetry_port != None):
+        port = telemetry.start_http(args.telemetry_port)
+        print("Serving live metrics on http://127.0.0.1:%d/metrics" % (port))
+    if (args.telemetry_file != None):
+        telemetry.start_textfile(args.telemetry_file, args.telemetry_interval)
+
+def reportTelemetry(benchmarkName, window, overall, timing, duration, stdDev):
+    if (telemetry == None):
+        return
+    labels = {'benchmark': benchmarkName}
+    telemetry.inc('stability_iterations', labels)
+    telemetry.set('stability_last_value', labels, timing)
+    telemetry.set('stability_median_value', labels, overall.median())
+    telemetry.set('stability_p95_value', labels, overall.percentile(95))
+    telemetry.set('stability_stddev_percent', labels, window.percent_of_median())
+    telemetry.set('stability_stddev_target_percent', labels, stdDev)
+    telemetry.observe('stability_iteration_duration_seconds', labels, duration)
+
+# Number of smallest and largest values dropped before computing statistics
+trimCount = 0
+
+# Fetches the benchmark through the download cache and unpacks it into the current directory.
+# Both steps are skipped when the cached archive and the unpacked files are intact.
+def downloadAndUnpack(sourceLocation, expectedHash):
+    if (args.no_unpack):
+        return 0
+    cacheDir = args.cache_dir if (args.cache_dir != None) else os.path.join(args.target_dir, 'download-cache')
+    archivePath, digest = DownloadCache(cacheDir).fetch(sourceLocation, expectedHash, args.offline)
+    unpack(archivePath, digest, os.getcwd())
     return 0
     
-def runAndProcess(commandLine, processFunc):
+def report(benchmarkName, message):
+    # Prints a line of progress, prefixed with the benchmark when several run at once
+    with outputLock:
+        if (args.parallel):
+            message = "[%s] %s" % (benchmarkName, message)
+        print(message)
+        sys.stdout.flush()
+
+# Failed launches the whole run may retry before it fails
+retryBudget = None
+
+def runIteration(commandLine, processFunc, benchmarkName):
+    # Runs the benchmark once and returns (timing, usage, duration). A launch that fails or
+    # prints no result is run again while the retry budget lasts.
+    while True:
+        try:
+            start = time.time()
+            result, usage = check_output_with_usage(commandLine)
+            duration = time.time() - start
+            timing = processFunc(result)
+            if (timing == None):
+                raise ValueError("no result in the output of %s" % (commandLine))
+            return timing, usage, duration
+        except (subprocess.CalledProcessError, ValueError) as e:
+            if (not retryBudget.take()):
+                raise
+            report(benchmarkName, "Iteration failed (%s), retrying with %d retries left" % (e, retryBudget.remaining))
+
+def openCheckpoint(commandLine, benchmarkName, stdDev):
+    # Every completed iteration is saved to a checkpoint in the benchmark's directory so an
+    # interrupted run can be resumed with --resume under the same settings
+    settings = [benchmarkName, commandLine, platformSystemName, args.iterations, args.stabilization, args.stabilization_iterations, stdDev, trimCount]
+    checkpoint = Checkpoint(os.path.join(os.getcwd(), 'checkpoint-%s.jsonl' % (benchmarkName)), fingerprint(settings))
+    if (args.resume and checkpoint.load()):
+        # A finished checkpoint is only read, its iterations are already in the result store
+        if (checkpoint.finished == None):
+            report(benchmarkName, "Resuming after %d completed iterations" % (len(checkpoint.records)))
+            checkpoint.start()
+    else:
+        checkpoint = Checkpoint(checkpoint.path, checkpoint.fingerprint)
+        checkpoint.start({'run': new_run_id()})
+    return checkpoint
+
+def runAndProcess(commandLine, processFunc, benchmarkName, metricName, stdDev):
+    checkpoint = openCheckpoint(commandLine, benchmarkName, stdDev)
     # Current results
-    results = []
+    results = [record['value'] for record in checkpoint.records]
+    if (checkpoint.finished != None):
+        report(benchmarkName, "Already finished with %d iterations" % (len(results)))
+        return checkpoint.finished
+    # Every iteration is also appended to the result store as soon as it completes
+    runId = checkpoint.state['run']
+    store = None if args.no_result_store else ResultStore(args.result_store)
+    if (store != None):
+        storedRuns.append(runId)
+    # Statistics over the last stabilization-iterations results and over all of them
+    window = RollingStats(args.stabilization_iterations, trimCount)
+    overall = RollingStats(None, trimCount)
+    for timing in results:
+        window.push(timing)
+        overall.push(timing)
     
     # Loop over the maximum number of iterations
     maxIter = args.iterations
-    for i in range(1, maxIter + 1):
-        sys.stdout.write('Running iteration %d of %d - ' % (i, maxIter))
-        sys.stdout.flush()
+    for i in range(len(results) + 1, maxIter + 1):
         # Execute the benchmark
-        result = subprocess.check_output(commandLine, shell=True)
+        timing, usage, duration = runIteration(commandLine, processFunc, benchmarkName)
         # Process the results
-        timing = processFunc(result)
         results.append(timing)
-        print ("%fs" % (timing))
+        checkpoint.append({'iteration': i, 'value': timing})
+        window.push(timing)
+        overall.push(timing)
+        reportTelemetry(benchmarkName, window, overall, timing, duration, stdDev)
+        if (store != None):
+            rows = [{'run': runId, 'benchmark': benchmarkName, 'metric': metricName, 'config': platformSystemName, 'iteration': i, 'value': timing}]
+            for metric in usageMetrics:
+                if (usage[metric] != None):
+                    rows.append({'run': runId, 'benchmark': benchmarkName, 'metric': metric, 'config': platformSystemName, 'iteration': i, 'value': usage[metric]})
+            store.append(rows)
+        report(benchmarkName, "Iteration %d of %d - %fs (%s)" % (i, maxIter, timing, format_usage(usage)))
         # If in stabilization mode and we're over the target number of iterations, compute the standard
         # deviation over the target number of stabilization iterations.  If below the stabilization target, exit.
         # If we haven't hit the stabilization target, continue
         if (args.stabilization and i >= args.stabilization_iterations):
-            median, percentOfMedian = computeStats (results, args.stabilization_iterations)
-            print ("Standard deviation was %.2f%% of median %.3f over the last %d iterations" % (percentOfMedian, median, args.stabilization_iterations))
-            if (percentOfMedian <= args.std_dev):
-                print ("Hit target of < %.2f%%, stopping" % (args.std_dev))
-                return 0
+            median, percentOfMedian = window.median(), window.percent_of_median()
+            report(benchmarkName, "Standard deviation was %.2f%% of median %.3f over the last %d iterations" % (percentOfMedian, median, args.stabilization_iterations))
+            if (percentOfMedian <= stdDev):
+                report(benchmarkName, "Hit target of < %.2f%%, stopping" % (stdDev))
+                return checkpoint.finish(0)
             else:
-                print ("Haven't hit target of < %.2f%%, continuing" % (args.std_dev))
+                report(benchmarkName, "Haven't hit target of < %.2f%%, continuing" % (stdDev))
     
     # If in stabilization mode and we haven't hit the target, then exit with a non-zero exit code to indicate that
     # Something is wrong here.
     if (args.stabilization):
-        print ("Failed to hit standard deviation target of %.2f%%, exiting" % (args.std_dev))
-        return 1
+        report(benchmarkName, "Failed to hit standard deviation target of %.2f%%, exiting" % (stdDev))
+        return checkpoint.finish(1)
     else:
         # Compute and print the standard deviation
-        median, percentOfMedian = computeStats (results, len(results))
-        print ("Standard deviation was %.2f%% of median %.3f." % (percentOfMedian, median))
-        if (percentOfMedian <= args.std_dev):
-            print ("Hit target of < %.2f%%" % (args.std_dev))
-            return 0
+        median, percentOfMedian = overall.median(), overall.percent_of_median()
+        report(benchmarkName, "Standard deviation was %.2f%% of median %.3f." % (percentOfMedian, median))
+        low, high = overall.bootstrap_ci()
+        report(benchmarkName, "95%% bootstrap confidence interval of the median is [%.3f, %.3f]" % (low, high))
+        if (percentOfMedian <= stdDev):
+            report(benchmarkName, "Hit target of < %.2f%%" % (stdDev))
+            return checkpoint.finish(0)
         else:
-            print ("Did not hit target of < %.2f%%, failing" % (args.std_dev))
-            return 1
-
-# Computes the median and standard deviatio.  There isn't a standard library
-# for this so we do it manually.
-def computeStats(results, lastNValues):
-
-    resultsLen = len(results)
-    # Grab the sub array
-    subArray = results[resultsLen-lastNValues:resultsLen]
-    # Sort
-    subArray = sorted(subArray)
-    # Find the median
-    median = None
-    medianValueIndex = (lastNValues - 1) / 2
-    if (lastNValues % 2 == 1):
-        median = float(subArray[medianValueIndex])
-    else:
-        median = float(subArray[medianValueIndex] + subArray[medianValueIndex + 1]/2.0)
-    
-    # Find the mean
-    mean = sum(subArray) / float(lastNValues)
-    # percent of median is the standard deviation computed as a % of the median.
-    sqdiff = map(lambda x: (x - mean) ** 2, subArray)
-    meanSqdif = sum(sqdiff) / float(lastNValues)
-    sqrtmeanSqdif = math.sqrt(meanSqdif)
-    
-    # Compute percentage of the median
-    percentOfMedian = (sqrtmeanSqdif / median) * 100.0
-    return (median, percentOfMedian)
-    
-# Given output from a command line, process the result and return the ET.
-def parsecProcessResults(result):
-    # Match the data in the 
-    for line in iter(result.splitlines()):
-        m = re.search('\[HOOKS\] Total time spent in ROI: (\d+\.?\d+)*s', line)
-        if (m == None):
-            continue
-        timing = m.group(1)
-        return float(timing)
-        
-def runParsec():
-    # Table of parsec build locations, indexed by platform
-    blackScholesLocations = {'Windows' : 'https://dciperfdata.blob.core.windows.net/stability/Windows-blackscholes.tar.gz',
-                             'Linux' : 'https://dciperfdata.blob.core.windows.net/stability/Linux-blackscholes.tar.gz'}
-    
-    # Download blackscholes
-    benchmarkLocation = blackScholesLocations[platformSystemName]
-    targetDir = os.path.join(args.target_dir, 'blackscholes')
-    if not os.path.exists(targetDir):
-        os.makedirs(targetDir)
-    targetFile = os.path.join(targetDir, 'blackscholes.tar.gz')
-    downloadAndUnpack(benchmarkLocation, targetFile)
-    
-    return runAndProcess('/mnt/j/workspace/dotnet_citest/stability_test_07_20/blackscholes_cpp_serial 1 in_10M.txt prices.txt', parsecProcessResults)
-    
-# List of benchmarks to run
-benchmarkRunners = {'Parsec': runParsec}
-    
+            report(benchmarkName, "Did not hit target of < %.2f%%, failing" % (stdDev))
+            return checkpoint.finish(1)
+
+# Directory the benchmarks are run from, substituted for {binDir} in the command templates of the registry
+binDir = '/mnt/j/workspace/dotnet_citest/stability_test_07_20/'
+
+# Processors a benchmark is pinned to when it runs on its own, None to not pin it
+defaultCores = None
+
+def runBenchmark(benchmarkName, spec, cores):
+    # Download the benchmark
+    downloadAndUnpack(spec['sources'][platformSystemName], spec.get('sha256'))
+
+    commandLine = spec['command'].format(binDir = binDir)
+    if (cores != None):
+        commandLine = pin_command(commandLine, cores, False)
+    stdDev = args.std_dev if (args.std_dev != None) else spec['stdDev']
+    return runAndProcess(commandLine, lambda result: parse_result(spec, result), benchmarkName, spec['metric'], stdDev)
+
+def runParallel(registry, benchmarkNames):
+    # Runs every benchmark at the same time on its own set of processors and
+    # returns the names of the ones that failed
+    try:
+        coreSets = split_cores(len(benchmarkNames))
+    except ValueError as e:
+        print ("Cannot run %d benchmarks in parallel: %s" % (len(benchmarkNames), e))
+        return benchmarkNames
+    failures = []
+    failuresLock = threading.Lock()
+    def run(benchmarkName, cores):
+        # A benchmark that raises, or exits, would otherwise only end its own thread
+        try:
+            report(benchmarkName, "Running on processors %s" % (','.join(str(c) for c in cores)))
+            failed = (runBenchmark(benchmarkName, registry[benchmarkName], cores) != 0)
+        except BaseException:
+            report(benchmarkName, "Failed with an exception\n%s" % (traceback.format_exc()))
+            failed = True
+        if (failed):
+            with failuresLock:
+                failures.append(benchmarkName)
+    threads = []
+    for benchmarkName, cores in zip(benchmarkNames, coreSets):
+        thread = threading.Thread(target = run, args = (benchmarkName, cores))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return failures
+
 if __name__ == '__main__':
     args = argParser.parse_args()
+    retryBudget = RetryBudget(args.retries)
+    startTelemetry()
     # Check the arguments
     
     platformSystemName = platform.system()
-    print("Running native stability tests on %s. Aiming for standard deviation of %.2f%% from median" % (platformSystemName, args.std_dev))
+    registry = load_registry(args.registry)
+    benchmarkNames = args.benchmarks.split(',') if (args.benchmarks != None) else sorted(registry.keys())
+    for benchmarkName in benchmarkNames:
+        if (benchmarkName not in registry):
+            print ("Unknown benchmark %s, %s only has %s" % (benchmarkName, args.registry, ', '.join(sorted(registry.keys()))))
+            sys.exit(1)
+    print("Running native stability tests on %s" % (platformSystemName))
     
-    for benchmarkName, benchmarkFunction, in benchmarkRunners.iteritems():
-        print("Running %s" % (benchmarkName))
-        if (benchmarkFunction() != 0):
-            print ("Benchmark failed to reach desired standard deviation, exiting")
+    if (args.parallel and len(benchmarkNames) > 1):
+        print("Running %s in parallel" % (', '.join(benchmarkNames)))
+        failures = runParallel(registry, benchmarkNames)
+        if (len(failures) != 0):
+            print ("%s failed to reach desired standard deviation, exiting" % (', '.join(sorted(failures))))
             sys.exit(1)
+    else:
+        for benchmarkName in benchmarkNames:
+            print("Running %s" % (benchmarkName))
+            if (runBenchmark(benchmarkName, registry[benchmarkName], defaultCores) != 0):
+                print ("Benchmark failed to reach desired standard deviation, exiting")
+                sys.exit(1)
+
+    # Compare with the previous runs on this machine to catch drift in the hardware
+    if (not args.no_result_store):
+        store = ResultStore(args.result_store)
+        findings = []
+        for runId in storedRuns:
+            findings += compare_run(store, runId, args.baseline_runs)
+        write_report(findings, 'regressions.txt')
+    if (telemetry != None):
+        telemetry.stop()
     sys.exit(0)
     
\ No newline at end of file
@@ -88,18 +88,8 @@ def osShortName = ['Windows 10': 'win10',
                                 "py %WORKSPACE%\\Microsoft.BenchView.JSONFormat\\tools\\build.py git --type rolling --branch master --number %mydate%-%mytime% --source-timestamp \"%timestamp%\"")
                     batchFile("py \"%WORKSPACE%\\Microsoft.BenchView.JSONFormat\\tools\\machinedata.py\"")
                     batchFile("pushd JitBench_Timing\n" +
-                    "py startup.py")
+                    "py startup.py --preflight flag --benchview-measurement measurement.json")
                     batchFile("popd")
-                    batchFile("py %WORKSPACE%\\Microsoft.BenchView.JSONFormat\\tools\\measurement.py csv -m \"Duration\" -u \"ms\" --better desc --drop-first-value --append startup.txt")
-                    batchFile("py %WORKSPACE%\\Microsoft.BenchView.JSONFormat\\tools\\measurement.py csv -m \"Duration\" -u \"ms\" --better desc --drop-first-value --append request.txt")
-                    batchFile("py %WORKSPACE%\\Microsoft.BenchView.JSONFormat\\tools\\measurement.py csv -m \"Duration\" -u \"ms\" --better desc --drop-first-value --append avgSteadyState.txt")
-                    batchFile("py %WORKSPACE%\\Microsoft.BenchView.JSONFormat\\tools\\measurement.py csv -m \"Duration\" -u \"ms\" --better desc --drop-first-value --append maxSteadyState.txt")
-                    batchFile("py %WORKSPACE%\\Microsoft.BenchView.JSONFormat\\tools\\measurement.py csv -m \"Duration\" -u \"ms\" --better desc --drop-first-value --append minSteadyState.txt")
-                    batchFile("py %WORKSPACE%\\Microsoft.BenchView.JSONFormat\\tools\\measurement.py csv -m \"Duration\" -u \"ms\" --better desc --drop-first-value --append startup_TieredCompilation.txt")
-                    batchFile("py %WORKSPACE%\\Microsoft.BenchView.JSONFormat\\tools\\measurement.py csv -m \"Duration\" -u \"ms\" --better desc --drop-first-value --append request_TieredCompilation.txt")
-                    batchFile("py %WORKSPACE%\\Microsoft.BenchView.JSONFormat\\tools\\measurement.py csv -m \"Duration\" -u \"ms\" --better desc --drop-first-value --append avgSteadyState_TieredCompilation.txt")
-                    batchFile("py %WORKSPACE%\\Microsoft.BenchView.JSONFormat\\tools\\measurement.py csv -m \"Duration\" -u \"ms\" --better desc --drop-first-value --append maxSteadyState_TieredCompilation.txt")
-                    batchFile("py %WORKSPACE%\\Microsoft.BenchView.JSONFormat\\tools\\measurement.py csv -m \"Duration\" -u \"ms\" --better desc --drop-first-value --append minSteadyState_TieredCompilation.txt")
                     batchFile("py \"%WORKSPACE%\\Microsoft.BenchView.JSONFormat\\tools\\submission.py\" measurement.json " +
                                     "--build build.json " +
                                     "--machine-data machinedata.json " +